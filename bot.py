@@ -1,13 +1,28 @@
 import asyncio
+import bisect
+import contextlib
+import copy
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
 import json
 import logging
-import time
 import os
+import shutil
+import sqlite3
+import time
+import weakref
+import zlib
 import calendar
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-from telegram.ext import JobQueue
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telegram.ext import BaseHandler, BaseUpdateProcessor, JobQueue
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -25,8 +40,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Временная зона Москвы
-MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+# Часовой пояс по умолчанию: для пользователей без своего пояса и старых записей без пояса
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+DEFAULT_TZ = ZoneInfo(DEFAULT_TIMEZONE)
 
 # Состояния для ConversationHandler
 ADD_TEXT, ADD_DAY, ADD_TIME, ADD_INTERVAL, ADD_USERS = range(5)
@@ -37,8 +53,7 @@ DELETE_CONFIRM = range(1)
 EDIT_RECIPE_NAME, EDIT_RECIPE_INGREDIENTS = range(2, 4)
 EDIT_PLAN_ASSIGNMENT = range(4)
 
-def get_main_keyboard():
-    """Возвращает основную клавиатуру"""
+def _build_main_keyboard():
     keyboard = [
         [
             InlineKeyboardButton("➕ Добавить напоминание", callback_data="add_reminder"),
@@ -52,299 +67,2161 @@ def get_main_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def load_users():
+_DAY_ROWS = [
+    [InlineKeyboardButton("Сегодня", callback_data="day_today")],
+    [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
+    [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
+    [InlineKeyboardButton("Другое", callback_data="day_custom")],
+]
+_INTERVAL_ROWS = [
+    [InlineKeyboardButton("Однократно", callback_data="interval_0")],
+    [InlineKeyboardButton("Каждый день", callback_data="interval_1")],
+    [InlineKeyboardButton("Каждые 3 дня", callback_data="interval_3")],
+    [InlineKeyboardButton("Каждую неделю", callback_data="interval_7")],
+]
+
+# СТАТИЧЕСКИЕ КЛАВИАТУРЫ строятся один раз при запуске (InlineKeyboardMarkup неизменяем)
+MAIN_KEYBOARD = _build_main_keyboard()
+# Выбор дня напоминания с кнопкой "Отмена"
+DAY_SELECTION_KEYBOARD = InlineKeyboardMarkup(_DAY_ROWS + [
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
+])
+# Выбор дня напоминания с кнопками "Назад" и "На главную"
+DAY_SELECTION_BACK_KEYBOARD = InlineKeyboardMarkup(_DAY_ROWS + [
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_text_input")],
+    [InlineKeyboardButton("🔙 На главную", callback_data="back_to_main")]
+])
+# Выбор интервала повторения с кнопками "Назад" и "Отмена"
+INTERVAL_KEYBOARD = InlineKeyboardMarkup(_INTERVAL_ROWS + [
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_day_selection")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
+])
+
+def get_main_keyboard():
+    """Возвращает основную клавиатуру"""
+    return MAIN_KEYBOARD
+
+# Задержка отложенной записи состояния на диск (секунды)
+STATE_FLUSH_DELAY = 2.0
+# Сколько раз повторяется оптимистичное обновление записи при конфликте версий
+CAS_MAX_ATTEMPTS = 5
+
+class VersionConflict(Exception):
+    """Запись изменили параллельно: ее версия не совпадает с той, на которой основано изменение"""
+
+    def __init__(self, name, record_ids):
+        super().__init__(f"{name}: {', '.join(map(str, record_ids))}")
+        self.name = name
+        self.record_ids = list(record_ids)
+
+class RecordMap(dict):
+    """Копия коллекции, запоминающая измененные и удаленные записи
+
+    Записи копируются при первом чтении: изменения на месте не трогают
+    хранилище до сохранения, а сохраняются только назначенные, удаленные
+    и реально измененные записи. Для каждой из них запоминается версия,
+    на которой основано изменение (base_versions); при сохранении она
+    сверяется с текущей.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.assigned = set()
+        self.removed = set()
+        self.base_versions = {}
+        # ID -> запись хранилища, с которой снята выданная копия
+        self.read = {}
+
+    def _remember_base(self, key):
+        if key not in self.base_versions:
+            record = dict.get(self, key, _MISSING)
+            self.base_versions[key] = _MISSING if record is _MISSING else getattr(record, 'version', None)
+
+    def _checkout(self, key):
+        """Запись по ключу; запись хранилища при первом чтении заменяется копией"""
+        record = dict.__getitem__(self, key)
+        if key in self.read or key in self.assigned or not isinstance(record, Record):
+            return record
+        self._remember_base(key)
+        clone = record.clone()
+        dict.__setitem__(self, key, clone)
+        self.read[key] = record
+        return clone
+
+    def __getitem__(self, key):
+        return self._checkout(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._checkout(key)
+        return default
+
+    def values(self):
+        return [self._checkout(key) for key in self]
+
+    def items(self):
+        return [(key, self._checkout(key)) for key in self]
+
+    def changed(self):
+        """ID прочитанных записей, измененных на месте"""
+        return {key for key, original in self.read.items()
+                if key not in self.assigned and key not in self.removed
+                and not dict.__getitem__(self, key).same_content(original)}
+
+    def _committed(self, key, stored):
+        """После сохранения: дальнейшие изменения сравниваются с записанной версией"""
+        self.read[key] = stored
+        self.base_versions[key] = getattr(stored, 'version', None)
+
+    def __setitem__(self, key, value):
+        self._remember_base(key)
+        super().__setitem__(key, value)
+        self.assigned.add(key)
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        self._remember_base(key)
+        super().__delitem__(key)
+        self.assigned.discard(key)
+        self.removed.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._remember_base(key)
+            self.assigned.discard(key)
+            self.removed.add(key)
+        return super().pop(key, *default)
+
+class StateRepository:
+    """Хранилище состояния в памяти: читает backend один раз и пишет в него отложенно"""
+
+    def __init__(self, backend, record_types=None, flush_delay=STATE_FLUSH_DELAY):
+        self.backend = backend
+        self.record_types = record_types or {}
+        self.flush_delay = flush_delay
+        self._collections = {}
+        self._dirty = {}
+        self._flush_handle = None
+        self._flush_task = None
+        self._listeners = []
+        # Все обращения к backend'у (сериализация и диск) идут через один поток
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+
+    def _run(self, func, *args):
+        """Выполняет функцию в потоке записи и ждет результата (блокирующе)"""
+        return self._writer.submit(func, *args).result()
+
+    async def _run_async(self, func, *args):
+        """Выполняет функцию в потоке записи, не блокируя цикл событий"""
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    def _coerce(self, name, record):
+        record_type = self.record_types.get(name)
+        return record_type.coerce(record) if record_type else record
+
+    def _wrap(self, name, records):
+        """Превращает загруженные словари в записи коллекции"""
+        record_type = self.record_types.get(name)
+        if record_type is None:
+            return records
+        wrapped = {}
+        outdated = []
+        for record_id, record in records.items():
+            wrapped[record_id] = record_type.coerce(record)
+            if isinstance(record, dict) and wrapped[record_id].stored_outdated(record):
+                outdated.append(record_id)
+        if outdated:
+            # Записи в старом виде (например, время ISO-строкой) переписываются при ближайшей записи
+            self._dirty.setdefault(name, set()).update(outdated)
+            logger.info(f"🔄 {name}: записей в старом формате будет переписано: {len(outdated)}")
+        return wrapped
+
+    def collection(self, name):
+        """Возвращает живую коллекцию, загружая ее при первом обращении"""
+        records = self._collections.get(name)
+        if records is None:
+            records = self._wrap(name, self._run(self.backend.load, name))
+            self._collections[name] = records
+        return records
+
+    def load_all(self):
+        """Загружает все коллекции backend'а"""
+        for name in self.backend.collections:
+            self.collection(name)
+
+    async def load_all_async(self):
+        """Загружает все коллекции backend'а в потоке записи"""
+        for name in self.backend.collections:
+            if name not in self._collections:
+                self._collections[name] = self._wrap(name, await self._run_async(self.backend.load, name))
+
+    async def find_ids(self, name, field, value):
+        """Возвращает ID записей с заданным значением поля (по индексу, если он есть)"""
+        live = self.collection(name)
+        if self.backend.has_index(name, field):
+            candidates = set(await self._run_async(self.backend.find_ids, name, field, value))
+            # Еще не записанные изменения база не видит - проверяем их по памяти
+            candidates.update(self._dirty.get(name, ()))
+        else:
+            candidates = live.keys()
+        return [record_id for record_id in candidates
+                if record_id in live and live[record_id].get(field) == value]
+
+    def get(self, name, record_id, default=None):
+        """Возвращает запись по ID"""
+        return self.collection(name).get(record_id, default)
+
+    def put(self, name, record_id, record):
+        """Добавляет или заменяет запись"""
+        record = self._coerce(name, record)
+        live = self.collection(name)
+        current = live.get(record_id)
+        self._bump(record, getattr(current, 'version', None))
+        # Хранилище держит свою копию: изменения записи вызывающим кодом его не трогают
+        live[record_id] = record.clone() if isinstance(record, Record) else record
+        self.mark_dirty(name, record_id)
+        return record
+
+    @staticmethod
+    def _bump(record, base_version):
+        """Новая версия записи: на единицу больше той, на которой основано изменение"""
+        if hasattr(record, 'version'):
+            record.version = (base_version or 0) + 1
+
+    def compare_and_set(self, name, record_id, expected_version, record):
+        """Заменяет запись, только если ее текущая версия равна expected_version"""
+        live = self.collection(name)
+        current = live.get(record_id)
+        if current is None or current.version != expected_version:
+            return False
+        record = self._coerce(name, record)
+        self._bump(record, expected_version)
+        live[record_id] = record.clone() if isinstance(record, Record) else record
+        self.mark_dirty(name, record_id)
+        return True
+
+    async def update(self, name, record_id, mutate, attempts=CAS_MAX_ATTEMPTS):
+        """Оптимистичное обновление: mutate(копия) меняет копию записи, запись заменяется,
+        только если за это время ее версия не изменилась (иначе повтор на свежих данных).
+
+        Возвращает новую запись или None, если записи нет или mutate вернул False.
+        """
+        for attempt in range(attempts):
+            current = self.get(name, record_id)
+            if current is None:
+                return None
+            expected_version = current.version
+            draft = self._coerce(name, _detach(current))
+            result = mutate(draft)
+            if inspect.isawaitable(result):
+                result = await result
+            if result is False:
+                return None
+            if self.compare_and_set(name, record_id, expected_version, draft):
+                return draft
+            logger.info(f"🔁 Конфликт версий {name}/{record_id}, повтор {attempt + 1}")
+        raise VersionConflict(name, [record_id])
+
+    def delete(self, name, record_id):
+        """Удаляет запись и возвращает ее (или None)"""
+        record = self.collection(name).pop(record_id, None)
+        if record is not None:
+            self.mark_dirty(name, record_id)
+        return record
+
+    def add_listener(self, listener):
+        """Подписывает функцию listener(name, record_id) на изменения записей"""
+        self._listeners.append(listener)
+
+    def mark_dirty(self, name, record_id):
+        """Отмечает запись как измененную и планирует запись на диск"""
+        self._dirty.setdefault(name, set()).add(record_id)
+        for listener in self._listeners:
+            listener(name, record_id)
+        self.schedule_flush()
+
+    def snapshot(self, name):
+        """Возвращает копию коллекции для кода, работающего со всем словарем (записи копируются при чтении)"""
+        return RecordMap(self.collection(name))
+
+    def _conflicts(self, live, records, changed):
+        """ID записей копии, измененных в хранилище после того, как их прочитали"""
+        conflicts = []
+        for record_id in records.assigned | records.removed | changed:
+            base_version = records.base_versions.get(record_id)
+            if base_version is None:
+                continue
+            current = live.get(record_id)
+            if base_version is _MISSING:
+                # Новая запись: конфликт, только если такую же успели создать параллельно
+                if current is not None and current is not dict.get(records, record_id):
+                    conflicts.append(record_id)
+            elif current is None:
+                # Удаленную параллельно запись не воскрешаем
+                if record_id in records.assigned:
+                    conflicts.append(record_id)
+            elif current.version != base_version:
+                conflicts.append(record_id)
+        return conflicts
+
+    def commit(self, name, records):
+        """Применяет изменения, сделанные в копии коллекции.
+
+        Возвращает False (ничего не применяя), если измененные записи успели
+        поменять параллельно - более медленный писатель не затирает чужие изменения.
+        """
+        live = self.collection(name)
+        if isinstance(records, RecordMap):
+            changed = records.changed()
+            conflicts = self._conflicts(live, records, changed)
+            if conflicts:
+                logger.warning(f"⚠️ Конфликт версий в {name}: {conflicts} изменены параллельно, сохранение отклонено")
+                return False
+            for record_id in records.removed:
+                records.read.pop(record_id, None)
+                records.base_versions.pop(record_id, None)
+                if record_id in live:
+                    del live[record_id]
+                    self.mark_dirty(name, record_id)
+            for record_id in records.assigned | changed:
+                record = self._coerce(name, dict.__getitem__(records, record_id))
+                base_version = records.base_versions.get(record_id)
+                self._bump(record, None if base_version is _MISSING else base_version)
+                # Вызывающий код продолжает работать со своей записью, хранилище - со своей копией
+                dict.__setitem__(records, record_id, record)
+                stored = record.clone() if isinstance(record, Record) else record
+                live[record_id] = stored
+                records._committed(record_id, stored)
+                self.mark_dirty(name, record_id)
+            records.assigned.clear()
+            records.removed.clear()
+        else:
+            # Обычный словарь целиком: записи, основанные на устаревшей версии, не принимаются
+            records = {record_id: self._coerce(name, record) for record_id, record in records.items()}
+            stale = [record_id for record_id, record in records.items()
+                     if record_id in live and getattr(record, 'version', None) != getattr(live[record_id], 'version', None)]
+            if stale:
+                logger.warning(f"⚠️ Конфликт версий в {name}: {stale} изменены параллельно, сохранение отклонено")
+                return False
+            for record_id in list(live.keys()):
+                if record_id not in records:
+                    del live[record_id]
+                    self.mark_dirty(name, record_id)
+            for record_id, record in records.items():
+                current = live.get(record_id)
+                if isinstance(record, Record) and isinstance(current, Record) and record.same_content(current):
+                    continue
+                self._bump(record, getattr(current, 'version', None))
+                live[record_id] = record.clone() if isinstance(record, Record) else record
+                self.mark_dirty(name, record_id)
+        return True
+
+    def schedule_flush(self):
+        """Планирует запись измененных коллекций после задержки"""
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий (запуск, shutdown) пишем сразу
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._run_scheduled_flush)
+
+    def _run_scheduled_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self._scheduled_flush())
+
+    async def _scheduled_flush(self):
+        if not await self.flush_async():
+            self.schedule_flush()
+
+    def _take_changes(self):
+        """Забирает изменения: {коллекция: {ID: копия записи или None, если удалена}}"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch = {}
+        for name, changed in self._dirty.items():
+            live = self._collections.get(name, {})
+            # Копии отвязывают запись от кода, который продолжает менять ее в цикле событий
+            batch[name] = {record_id: _detach(live[record_id]) if record_id in live else None
+                           for record_id in changed}
+        self._dirty = {}
+        return batch
+
+    def _write_changes(self, batch):
+        """Пишет изменения в backend (в потоке записи), возвращает коллекции с ошибкой"""
+        failed = []
+        for name, changes in batch.items():
+            if changes and not self.backend.write(name, changes):
+                failed.append(name)
+        return failed
+
+    def _restore_changes(self, batch, failed):
+        # Не удалось записать - оставляем записи грязными до следующей попытки
+        for name in failed:
+            self._dirty.setdefault(name, set()).update(batch[name].keys())
+
+    async def flush_async(self):
+        """Записывает изменения в потоке записи, не блокируя цикл событий"""
+        batch = self._take_changes()
+        if not batch:
+            return True
+        failed = await self._run_async(self._write_changes, batch)
+        self._restore_changes(batch, failed)
+        return not failed
+
+    def flush(self):
+        """Записывает изменения и ждет завершения (для запуска и остановки)"""
+        batch = self._take_changes()
+        if not batch:
+            return True
+        failed = self._run(self._write_changes, batch)
+        self._restore_changes(batch, failed)
+        return not failed
+
+    def close(self):
+        """Записывает несохраненные изменения и закрывает backend"""
+        self.flush()
+        self._run(self.backend.close)
+        self._writer.shutdown(wait=True)
+
+# Поля напоминания, которые в памяти хранятся как set
+REMINDER_SET_FIELDS = ['confirmed_by', 'postponed_by', 'delete_confirmed_by']
+
+def _normalize_reminder(reminder):
+    """Приводит загруженное напоминание к виду, с которым работает бот"""
+    # Преобразуем списки обратно в set
+    for field in REMINDER_SET_FIELDS:
+        if field in reminder and isinstance(reminder[field], list):
+            reminder[field] = set(reminder[field])
+
+    # Гарантируем наличие полей для срочного режима
+    if 'urgent_reminders' not in reminder:
+        reminder['urgent_reminders'] = False
+    if 'urgent_until' not in reminder:
+        reminder['urgent_until'] = None
+    if 'last_sent' not in reminder:
+        reminder['last_sent'] = None
+    if 'not_bought_count' not in reminder:
+        reminder['not_bought_count'] = 0
+    return reminder
+
+def _serialize_reminder(reminder):
+    """Возвращает копию напоминания, пригодную для JSON"""
+    data = reminder.copy()
+    # Преобразуем set в list
+    for field in REMINDER_SET_FIELDS:
+        if field in data and isinstance(data[field], set):
+            data[field] = list(data[field])
+    return data
+
+# Признак отсутствующего поля записи
+_MISSING = object()
+
+def _parse_epoch(value):
+    """Число, datetime или ISO-строка старых записей -> секунды UTC; время без пояса - в поясе по умолчанию"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, datetime):
+        if value.lstrip('-').isdigit():
+            return int(value)
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=DEFAULT_TZ)
+    return int(value.timestamp())
+
+def _format_epoch(value):
+    return value
+
+def now_ts():
+    """Текущее время в секундах UTC"""
+    return int(time.time())
+
+def local_time(ts, tz=None):
+    """Секунды UTC -> datetime в поясе tz (по умолчанию - общий) для ввода и отображения"""
+    return datetime.fromtimestamp(ts, tz or DEFAULT_TZ)
+
+def add_local_days(ts, days, tz=None):
+    """Сдвиг на days календарных дней с сохранением местного времени (переходы на летнее время учтены)"""
+    return int((local_time(ts, tz) + timedelta(days=days)).timestamp())
+
+def next_local_midnight(ts, tz=None):
+    """Ближайшая полночь после ts по местному времени"""
+    day = local_time(ts, tz).date() + timedelta(days=1)
+    return int(datetime.combine(day, datetime.min.time(), tzinfo=tz or DEFAULT_TZ).timestamp())
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    """Часовой пояс по имени IANA (Europe/Berlin); None - неизвестный"""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+def _parse_day(value):
+    """Строка 'дд.мм.ГГГГ' -> date"""
+    if value is None:
+        return None
+    return datetime.strptime(value, '%d.%m.%Y').date()
+
+def _format_day(value):
+    return value.strftime('%d.%m.%Y')
+
+class Record:
+    """Запись со слотами, доступная и как словарь
+
+    FIELDS хранятся как есть в одноименных слотах, поля из CONVERTED
+    разбираются один раз при записи и форматируются обратно только при чтении
+    по ключу и при сохранении. Неизвестные ключи попадают в extra.
+    Поле version (у напоминаний, рецептов и планов) увеличивает хранилище.
+    """
+
+    __slots__ = ('extra',)
+
+    FIELDS = ()
+    # ключ -> (слот, разбор, форматирование)
+    CONVERTED = {}
+    # Поля, которые сохраняются даже со значением None
+    KEEP_NULL = ()
+    DEFAULTS = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+        cls._CONVERTED_SLOTS = tuple(slot for slot, _, _ in cls.CONVERTED.values())
+
+    def __init__(self, data=None):
+        for field in self.FIELDS:
+            setattr(self, field, _MISSING)
+        for slot in self._CONVERTED_SLOTS:
+            setattr(self, slot, None)
+        self.extra = {}
+        if data:
+            for key, value in data.items():
+                self[key] = value
+        for key, value in self.DEFAULTS.items():
+            if key not in self:
+                self[key] = value
+
+    @classmethod
+    def coerce(cls, value):
+        """Возвращает запись этого типа (словарь оборачивается)"""
+        return value if isinstance(value, cls) else cls(value)
+
+    def _normalize(self, key, value):
+        return value
+
+    def __getitem__(self, key):
+        converted = self.CONVERTED.get(key)
+        if converted is not None:
+            value = getattr(self, converted[0])
+            if value is None:
+                return self.extra.get(key)
+            return converted[2](value)
+        if key in self._FIELD_SET:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        converted = self.CONVERTED.get(key)
+        if converted is not None:
+            try:
+                setattr(self, converted[0], converted[1](value))
+                self.extra.pop(key, None)
+            except (ValueError, TypeError):
+                # Неразборчивое значение храним как есть
+                logger.warning(f"⚠️ Некорректное значение {key}={value!r} в {type(self).__name__}")
+                setattr(self, converted[0], None)
+                self.extra[key] = value
+            return
+        if key in self._FIELD_SET:
+            setattr(self, key, self._normalize(key, value))
+            return
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        converted = self.CONVERTED.get(key)
+        if converted is not None:
+            setattr(self, converted[0], None)
+            self.extra.pop(key, None)
+        elif key in self._FIELD_SET:
+            setattr(self, key, _MISSING)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        converted = self.CONVERTED.get(key)
+        if converted is not None:
+            return getattr(self, converted[0]) is not None or key in self.extra
+        if key in self._FIELD_SET:
+            return getattr(self, key) is not _MISSING
+        return key in self.extra
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        keys = [field for field in self.FIELDS if getattr(self, field) is not _MISSING]
+        keys.extend(key for key in self.CONVERTED if key in self)
+        keys.extend(key for key in self.extra if key not in self.CONVERTED)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def stored_outdated(self, data):
+        """Сохраненный словарь в старом виде: разобранные поля записались бы иначе"""
+        for key, (slot, _, fmt) in self.CONVERTED.items():
+            value = getattr(self, slot)
+            if value is not None and key in data and data[key] != fmt(value):
+                return True
+        return False
+
+    def clone(self):
+        """Глубокая копия без повторного разбора полей"""
+        clone = object.__new__(type(self))
+        for slot in self.FIELDS + self._CONVERTED_SLOTS:
+            setattr(clone, slot, _clone_value(getattr(self, slot)))
+        clone.extra = _clone_value(self.extra)
+        return clone
+
+    def same_content(self, other):
+        """Совпадает ли содержимое записей (включая версию)"""
+        if type(other) is not type(self):
+            return False
+        for slot in self.FIELDS + self._CONVERTED_SLOTS:
+            if not _same_value(getattr(self, slot), getattr(other, slot)):
+                return False
+        return _same_value(self.extra, other.extra)
+
+    def copy(self):
+        """Поверхностная копия, как dict.copy()"""
+        clone = object.__new__(type(self))
+        for slot in self.FIELDS + self._CONVERTED_SLOTS:
+            setattr(clone, slot, getattr(self, slot))
+        clone.extra = dict(self.extra)
+        return clone
+
+    def __deepcopy__(self, memo):
+        return type(self)(self.to_dict())
+
+    def to_dict(self):
+        """Независимый словарь, пригодный для JSON"""
+        data = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not _MISSING:
+                data[field] = _plain(value)
+        for key, (slot, _, fmt) in self.CONVERTED.items():
+            value = getattr(self, slot)
+            if value is not None:
+                data[key] = fmt(value)
+            elif key in self.extra:
+                data[key] = self.extra[key]
+            elif key in self.KEEP_NULL:
+                data[key] = None
+        for key, value in self.extra.items():
+            if key not in self.CONVERTED:
+                data[key] = _plain(value)
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+def _clone_value(value):
+    """Независимая копия значения поля"""
+    if isinstance(value, Record):
+        return value.clone()
+    if isinstance(value, set):
+        return set(value)
+    if isinstance(value, (list, tuple)):
+        return [_clone_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _clone_value(item) for key, item in value.items()}
+    return value
+
+def _same_value(first, second):
+    if isinstance(first, Record):
+        return isinstance(second, Record) and first.same_content(second)
+    if isinstance(first, (list, tuple)):
+        return (isinstance(second, (list, tuple)) and len(first) == len(second)
+                and all(_same_value(a, b) for a, b in zip(first, second)))
+    if isinstance(first, dict):
+        return (isinstance(second, dict) and first.keys() == second.keys()
+                and all(_same_value(item, second[key]) for key, item in first.items()))
+    return first == second
+
+def _plain(value):
+    """Копия значения поля из простых типов JSON"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, (set, list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    return value
+
+class Ingredient(Record):
+    """Ингредиент рецепта или плана питания"""
+
+    FIELDS = ('id', 'name', 'quantity', 'assigned_to')
+    __slots__ = FIELDS
+
+class _WithIngredients(Record):
+    __slots__ = ()
+
+    def _normalize(self, key, value):
+        if key == 'ingredients' and value is not None:
+            return [Ingredient.coerce(ingredient) for ingredient in value]
+        return value
+
+class Recipe(_WithIngredients):
+    """Рецепт"""
+
+    FIELDS = ('id', 'name', 'ingredients', 'created_by', 'created_at', 'updated_at', 'version')
+    DEFAULTS = {'version': 0}
+    __slots__ = FIELDS
+
+class MealPlan(_WithIngredients):
+    """План питания; cook_ts - момент приготовления в секундах UTC"""
+
+    FIELDS = ('id', 'recipe_id', 'recipe_name', 'date_str', 'day', 'ingredients', 'created_by',
+              'created_at', 'updated_at', 'is_auto_created', 'with_notifications', 'notification_time',
+              'notify_at', 'version')
+    CONVERTED = {
+        'date': ('cook_ts', _parse_epoch, _format_epoch),
+    }
+    DEFAULTS = {'notify_at': None, 'version': 0}
+    __slots__ = FIELDS + ('cook_ts',)
+
+class User(Record):
+    """Пользователь бота"""
+
+    FIELDS = ('username', 'first_name', 'last_name', 'quiet_hours', 'timezone')
+    DEFAULTS = {'quiet_hours': None, 'timezone': None}
+    __slots__ = FIELDS
+
+class Reminder(Record):
+    """Напоминание; время хранится в секундах UTC: due_ts, last_sent_ts, urgent_until_ts,
+    original_due_ts, а meal_day - дата приготовления для ингредиентов"""
+
+    FIELDS = ('id', 'text', 'interval_days', 'users', 'created_by', 'created_at', 'type',
+              'confirmed_by', 'postponed_by', 'delete_confirmed_by', 'urgent_reminders',
+              'not_bought_count', 'frequency_multiplier', 'meal_plan_id', 'ingredient_id',
+              'recipe_name', 'original_interval', 'version')
+    CONVERTED = {
+        'datetime': ('due_ts', _parse_epoch, _format_epoch),
+        'last_sent': ('last_sent_ts', _parse_epoch, _format_epoch),
+        'urgent_until': ('urgent_until_ts', _parse_epoch, _format_epoch),
+        'original_datetime': ('original_due_ts', _parse_epoch, _format_epoch),
+        'meal_date': ('meal_day', _parse_day, _format_day),
+    }
+    KEEP_NULL = ('urgent_until', 'last_sent')
+    DEFAULTS = {'urgent_reminders': False, 'not_bought_count': 0, 'version': 0}
+    __slots__ = FIELDS + ('due_ts', 'last_sent_ts', 'urgent_until_ts', 'original_due_ts', 'meal_day')
+
+    def _normalize(self, key, value):
+        if key in REMINDER_SET_FIELDS and isinstance(value, list):
+            return set(value)
+        return value
+
+# Типы записей коллекций хранилища
+RECORD_TYPES = {
+    'users': User,
+    'reminders': Reminder,
+    'recipes': Recipe,
+    'meal_plans': MealPlan,
+}
+
+def _detach(record):
+    """Независимая копия записи для потока записи"""
+    if isinstance(record, Record):
+        return record.to_dict()
+    return copy.deepcopy(record)
+
+def _checksum(payload):
+    """Контрольная сумма содержимого файла: длина и sha256"""
+    return f"{len(payload)} {hashlib.sha256(payload).hexdigest()}"
+
+def _fsync_dir(file_path):
+    """Сбрасывает на диск запись каталога после переименования"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    except OSError:
+        return  # На некоторых платформах каталог нельзя открыть
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _write_bytes_atomic(file_path, payload):
+    """Записывает файл через временный файл, fsync и атомарное переименование"""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+def _write_json_atomic(file_path, data):
+    """Атомарно сохраняет JSON в компактном виде вместе с контрольной суммой"""
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    _write_bytes_atomic(file_path, payload)
+    _write_bytes_atomic(f"{file_path}.sha256", _checksum(payload).encode('ascii'))
+    _fsync_dir(file_path)
+
+class SnapshotChecksumError(Exception):
+    """Снимок не совпадает с контрольной суммой, и восстановить его не из чего"""
+
+def _remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+def _checked_payload(file_path):
+    """Содержимое файла, если оно совпадает с контрольной суммой (или суммы нет), иначе None"""
+    with open(file_path, 'rb') as f:
+        payload = f.read()
+
+    try:
+        with open(f"{file_path}.sha256", 'r', encoding='ascii') as f:
+            expected = f.read().strip()
+    except FileNotFoundError:
+        return payload
+
+    return payload if not expected or expected == _checksum(payload) else None
+
+def _replay_journal(records, journal_path):
+    """Применяет журнал изменений к загруженному снимку, возвращает число записей"""
+    try:
+        f = open(journal_path, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return 0
+
+    applied = 0
+    with f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Оборванная последняя строка после сбоя
+                logger.warning(f"⚠️ Пропущена поврежденная строка {line_number} в {journal_path}")
+                continue
+            if entry.get('op') == 'put':
+                records[entry['id']] = entry['data']
+            elif entry.get('op') == 'del':
+                records.pop(entry['id'], None)
+            applied += 1
+    return applied
+
+def _recover_snapshot(file_path):
+    """Восстанавливает снимок из предыдущего и свернутого в текущий журнала (.prev, .journal.prev)"""
+    backup_path = f"{file_path}.corrupt.{int(time.time())}"
+    try:
+        shutil.copy2(file_path, backup_path)
+    except Exception as e:
+        logger.error(f"❌ Не удалось сохранить поврежденный {file_path}: {e}")
+
+    try:
+        payload = _checked_payload(f"{file_path}.prev")
+    except FileNotFoundError:
+        payload = None
+    if payload is None:
+        raise SnapshotChecksumError(
+            f"{file_path}: контрольная сумма не совпадает, предыдущего снимка нет (копия: {backup_path})")
+
+    records = json.loads(payload.decode('utf-8'))
+    applied = _replay_journal(records, f"{file_path}.journal.prev")
+    _write_json_atomic(file_path, records)
+    logger.warning(f"♻️ {file_path} восстановлен из предыдущего снимка и {applied} записей журнала, "
+                   f"поврежденный файл сохранен как {backup_path}")
+    return records
+
+def _read_json_checked(file_path):
+    """Читает JSON и сверяет его с контрольной суммой, если она есть
+
+    Поврежденный снимок не загружается: данные восстанавливаются из
+    предыдущего снимка, а если его нет - поднимается SnapshotChecksumError.
+    """
+    payload = _checked_payload(file_path)
+    if payload is None:
+        logger.error(f"❌ Контрольная сумма {file_path} не совпадает")
+        return _recover_snapshot(file_path)
+
+    return json.loads(payload.decode('utf-8'))
+
+def _read_users_file():
     """Загрузка пользователей из файла"""
     file_path = 'users.json'
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json_checked(file_path)
     except FileNotFoundError:
         logger.info(f"Файл {file_path} не найден, создается новый")
         users = {}
-        save_users(users)  # Создаем пустой файл
+        _write_users_file(users)  # Создаем пустой файл
         return users
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
     except Exception as e:
         logger.error(f"Ошибка загрузки пользователей из {file_path}: {e}")
         return {}
 
-def save_users(users):
+def _write_users_file(users):
     """Сохранение пользователей в файл"""
     file_path = 'users.json'
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(file_path, users)
         logger.info(f"Пользователи успешно сохранены в {file_path}")
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения пользователей в {file_path}: {e}")
         return False
 
-def save_reminders(reminders):
-    """Сохранение напоминаний в файл с детальным логированием"""
+def _write_reminders_file(reminders):
+    """Сохранение напоминаний в файл"""
     file_path = 'reminders.json'
     try:
         data = {}
         urgent_count = 0
 
         for rid, reminder in reminders.items():
-            # Создаем глубокую копию
-            data[rid] = reminder.copy()
-
-            # Преобразуем set в list
-            for field in ['confirmed_by', 'postponed_by', 'delete_confirmed_by']:
-                if field in data[rid] and isinstance(data[rid][field], set):
-                    data[rid][field] = list(data[rid][field])
+            data[rid] = _serialize_reminder(reminder)
 
             # Считаем срочные напоминания
             if data[rid].get('urgent_reminders'):
                 urgent_count += 1
-                logger.info(f"💾 СРОЧНОЕ ДЛЯ СОХРАНЕНИЯ: {rid} - urgent_reminders={data[rid].get('urgent_reminders')}, urgent_until={data[rid].get('urgent_until')}")
 
-        logger.info(f"💾 Сохранение {len(data)} напоминаний, из них срочных: {urgent_count}")
-
-        # Сохраняем в файл
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-        # Проверяем запись
-        with open(file_path, 'r', encoding='utf-8') as f:
-            saved_data = json.load(f)
-            saved_urgent_count = sum(1 for rem in saved_data.values() if rem.get('urgent_reminders'))
-            logger.info(f"📖 ПРОВЕРКА: в файле {saved_urgent_count} срочных напоминаний")
-
-            # Детальная проверка конкретного напоминания
-            for rid in data.keys():
-                if rid in saved_data:
-                    saved_rem = saved_data[rid]
-                    if saved_rem.get('urgent_reminders'):
-                        logger.info(f"📖 ПРОВЕРКА {rid}: urgent_reminders={saved_rem.get('urgent_reminders')}, urgent_until={saved_rem.get('urgent_until')}")
-
-        logger.info(f"✅ Напоминания успешно сохранены в {file_path}")
+        _write_json_atomic(file_path, data)
+        logger.info(f"💾 Сохранено {len(data)} напоминаний в {file_path}, из них срочных: {urgent_count}")
         return True
 
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения напоминаний в {file_path}: {e}")
         return False
 
-def load_reminders():
+def _read_reminders_file():
     """Загрузка напоминаний из файла"""
     file_path = 'reminders.json'
-    max_retries = 3
-    retry_delay = 0.1
+    try:
+        data = _read_json_checked(file_path)
+        for reminder in data.values():
+            _normalize_reminder(reminder)
 
-    for attempt in range(max_retries):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                for reminder in data.values():
-                    # Преобразуем списки обратно в set
-                    for field in ['confirmed_by', 'postponed_by', 'delete_confirmed_by']:
-                        if field in reminder and isinstance(reminder[field], list):
-                            reminder[field] = set(reminder[field])
-
-                    # Гарантируем наличие полей для срочного режима
-                    if 'urgent_reminders' not in reminder:
-                        reminder['urgent_reminders'] = False
-                    if 'urgent_until' not in reminder:
-                        reminder['urgent_until'] = None
-                    if 'last_sent' not in reminder:
-                        reminder['last_sent'] = None
-                    if 'not_bought_count' not in reminder:
-                        reminder['not_bought_count'] = 0
-
-                logger.info(f"📖 Загружено {len(data)} напоминаний из {file_path}")
-                return data
+        logger.info(f"📖 Загружено {len(data)} напоминаний из {file_path}")
+        return data
 
-        except FileNotFoundError:
-            logger.info(f"Файл {file_path} не найден, создается новый")
-            reminders = {}
-            save_reminders(reminders)
-            return reminders
-
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON в {file_path}: {e}")
-            if attempt == max_retries - 1:
-                # Создаем резервную копию и новый файл
-                backup_path = f"{file_path}.backup.{int(datetime.now().timestamp())}"
-                try:
-                    import shutil
-                    shutil.copy2(file_path, backup_path)
-                    logger.info(f"Создана резервная копия: {backup_path}")
-                except Exception as backup_error:
-                    logger.error(f"Не удалось создать резервную копию: {backup_error}")
-
-                reminders = {}
-                save_reminders(reminders)
-                return reminders
-            else:
-                time.sleep(retry_delay)
+    except FileNotFoundError:
+        logger.info(f"Файл {file_path} не найден, создается новый")
+        reminders = {}
+        _write_reminders_file(reminders)
+        return reminders
+
+    except json.JSONDecodeError as e:
+        logger.error(f"Ошибка парсинга JSON в {file_path}: {e}")
+        # Создаем резервную копию и новый файл
+        backup_path = f"{file_path}.backup.{int(datetime.now().timestamp())}"
+        try:
+            shutil.copy2(file_path, backup_path)
+            logger.info(f"Создана резервная копия: {backup_path}")
+        except Exception as backup_error:
+            logger.error(f"Не удалось создать резервную копию: {backup_error}")
 
-        except Exception as e:
-            logger.error(f"Ошибка загрузки напоминаний из {file_path} (попытка {attempt + 1}): {e}")
-            if attempt == max_retries - 1:
-                return {}
-            else:
-                time.sleep(retry_delay)
+        reminders = {}
+        _write_reminders_file(reminders)
+        return reminders
 
-    return {}
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка загрузки напоминаний из {file_path}: {e}")
+        return {}
 
-def load_message_ids():
-    """Загружает сохраненные ID сообщений"""
+def _read_message_ids_file():
+    """Загружает сохраненные ID сообщений из файла"""
     try:
-        with open('message_ids.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json_checked('message_ids.json')
     except FileNotFoundError:
         logger.info("Файл message_ids.json не найден, создается новый")
-        save_message_ids_to_file({})
+        _write_message_ids_file({})
         return {}
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки message_ids: {e}")
         return {}
 
-def save_message_ids_to_file(message_ids):
+def _write_message_ids_file(message_ids):
     """Сохраняет ID сообщений в файл"""
     try:
-        with open('message_ids.json', 'w', encoding='utf-8') as f:
-            json.dump(message_ids, f, ensure_ascii=False, indent=2)
+        _write_json_atomic('message_ids.json', message_ids)
         logger.info(f"💾 Сохранено {len(message_ids)} message_ids в файл")
+        return True
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения message_ids в файл: {e}")
+        return False
 
-def save_message_id(reminder_id, user_id, message_id):
-    """Сохраняет ID сообщения для напоминания и пользователя"""
-    try:
-        message_ids = load_message_ids()
-
-        # Нормализуем user_id - убеждаемся, что это число
-        try:
-            user_id_int = int(user_id)
-        except (ValueError, TypeError):
-            logger.error(f"❌ Неверный формат user_id: {user_id}")
-            return
-
-        # Создаем ключ в правильном формате: reminderId_userId
-        key = f"{reminder_id}_{user_id_int}"
-
-        message_ids[key] = message_id
-        save_message_ids_to_file(message_ids)
-        logger.info(f"💾 Сохранен message_id {message_id} для reminder {reminder_id} и пользователя {user_id_int}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка сохранения message_id: {e}")
-
-async def delete_old_reminder_messages(application, reminder_id):
-    """Удаляет старые сообщения для указанного reminder_id"""
-    try:
-        message_ids = load_message_ids()
-        deleted_count = 0
-
-        # Ищем все сообщения для этого reminder_id
-        keys_to_delete = []
-        for key, message_id in message_ids.items():
-            try:
-                # Разделяем ключ на части по последнему подчеркиванию
-                # Формат: reminderId_userId
-                last_underscore_index = key.rfind('_')
-                if last_underscore_index == -1:
-                    continue
-
-                key_reminder_id = key[:last_underscore_index]
-                user_id_str = key[last_underscore_index + 1:]
-
-                if key_reminder_id == str(reminder_id):
-                    try:
-                        # Преобразуем user_id в число
-                        user_id = int(user_id_str)
-                        await application.bot.delete_message(
-                            chat_id=user_id,
-                            message_id=message_id
-                        )
-                        keys_to_delete.append(key)
-                        deleted_count += 1
-                        logger.info(f"🗑 Удалено старое сообщение {message_id} для пользователя {user_id}")
-                    except Exception as e:
-                        if "Chat not found" in str(e):
-                            logger.info(f"🗑 Чат не найден для пользователя {user_id}, удаляем запись из базы")
-                            keys_to_delete.append(key)
-                        elif "Message to delete not found" in str(e):
-                            logger.info(f"🗑 Сообщение уже удалено для пользователя {user_id}, удаляем запись из базы")
-                            keys_to_delete.append(key)
-                        else:
-                            logger.error(f"❌ Ошибка удаления сообщения {message_id} для пользователя {user_id}: {e}")
-                            # Если сообщение не найдено (уже удалено и т.д.), все равно удаляем из базы
-                            keys_to_delete.append(key)
-
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки ключа {key}: {e}")
-                continue
-
-        # Удаляем обработанные записи из базы
-        for key in keys_to_delete:
-            del message_ids[key]
-
-        if keys_to_delete:
-            save_message_ids_to_file(message_ids)
-
-        logger.info(f"✅ Удалено {deleted_count} старых сообщений для reminder {reminder_id}")
-        return deleted_count
-
-    except Exception as e:
-        logger.error(f"❌ Ошибка в delete_old_reminder_messages: {e}")
-        return 0
-
-def load_recipes():
+def _read_recipes_file():
     """Загрузка рецептов из файла"""
     file_path = 'recipes.json'
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json_checked(file_path)
     except FileNotFoundError:
         logger.info(f"Файл {file_path} не найден, создается новый")
         recipes = {}
-        save_recipes(recipes)  # Создаем пустой файл
+        _write_recipes_file(recipes)  # Создаем пустой файл
         return recipes
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
     except Exception as e:
         logger.error(f"Ошибка загрузки рецептов из {file_path}: {e}")
         return {}
 
-def save_recipes(recipes):
+def _write_recipes_file(recipes):
     """Сохранение рецептов в файл"""
     file_path = 'recipes.json'
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(recipes, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(file_path, recipes)
         logger.info(f"Рецепты успешно сохранены в {file_path}")
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения рецептов в {file_path}: {e}")
         return False
 
-def load_meal_plans():
+def _read_meal_plans_file():
     """Загрузка планов питания из файла"""
     file_path = 'meal_plans.json'
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json_checked(file_path)
     except FileNotFoundError:
         logger.info(f"Файл {file_path} не найден, создается новый")
         meal_plans = {}
-        save_meal_plans(meal_plans)  # Создаем пустой файл
+        _write_meal_plans_file(meal_plans)  # Создаем пустой файл
         return meal_plans
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
     except Exception as e:
         logger.error(f"Ошибка загрузки планов питания из {file_path}: {e}")
         return {}
 
-def save_meal_plans(meal_plans):
+def _write_meal_plans_file(meal_plans):
     """Сохранение планов питания в файл"""
     file_path = 'meal_plans.json'
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(meal_plans, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(file_path, meal_plans)
         logger.info(f"Планы питания успешно сохранены в {file_path}")
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения планов питания в {file_path}: {e}")
         return False
 
+def _read_scheduler_state_file():
+    """Загружает состояние планировщика (отметку последнего прохода проверки)"""
+    try:
+        return _read_json_checked('scheduler_state.json')
+    except FileNotFoundError:
+        logger.info("Файл scheduler_state.json не найден, создается новый")
+        _write_scheduler_state_file({})
+        return {}
+    except SnapshotChecksumError:
+        # Поврежденные данные не подменяем пустыми - отказываемся загружаться
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки состояния планировщика: {e}")
+        return {}
+
+def _write_scheduler_state_file(state):
+    """Сохраняет состояние планировщика в файл"""
+    try:
+        _write_json_atomic('scheduler_state.json', state)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения состояния планировщика: {e}")
+        return False
+
+# Хранилище состояния: 'json' (файлы) или 'sqlite'
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "bot_state.db")
+# Доставка напоминаний ингредиентов: grouped - один список покупок на (план, пользователь),
+# per_ingredient - отдельное сообщение на каждый ингредиент
+SHOPPING_LIST_MODE = os.getenv("SHOPPING_LIST_MODE", "grouped")
+
+# Размер журнала, после которого он сворачивается в снимок (байты)
+JOURNAL_COMPACT_BYTES = 512 * 1024
+
+class JsonBackend:
+    """Хранение коллекций в JSON: снимок в файле и журнал изменений рядом с ним
+
+    Методы вызываются только из потока записи StateRepository.
+    """
+
+    def __init__(self):
+        self._files = {
+            'users': ('users.json', _read_users_file),
+            'reminders': ('reminders.json', _read_reminders_file),
+            'message_ids': ('message_ids.json', _read_message_ids_file),
+            'recipes': ('recipes.json', _read_recipes_file),
+            'meal_plans': ('meal_plans.json', _read_meal_plans_file),
+            'scheduler_state': ('scheduler_state.json', _read_scheduler_state_file),
+        }
+        self.collections = tuple(self._files)
+        # Последняя записанная JSON-строка каждой записи
+        self._serialized = {}
+        self._journal_sizes = {}
+
+    def _journal_path(self, name):
+        return f"{self._files[name][0]}.journal"
+
+    def _encode(self, name, record):
+        if name == 'reminders':
+            record = _serialize_reminder(record)
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+    def load(self, name):
+        _, reader = self._files[name]
+        records = reader()
+
+        journal_path = self._journal_path(name)
+        applied = _replay_journal(records, journal_path)
+        if applied:
+            logger.info(f"📜 Применено {applied} записей журнала {journal_path}")
+        if name == 'reminders':
+            for reminder in records.values():
+                _normalize_reminder(reminder)
+
+        self._serialized[name] = {record_id: self._encode(name, record) for record_id, record in records.items()}
+        self._journal_sizes[name] = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        return records
+
+    def write(self, name, changes):
+        """Дописывает в журнал только действительно изменившиеся записи"""
+        serialized = self._serialized.setdefault(name, {})
+        timestamp = datetime.now(DEFAULT_TZ).isoformat()
+        lines = []
+        updates = {}
+
+        try:
+            for record_id, record in changes.items():
+                if record is not None:
+                    text = self._encode(name, record)
+                    if serialized.get(record_id) == text:
+                        continue
+                    updates[record_id] = text
+                    lines.append(f'{{"ts":"{timestamp}","op":"put","id":{json.dumps(record_id, ensure_ascii=False)},"data":{text}}}\n')
+                elif record_id in serialized:
+                    updates[record_id] = None
+                    lines.append(f'{{"ts":"{timestamp}","op":"del","id":{json.dumps(record_id, ensure_ascii=False)}}}\n')
+
+            if not lines:
+                return True
+
+            payload = ''.join(lines).encode('utf-8')
+            self._append(self._journal_path(name), payload)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи журнала {name}: {e}")
+            return False
+
+        for record_id, text in updates.items():
+            if text is None:
+                serialized.pop(record_id, None)
+            else:
+                serialized[record_id] = text
+        self._journal_sizes[name] = self._journal_sizes.get(name, 0) + len(payload)
+        logger.info(f"📜 {name}: в журнал записано изменений: {len(lines)}")
+
+        if self._journal_sizes[name] >= JOURNAL_COMPACT_BYTES:
+            self._compact(name)
+        return True
+
+    def _append(self, journal_path, payload):
+        with open(journal_path, 'ab') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self, name):
+        """Сворачивает журнал в снимок, собранный из уже сериализованных записей
+
+        Заменяемый снимок остается как .prev, а свернутый журнал - как
+        .journal.prev: вместе они дают новый снимок, если тот окажется поврежден.
+        """
+        file_path = self._files[name][0]
+        journal_path = self._journal_path(name)
+        try:
+            payload = ('{' + ','.join(
+                f"{json.dumps(record_id, ensure_ascii=False)}:{text}"
+                for record_id, text in self._serialized[name].items()
+            ) + '}').encode('utf-8')
+
+            # Старый свернутый журнал к заменяемому снимку уже не относится
+            _remove_file(f"{journal_path}.prev")
+            try:
+                previous = _checked_payload(file_path)
+            except FileNotFoundError:
+                previous = None
+            if previous is not None:
+                _write_bytes_atomic(f"{file_path}.prev", previous)
+                _write_bytes_atomic(f"{file_path}.prev.sha256", _checksum(previous).encode('ascii'))
+            else:
+                _remove_file(f"{file_path}.prev")
+                _remove_file(f"{file_path}.prev.sha256")
+
+            _write_bytes_atomic(file_path, payload)
+            _write_bytes_atomic(f"{file_path}.sha256", _checksum(payload).encode('ascii'))
+            _fsync_dir(file_path)
+            # Если сбой случится до переименования журнала, его повторное
+            # применение к новому снимку ничего не изменит
+            os.replace(journal_path, f"{journal_path}.prev")
+            _fsync_dir(journal_path)
+            self._journal_sizes[name] = 0
+            logger.info(f"🗜 Журнал {journal_path} свернут в снимок {file_path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"❌ Ошибка сворачивания журнала {journal_path}: {e}")
+
+    def has_index(self, name, field):
+        return False
+
+    def close(self):
+        pass
+
+class SQLiteBackend:
+    """Хранение коллекций в SQLite: одна строка на запись, индексы по полям поиска
+
+    Методы вызываются только из потока записи StateRepository.
+    """
+
+    # Поля записей, вынесенные в отдельные колонки для индексов (только те, по которым есть поиск)
+    INDEXED_FIELDS = {
+        'users': (),
+        'reminders': ('meal_plan_id', 'created_by'),
+        'message_ids': (),
+        'recipes': (),
+        'meal_plans': ('recipe_id', 'date_str'),
+        'scheduler_state': (),
+    }
+
+    INDEXES = {
+        'idx_reminders_meal_plan_id': ('reminders', 'meal_plan_id'),
+        'idx_reminders_created_by': ('reminders', 'created_by'),
+        'idx_meal_plans_recipe_date': ('meal_plans', 'recipe_id, date_str'),
+    }
+    # Индексы прежних версий, по которым поиска нет (колонки остаются, но не заполняются)
+    OBSOLETE_INDEXES = ('idx_reminders_datetime', 'idx_reminders_type')
+
+    def __init__(self, db_path=SQLITE_DB_PATH):
+        self.db_path = db_path
+        self.collections = tuple(self.INDEXED_FIELDS)
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            # База открывается при первом обращении
+            self._open()
+        return self._conn
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        for name, fields in self.INDEXED_FIELDS.items():
+            columns = ''.join(f", {field} TEXT" for field in fields)
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, data TEXT NOT NULL{columns})")
+        for index_name, (table, columns) in self.INDEXES.items():
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+        for index_name in self.OBSOLETE_INDEXES:
+            self._conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+        self._conn.commit()
+        self._migrate_from_json()
+
+    def _migrate_from_json(self):
+        """Одноразовый перенос данных из JSON-файлов в базу"""
+        if self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+
+        json_backend = JsonBackend()
+        total = 0
+        for name in self.collections:
+            file_path = json_backend._files[name][0]
+            if not os.path.exists(file_path):
+                continue
+            records = json_backend.load(name)
+            rows = [self._encode(name, record_id, record) for record_id, record in records.items()]
+            self._upsert(name, rows)
+            total += len(rows)
+            logger.info(f"📦 Перенесено {len(rows)} записей из {file_path}")
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+            (datetime.now(DEFAULT_TZ).isoformat(),)
+        )
+        self._conn.commit()
+        logger.info(f"✅ Миграция JSON -> {self.db_path} завершена, всего записей: {total}")
+
+    def _encode(self, name, record_id, record):
+        """Превращает запись в строку таблицы"""
+        if name == 'reminders':
+            record = _serialize_reminder(record)
+        values = [record_id, json.dumps(record, ensure_ascii=False, separators=(',', ':'))]
+        for field in self.INDEXED_FIELDS[name]:
+            value = record.get(field)
+            values.append(None if value is None else str(value))
+        return values
+
+    def _upsert(self, name, rows):
+        if not rows:
+            return
+        columns = ('id', 'data') + self.INDEXED_FIELDS[name]
+        placeholders = ', '.join('?' for _ in columns)
+        self._conn.executemany(
+            f"INSERT OR REPLACE INTO {name} ({', '.join(columns)}) VALUES ({placeholders})",
+            rows
+        )
+
+    def _apply(self, name, rows, deleted):
+        with self._conn:
+            self._upsert(name, rows)
+            if deleted:
+                self._conn.executemany(f"DELETE FROM {name} WHERE id = ?", deleted)
+
+    def load(self, name):
+        records = {}
+        for record_id, data in self._connection().execute(f"SELECT id, data FROM {name}").fetchall():
+            record = json.loads(data)
+            if name == 'reminders':
+                _normalize_reminder(record)
+            records[record_id] = record
+        logger.info(f"📖 Загружено {len(records)} записей {name} из {self.db_path}")
+        return records
+
+    def write(self, name, changes):
+        """Записывает только измененные строки"""
+        try:
+            rows, deleted = [], []
+            for record_id, record in changes.items():
+                if record is not None:
+                    rows.append(self._encode(name, record_id, record))
+                else:
+                    deleted.append((record_id,))
+            self._connection()
+            self._apply(name, rows, deleted)
+            logger.info(f"💾 {name}: обновлено {len(rows)}, удалено {len(deleted)} записей в {self.db_path}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи {name} в {self.db_path}: {e}")
+            return False
+
+    def has_index(self, name, field):
+        return field in self.INDEXED_FIELDS.get(name, ())
+
+    def find_ids(self, name, field, value):
+        rows = self._connection().execute(
+            f"SELECT id FROM {name} WHERE {field} = ?",
+            (None if value is None else str(value),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+def create_storage_backend():
+    """Создает backend хранилища по переменной окружения STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        logger.info(f"🗄 Хранилище: SQLite ({SQLITE_DB_PATH})")
+        return SQLiteBackend(SQLITE_DB_PATH)
+    return JsonBackend()
+
+# Единое хранилище состояния процесса
+repository = StateRepository(create_storage_backend(), RECORD_TYPES)
+
+def user_timezone(user_id):
+    """Часовой пояс пользователя: свой (/timezone) или общий по умолчанию"""
+    user = repository.get('users', str(user_id))
+    timezone = user.get('timezone') if user is not None else None
+    return (get_timezone(timezone) if timezone else None) or DEFAULT_TZ
+
+def user_now(user_id):
+    """Текущее время в поясе пользователя - для разбора введенных дат и времени"""
+    return datetime.now(user_timezone(user_id))
+
+def reminder_timezone(reminder):
+    """Пояс календарной логики напоминания (повторы, "раз в день"): первого получателя или автора"""
+    owner = next(iter(reminder.get('users') or ()), None) or reminder.get('created_by')
+    return user_timezone(owner) if owner else DEFAULT_TZ
+
+def load_users():
+    """Загрузка пользователей из хранилища"""
+    return repository.snapshot('users')
+
+async def save_users(users):
+    """Сохранение пользователей: изменения применяются в памяти, на диск - отложенной записью"""
+    if not repository.commit('users', users):
+        return False
+    return True
+
+def load_reminders():
+    """Загрузка напоминаний из хранилища"""
+    return repository.snapshot('reminders')
+
+async def save_reminders(reminders):
+    """Сохранение напоминаний: изменения применяются в памяти, на диск - отложенной записью"""
+    if not repository.commit('reminders', reminders):
+        return False
+    return True
+
+# Telegram не дает боту удалять сообщения старше 48 часов
+MESSAGE_DELETE_WINDOW_HOURS = 48
+
+def digest_item_record(message_text, reply_markup, position):
+    """Пункт сводки для хранения рядом с сообщением: текст, кнопки (текст, callback_data) и место в сводке"""
+    buttons = [[[button.text, button.callback_data] for button in row]
+               for row in (reply_markup.inline_keyboard if reply_markup else ())]
+    return {'text': message_text, 'buttons': buttons, 'position': position}
+
+def digest_item_markup(buttons):
+    """Кнопки сохраненного пункта сводки"""
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data) for text, data in row]
+                                 for row in buttons])
+
+class MessageStore:
+    """Учет отправленных сообщений: reminder_id -> {user_id: {message_id, sent_at[, digest]}}
+
+    У пунктов сводки в digest хранятся их текст и кнопки: сводку можно обновить и после перезапуска.
+
+    Сообщения, которые уже нельзя удалить, забываются по индексу сроков (куча).
+    """
+
+    def __init__(self, repository, name='message_ids', delete_window_hours=MESSAGE_DELETE_WINDOW_HOURS):
+        self.repository = repository
+        self.name = name
+        # Окно удаления в секундах; sent_at хранится в секундах UTC
+        self.delete_window = delete_window_hours * 3600
+        self._migrated = False
+        # (момент истечения, reminder_id, user_id, message_id); устаревшие элементы пропускаются
+        self._expiry = []
+
+    def _records(self):
+        records = self.repository.collection(self.name)
+        if not self._migrated:
+            self._migrated = True
+            self._migrate(records)
+            for reminder_id, entries in records.items():
+                for user_id, entry in entries.items():
+                    self._push_expiry(reminder_id, user_id, entry)
+        return records
+
+    @staticmethod
+    def _sent_at(entry):
+        try:
+            return _parse_epoch(entry['sent_at']) if entry.get('sent_at') else None
+        except (ValueError, TypeError):
+            return None
+
+    def _push_expiry(self, reminder_id, user_id, entry):
+        sent_at = self._sent_at(entry)
+        if sent_at is not None:
+            heapq.heappush(self._expiry, (sent_at + self.delete_window, reminder_id, user_id, entry['message_id']))
+
+    def is_deletable(self, entry, now=None):
+        """Можно ли еще удалить сообщение (редактировать можно всегда); без sent_at - пробуем"""
+        sent_at = self._sent_at(entry)
+        if sent_at is None:
+            return True
+        return (now or now_ts()) - sent_at < self.delete_window
+
+    def prune_expired(self, now=None):
+        """Забывает сообщения старше окна удаления без запросов к Telegram, возвращает их"""
+        records = self._records()
+        now = now or now_ts()
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            _, reminder_id, user_id, message_id = heapq.heappop(self._expiry)
+            entry = records.get(reminder_id, {}).get(user_id)
+            if entry is not None and entry['message_id'] == message_id:
+                expired.append((reminder_id, user_id, message_id))
+        if expired:
+            self.forget(expired)
+            logger.info(f"⌛ Забыто сообщений старше {MESSAGE_DELETE_WINDOW_HOURS} ч.: {len(expired)}")
+        return expired
+
+    def _migrate(self, records):
+        """Приводит ключи к int и переносит старый плоский формат reminderId_userId
+
+        Записям без sent_at ставится время миграции, чтобы и они забывались по окну удаления;
+        sent_at в старом виде (ISO-строка) переводится в секунды UTC.
+        """
+        migrated_at = now_ts()
+        for key in list(records.keys()):
+            value = records[key]
+            if isinstance(value, dict):
+                entries = {}
+                outdated = False
+                for user_id, entry in value.items():
+                    try:
+                        sent_at = self._sent_at(entry) or migrated_at
+                        outdated = outdated or entry.get('sent_at') != sent_at
+                        entries[int(user_id)] = {
+                            'message_id': int(entry['message_id']),
+                            'sent_at': sent_at,
+                        }
+                        if entry.get('digest'):
+                            entries[int(user_id)]['digest'] = entry['digest']
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        logger.warning(f"⚠️ Пропущена некорректная запись сообщения {key}/{user_id}")
+                records[key] = entries
+                if outdated:
+                    self.repository.mark_dirty(self.name, key)
+                continue
+
+            # Старый формат: "reminderId_userId" -> message_id
+            reminder_id, _, user_id_str = key.rpartition('_')
+            self.repository.delete(self.name, key)
+            try:
+                user_id = int(user_id_str)
+                message_id = int(value)
+            except (ValueError, TypeError):
+                logger.warning(f"⚠️ Удален некорректный ключ message_ids: {key}")
+                continue
+            if not reminder_id:
+                logger.warning(f"⚠️ Удален некорректный ключ message_ids: {key}")
+                continue
+            entries = records.get(reminder_id)
+            if entries is None:
+                entries = {}
+                self.repository.put(self.name, reminder_id, entries)
+            entries[user_id] = {'message_id': message_id, 'sent_at': migrated_at}
+            self.repository.mark_dirty(self.name, reminder_id)
+
+    def track(self, reminder_id, user_id, message_id, sent_at=None, digest_item=None):
+        """Запоминает сообщение, отправленное пользователю по напоминанию (digest_item - его пункт в сводке)"""
+        reminder_id = str(reminder_id)
+        records = self._records()
+        entries = records.get(reminder_id)
+        if entries is None:
+            entries = {}
+            records[reminder_id] = entries
+        entry = {
+            'message_id': int(message_id),
+            'sent_at': sent_at or now_ts(),
+        }
+        if digest_item is not None:
+            entry['digest'] = digest_item
+        entries[int(user_id)] = entry
+        self.repository.mark_dirty(self.name, reminder_id)
+        self._push_expiry(reminder_id, int(user_id), entry)
+
+    def digest_items(self, user_id, message_id):
+        """Пункты сводки (user_id, message_id) в ее порядке: {reminder_id: (текст, кнопки)}; пусто - не сводка"""
+        user_id = int(user_id)
+        found = []
+        for reminder_id, entries in self._records().items():
+            entry = entries.get(user_id)
+            if entry is not None and entry['message_id'] == message_id and entry.get('digest'):
+                found.append((entry['digest']['position'], reminder_id, entry['digest']))
+        found.sort(key=lambda item: (item[0], item[1]))
+        return {reminder_id: (item['text'], digest_item_markup(item['buttons'])) for _, reminder_id, item in found}
+
+    def set_digest_item(self, reminder_id, user_id, message_text=None, reply_markup=None):
+        """Меняет текст и кнопки пункта сводки; без текста - пункт больше не часть сводки"""
+        reminder_id = str(reminder_id)
+        entry = self._records().get(reminder_id, {}).get(int(user_id))
+        if entry is None or not entry.get('digest'):
+            return
+        if message_text is None:
+            del entry['digest']
+        else:
+            entry['digest'] = digest_item_record(message_text, reply_markup, entry['digest']['position'])
+        self.repository.mark_dirty(self.name, reminder_id)
+
+    def is_shared(self, reminder_id, user_id, message_id):
+        """Сообщение относится и к другим напоминаниям (сводка) - целиком его менять нельзя"""
+        return (int(user_id), message_id) in self.shared_messages({str(reminder_id)})
+
+    def get(self, reminder_id):
+        """Возвращает сообщения напоминания: {user_id: {message_id, sent_at}}"""
+        return dict(self._records().get(str(reminder_id), {}))
+
+    def message_id(self, reminder_id, user_id):
+        entry = self._records().get(str(reminder_id), {}).get(int(user_id))
+        return entry['message_id'] if entry else None
+
+    def discard(self, reminder_id, user_id):
+        """Забывает сообщение одного пользователя"""
+        reminder_id = str(reminder_id)
+        entries = self._records().get(reminder_id)
+        if not entries:
+            return None
+        entry = entries.pop(int(user_id), None)
+        if not entries:
+            self.repository.delete(self.name, reminder_id)
+        elif entry is not None:
+            self.repository.mark_dirty(self.name, reminder_id)
+        return entry
+
+    def forget(self, messages):
+        """Забывает сообщения [(reminder_id, user_id, message_id)] одним обновлением
+
+        Запись, которую за это время заменило новое сообщение, не трогается.
+        """
+        records = self._records()
+        changed = set()
+        for reminder_id, user_id, message_id in messages:
+            reminder_id = str(reminder_id)
+            entries = records.get(reminder_id)
+            entry = entries.get(int(user_id)) if entries else None
+            if entry is not None and entry['message_id'] == message_id:
+                del entries[int(user_id)]
+                changed.add(reminder_id)
+        for reminder_id in changed:
+            if records[reminder_id]:
+                self.repository.mark_dirty(self.name, reminder_id)
+            else:
+                self.repository.delete(self.name, reminder_id)
+        return len(changed)
+
+    def reminder_ids(self):
+        return list(self._records().keys())
+
+    def shared_messages(self, reminder_ids):
+        """Сообщения (user_id, message_id) указанных напоминаний, на которые ссылаются и другие (сводки)"""
+        records = self._records()
+        wanted = {(user_id, entry['message_id'])
+                  for reminder_id in reminder_ids
+                  for user_id, entry in records.get(str(reminder_id), {}).items()}
+        if not wanted:
+            return set()
+        return {(user_id, entry['message_id'])
+                for reminder_id, entries in records.items() if reminder_id not in reminder_ids
+                for user_id, entry in entries.items() if (user_id, entry['message_id']) in wanted}
+
+    def count(self):
+        return sum(len(entries) for entries in self._records().values())
+
+message_store = MessageStore(repository)
+
+# Ограничения Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+SEND_RATE_PER_SECOND = 30
+SEND_CHAT_INTERVAL = 1.0
+SEND_WORKERS = 8
+SEND_MAX_ATTEMPTS = 5
+SEND_BACKOFF_BASE = 1.0
+# Сколько ждать отправки оставшейся очереди при остановке бота (секунды)
+SEND_DRAIN_TIMEOUT = 10
+# Окно склейки уведомлений одного чата в сводку (секунды); 0 - отправлять сразу по одному
+NOTIFICATION_COALESCE_WINDOW = float(os.getenv("NOTIFICATION_COALESCE_WINDOW", "1.0"))
+# Предел длины текста сводки (лимит Telegram - 4096 символов)
+DIGEST_MAX_LENGTH = 4000
+
+class DeliveryQueue:
+    """Очередь запросов к Telegram: несколько воркеров, общий и початовый лимиты, повтор при ошибках сети
+
+    У каждого чата своя очередь; воркер берет только чат, чей интервал уже прошел,
+    поэтому занятый чат не держит воркеров и не задерживает остальные чаты.
+    """
+
+    def __init__(self, workers=SEND_WORKERS, rate=SEND_RATE_PER_SECOND, chat_interval=SEND_CHAT_INTERVAL):
+        self.workers = workers
+        self.rate = rate
+        self.chat_interval = chat_interval
+        # Чаты, готовые к следующему запросу
+        self._ready = None
+        self._tasks = []
+        self._tokens = rate
+        self._tokens_updated = None
+        self._paused_until = 0.0
+        # chat_id -> очередь запросов чата; чат здесь, пока у него есть запросы
+        self._chats = {}
+        self._chat_ready_at = {}
+        self._idle = None
+
+    def enqueue(self, chat_id, request, on_done=None, on_error=None, description="", **kwargs):
+        """Ставит запрос request(chat_id=..., **kwargs) в очередь
+
+        on_done(result) вызывается после успеха, on_error(error) - если запрос не удался.
+        """
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._idle = asyncio.Event()
+        if len(self._tasks) < self.workers:
+            loop = asyncio.get_running_loop()
+            self._tasks.extend(loop.create_task(self._worker()) for _ in range(self.workers - len(self._tasks)))
+        # [запрос, аргументы, on_done, on_error, описание, номер попытки]
+        item = [request, kwargs, on_done, on_error, description, 1]
+        self._idle.clear()
+        requests = self._chats.get(chat_id)
+        if requests is not None:
+            # Чат уже ждет своей очереди или обслуживается - запрос уйдет следом
+            requests.append(item)
+            return
+        self._chats[chat_id] = deque([item])
+        self._schedule(chat_id)
+
+    async def submit(self, chat_id, request, description="", **kwargs):
+        """Ставит запрос в очередь и ждет его результата (ошибка запроса поднимается)"""
+        future = asyncio.get_running_loop().create_future()
+
+        def done(result):
+            if not future.done():
+                future.set_result(result)
+
+        def failed(error):
+            if not future.done():
+                future.set_exception(error)
+
+        self.enqueue(chat_id, request, on_done=done, on_error=failed, description=description, **kwargs)
+        return await future
+
+    def pending(self):
+        return sum(len(requests) for requests in self._chats.values())
+
+    def _schedule(self, chat_id):
+        """Отдает чат воркерам, когда пройдет его интервал (до этого воркер не занят)"""
+        loop = asyncio.get_running_loop()
+        wait = self._chat_ready_at.get(chat_id, 0.0) - loop.time()
+        if wait > 0:
+            loop.call_later(wait, self._release, chat_id)
+        else:
+            self._release(chat_id)
+
+    def _release(self, chat_id):
+        if self._ready is not None and chat_id in self._chats:
+            self._ready.put_nowait(chat_id)
+
+    async def _acquire_rate(self):
+        """Общий лимит: ведро токенов на rate запросов в секунду"""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self._tokens_updated is not None:
+                self._tokens = min(self.rate, self._tokens + (now - self._tokens_updated) * self.rate)
+            self._tokens_updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _deliver(self, chat_id, item):
+        """Одна попытка запроса; возвращает (готово, результат) - не готово, если нужен повтор"""
+        loop = asyncio.get_running_loop()
+        request, kwargs, _, _, description, attempt = item
+        # Интервал чата уже выдержан планировщиком - остается общий лимит
+        await self._acquire_rate()
+        self._chat_ready_at[chat_id] = loop.time() + self.chat_interval
+        try:
+            return True, await request(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            # Telegram просит подождать - приостанавливаем всю очередь
+            self._paused_until = max(self._paused_until, loop.time() + float(e.retry_after))
+            logger.warning(f"⏳ Лимит Telegram: пауза {e.retry_after} с ({description})")
+            if attempt == SEND_MAX_ATTEMPTS:
+                raise RuntimeError(f"не удалось выполнить за {SEND_MAX_ATTEMPTS} попыток")
+        except (BadRequest, Forbidden):
+            raise
+        except NetworkError as e:
+            if attempt == SEND_MAX_ATTEMPTS:
+                raise
+            delay = SEND_BACKOFF_BASE * 2 ** (attempt - 1)
+            logger.warning(f"⚠️ Ошибка сети ({description}), попытка {attempt}, повтор через {delay:.1f} с: {e}")
+            # Повтор - не раньше задержки; чат до этого воркеров не занимает
+            self._chat_ready_at[chat_id] = max(self._chat_ready_at[chat_id], loop.time() + delay)
+        item[5] = attempt + 1
+        return False, None
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            requests = self._chats[chat_id]
+            item = requests[0]
+            try:
+                try:
+                    done, result = await self._deliver(chat_id, item)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    requests.popleft()
+                    on_error = item[3]
+                    if on_error is None:
+                        raise
+                    on_error(e)
+                else:
+                    if done:
+                        requests.popleft()
+                        if item[2] is not None:
+                            item[2](result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка запроса к Telegram для чата {chat_id} ({item[4]}): {e}")
+            finally:
+                if self._chats.get(chat_id) is requests:
+                    if requests:
+                        self._schedule(chat_id)
+                    else:
+                        del self._chats[chat_id]
+                        if not self._chats:
+                            self._idle.set()
+
+    async def stop(self, timeout=SEND_DRAIN_TIMEOUT):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров"""
+        if self._ready is not None and self._tasks and self._chats:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ При остановке не отправлено запросов: {self.pending()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = None
+        self._chats = {}
+
+delivery_queue = DeliveryQueue()
+
+class NotificationCoalescer:
+    """Склейка уведомлений: все, что пришло в один чат за окно, уходит одной сводкой
+
+    В сводке у каждого пункта свои кнопки с исходным callback_data, а сообщение
+    сводки запоминается в message_ids под ключом каждого пункта вместе с текстом
+    и кнопками пункта - по ним сводка пересобирается при обновлении пунктов.
+    """
+
+    def __init__(self, window=NOTIFICATION_COALESCE_WINDOW):
+        self.window = window
+        # chat_id -> (application, {ключ: (текст, кнопки, kind)})
+        self._pending = {}
+
+    def add(self, application, chat_id, key, message_text, reply_markup, kind="Уведомление"):
+        """Добавляет уведомление в окно чата; повтор того же ключа заменяет прежний текст"""
+        if self.window <= 0:
+            self._send(application, chat_id, {key: (message_text, reply_markup, kind)})
+            return
+        if chat_id not in self._pending:
+            self._pending[chat_id] = (application, {})
+            asyncio.get_running_loop().call_later(self.window, self.flush, chat_id)
+        self._pending[chat_id][1][str(key)] = (message_text, reply_markup, kind)
+
+    def flush(self, chat_id):
+        """Отправляет накопленное для чата: одно уведомление - как есть, несколько - сводками"""
+        pending = self._pending.pop(chat_id, None)
+        if pending is not None:
+            self._send(pending[0], chat_id, pending[1])
+
+    def flush_all(self):
+        for chat_id in list(self._pending):
+            self.flush(chat_id)
+
+    def _send(self, application, chat_id, items):
+        # Делим на сводки по лимиту длины сообщения
+        chunk, length = {}, 0
+        for key, item in items.items():
+            if chunk and length + len(item[0]) > DIGEST_MAX_LENGTH:
+                self._send_chunk(application, chat_id, chunk)
+                chunk, length = {}, 0
+            chunk[key] = item
+            length += len(item[0]) + 8
+        if chunk:
+            self._send_chunk(application, chat_id, chunk)
+
+    def _send_chunk(self, application, chat_id, items):
+        if len(items) == 1:
+            (key, (message_text, reply_markup, kind)), = items.items()
+            self._deliver(application, chat_id, {key: (message_text, reply_markup)}, message_text, reply_markup, kind)
+            return
+        digest = {key: (message_text, reply_markup) for key, (message_text, reply_markup, _) in items.items()}
+        message_text, reply_markup = render_digest(digest)
+        self._deliver(application, chat_id, digest, message_text, reply_markup, "Сводка напоминаний")
+
+    def _deliver(self, application, chat_id, items, message_text, reply_markup, kind):
+        def on_sent(message):
+            # Запоминаем ID нового сообщения под ключом каждого пункта (у сводки - и сам пункт)
+            for position, (key, (item_text, item_markup)) in enumerate(items.items()):
+                digest_item = digest_item_record(item_text, item_markup, position) if len(items) > 1 else None
+                message_store.track(key, chat_id, message.message_id, digest_item=digest_item)
+            logger.info(f"✅ {kind} отправлено пользователю {chat_id} с message_id {message.message_id}")
+
+        delivery_queue.enqueue(
+            chat_id,
+            application.bot.send_message,
+            on_done=on_sent,
+            description=f"напоминания {', '.join(items)}",
+            text=message_text,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+
+    def replace(self, chat_id, message_id, key, message_text, reply_markup):
+        """Обновляет пункт отправленной сводки; возвращает новый текст и кнопки сводки или None"""
+        items = message_store.digest_items(chat_id, message_id)
+        if str(key) not in items:
+            return None
+        message_store.set_digest_item(key, chat_id, message_text, reply_markup)
+        items[str(key)] = (message_text, reply_markup)
+        return render_digest(items)
+
+    def detach(self, chat_id, message_id, key):
+        """Убирает пункт из сводки; возвращает текст и кнопки оставшихся пунктов или None"""
+        items = message_store.digest_items(chat_id, message_id)
+        if str(key) not in items:
+            return None
+        message_store.set_digest_item(key, chat_id)
+        del items[str(key)]
+        if len(items) == 1:
+            # Остался один пункт - сообщение снова принадлежит одному напоминанию
+            (last_key, item), = items.items()
+            message_store.set_digest_item(last_key, chat_id)
+            return item
+        return render_digest(items)
+
+def render_digest(items):
+    """Текст сводки и кнопки: пункты пронумерованы, у каждого свой ряд кнопок"""
+    texts = []
+    keyboard = []
+    for number, (message_text, reply_markup) in enumerate(items.values(), 1):
+        texts.append(f"*{number}.* {message_text}")
+        for row in reply_markup.inline_keyboard if reply_markup else ():
+            keyboard.append([InlineKeyboardButton(f"{number}. {button.text}", callback_data=button.callback_data)
+                             for button in row])
+    message_text = f"🔔 *Сводка напоминаний ({len(items)})*\n\n" + "\n\n➖➖➖\n\n".join(texts)
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+notification_coalescer = NotificationCoalescer()
+
+def enqueue_notification(application, reminder_id, user_id, message_text, reply_markup, kind="Уведомление"):
+    """Ставит уведомление в очередь отправки (через окно склейки); ID сообщения запоминается после доставки"""
+    notification_coalescer.add(application, user_id, reminder_id, message_text, reply_markup, kind)
+
+async def edit_notification(query, reminder_id, message_text, reply_markup):
+    """Обновляет уведомление по нажатию его кнопки; в сводке меняется только этот пункт"""
+    message = query.message
+    digest = notification_coalescer.replace(message.chat_id, message.message_id, reminder_id, message_text, reply_markup)
+    if digest is not None:
+        message_text, reply_markup = digest
+    elif message_store.is_shared(reminder_id, message.chat_id, message.message_id):
+        # Сводка без сохраненных пунктов: общее сообщение не переписываем - пункт уходит отдельным сообщением
+        reply = await message.reply_text(message_text, parse_mode='Markdown', reply_markup=reply_markup)
+        message_store.track(reminder_id, message.chat_id, reply.message_id)
+        return
+    await query.edit_message_text(message_text, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def reply_to_notification(query, reminder_id, text):
+    """Ответ на кнопку уведомления вместо него самого; из сводки убирается только этот пункт
+
+    Возвращает сообщение с ответом (для отложенного удаления).
+    """
+    message = query.message
+    rest = notification_coalescer.detach(message.chat_id, message.message_id, reminder_id)
+    if rest is None:
+        if message_store.is_shared(reminder_id, message.chat_id, message.message_id):
+            # Сводка без сохраненных пунктов: другие пункты не трогаем, отвечаем отдельным сообщением
+            return await message.reply_text(text)
+        await query.edit_message_text(text)
+        return message
+    message_text, reply_markup = rest
+    await query.edit_message_text(message_text, parse_mode='Markdown', reply_markup=reply_markup)
+    return await message.reply_text(text)
+
+def enqueue_notification_update(application, reminder_id, user_id, message_text, reply_markup, kind="Уведомление"):
+    """Обновляет отправленное уведомление на месте; если это невозможно - удаляет его и отправляет новое"""
+    entry = message_store.get(reminder_id).get(user_id)
+    if entry is None:
+        enqueue_notification(application, reminder_id, user_id, message_text, reply_markup, kind)
+        return
+
+    message_id = entry['message_id']
+    # Уведомление отправлено в сводке - обновляется только его пункт
+    digest = notification_coalescer.replace(user_id, message_id, reminder_id, message_text, reply_markup)
+    edit_text, edit_markup = digest if digest is not None else (message_text, reply_markup)
+
+    def send_fresh():
+        message_store.forget([(str(reminder_id), user_id, message_id)])
+        enqueue_notification(application, reminder_id, user_id, message_text, reply_markup, kind)
+
+    if digest is None and message_store.is_shared(reminder_id, user_id, message_id):
+        # Сводка без сохраненных пунктов: общее сообщение целиком не переписываем
+        send_fresh()
+        return
+
+    # Ограничение в 48 часов касается только удаления: старое сообщение по-прежнему редактируется
+    def on_edited(_):
+        logger.info(f"✏️ {kind} обновлено у пользователя {user_id} (message_id {message_id})")
+
+    def on_failed(error):
+        if "message is not modified" in str(error):
+            return
+        # Сообщение удалено пользователем или недоступно - нужна новая отправка
+        logger.info(f"🔁 Не удалось обновить сообщение {message_id} у пользователя {user_id}, отправляем новое: {error}")
+        send_fresh()
+
+    delivery_queue.enqueue(
+        user_id,
+        application.bot.edit_message_text,
+        on_done=on_edited,
+        on_error=on_failed,
+        description=f"обновление напоминания {reminder_id}",
+        message_id=message_id,
+        text=edit_text,
+        reply_markup=edit_markup,
+        parse_mode='Markdown'
+    )
+
+# Максимум сообщений в одном запросе deleteMessages
+DELETE_BATCH_SIZE = 100
+
+# Чем заменяется сообщение удаленного напоминания, которое уже нельзя удалить
+STALE_MESSAGE_TEXT = "⌛ Напоминание больше не актуально."
+
+def strip_message_keyboard(application, user_id, message_id):
+    """Убирает кнопки сообщения, оставляя текст: сообщение больше не отслеживается"""
+    delivery_queue.enqueue(
+        user_id,
+        application.bot.edit_message_reply_markup,
+        on_error=lambda e: logger.info(f"⌛ Не удалось убрать кнопки сообщения {message_id}: {e}"),
+        description=f"снятие кнопок сообщения {message_id}",
+        message_id=message_id,
+        reply_markup=None
+    )
+
+def mark_message_stale(application, user_id, message_id):
+    """Убирает кнопки и помечает сообщение неактуальным вместо удаления"""
+    delivery_queue.enqueue(
+        user_id,
+        application.bot.edit_message_text,
+        on_error=lambda e: logger.info(f"⌛ Не удалось пометить сообщение {message_id} неактуальным: {e}"),
+        description=f"пометка сообщения {message_id}",
+        message_id=message_id,
+        text=STALE_MESSAGE_TEXT
+    )
+
+async def delete_tracked_messages(application, reminder_ids):
+    """Удаляет сообщения указанных напоминаний: группами по чатам через общую очередь запросов"""
+    now = now_ts()
+    reminder_ids = {str(reminder_id) for reminder_id in reminder_ids}
+    shared = message_store.shared_messages(reminder_ids)
+    messages = []
+    by_chat = {}
+    for reminder_id in reminder_ids:
+        for user_id, entry in message_store.get(reminder_id).items():
+            messages.append((reminder_id, user_id, entry['message_id']))
+            if (user_id, entry['message_id']) in shared:
+                # Сводка с другими напоминаниями: удаляется вместе с последним пунктом
+                continue
+            if message_store.is_deletable(entry, now):
+                by_chat.setdefault(user_id, []).append(entry['message_id'])
+            else:
+                # Старше 48 часов: удаление не сработает - не тратим на него запрос
+                mark_message_stale(application, user_id, entry['message_id'])
+    if not messages:
+        return 0
+
+    # Массовое удаление, если его поддерживает установленная библиотека
+    bot = application.bot
+    bulk = hasattr(bot, 'delete_messages')
+    batches = []
+    for chat_id, message_ids in by_chat.items():
+        if bulk:
+            batches.extend((chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
+                           for i in range(0, len(message_ids), DELETE_BATCH_SIZE))
+        else:
+            batches.extend((chat_id, [message_id]) for message_id in message_ids)
+
+    async def delete_batch(chat_id, message_ids):
+        # Удаления идут через очередь: общий лимит, пауза по RetryAfter и повторы при ошибках сети
+        try:
+            if len(message_ids) == 1:
+                await delivery_queue.submit(chat_id, bot.delete_message, description=f"удаление сообщения {message_ids[0]}",
+                                            message_id=message_ids[0])
+            else:
+                await delivery_queue.submit(chat_id, bot.delete_messages, description=f"удаление {len(message_ids)} сообщений",
+                                            message_ids=message_ids)
+            logger.info(f"🗑 Удалено старых сообщений: {len(message_ids)} для пользователя {chat_id}")
+            return len(message_ids)
+        except Exception as e:
+            if "Chat not found" in str(e):
+                logger.info(f"🗑 Чат не найден для пользователя {chat_id}, удаляем запись из базы")
+            elif "Message to delete not found" in str(e):
+                logger.info(f"🗑 Сообщение уже удалено для пользователя {chat_id}, удаляем запись из базы")
+            else:
+                logger.error(f"❌ Ошибка удаления сообщений {message_ids} для пользователя {chat_id}: {e}")
+            return 0
+
+    deleted_count = sum(await asyncio.gather(*(delete_batch(chat_id, message_ids) for chat_id, message_ids in batches)))
+
+    # Записи удаляются из базы в любом случае: сообщение удалено, уже
+    # отсутствует или чат недоступен
+    message_store.forget(messages)
+    return deleted_count
+
+async def delete_old_reminder_messages(application, reminder_id):
+    """Удаляет старые сообщения для указанного reminder_id"""
+    try:
+        deleted_count = await delete_tracked_messages(application, [reminder_id])
+        logger.info(f"✅ Удалено {deleted_count} старых сообщений для reminder {reminder_id}")
+        return deleted_count
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка в delete_old_reminder_messages: {e}")
+        return 0
+
+
+def load_recipes():
+    """Загрузка рецептов из хранилища"""
+    return repository.snapshot('recipes')
+
+async def save_recipes(recipes):
+    """Сохранение рецептов: изменения применяются в памяти, на диск - отложенной записью"""
+    if not repository.commit('recipes', recipes):
+        return False
+    return True
+
+def load_meal_plans():
+    """Загрузка планов питания из хранилища"""
+    return repository.snapshot('meal_plans')
+
+async def save_meal_plans(meal_plans):
+    """Сохранение планов питания: изменения применяются в памяти, на диск - отложенной записью"""
+    if not repository.commit('meal_plans', meal_plans):
+        return False
+    return True
+
 WEEK_DAYS = {
     'mon': 'Понедельник',
     'tue': 'Вторник',
@@ -362,74 +2239,27 @@ NOTIFICATION_TIMES = {
     '1_week': 'За неделю'
 }
 
+async def stale_shopping_list_keys():
+    """Ключи сообщений списков покупок, у планов которых не осталось напоминаний ингредиентов"""
+    stale_keys = []
+    for key in message_store.reminder_ids():
+        if not key.startswith(SHOPPING_LIST_KEY_PREFIX):
+            continue
+        meal_plan_id = key[len(SHOPPING_LIST_KEY_PREFIX):]
+        if not await repository.find_ids('reminders', 'meal_plan_id', meal_plan_id):
+            stale_keys.append(key)
+    return stale_keys
+
 async def cleanup_old_messages(application, current_reminders):
     """Удаляет сообщения для напоминаний, которых больше нет в актуальном списке"""
     try:
-        message_ids = load_message_ids()
-        if not message_ids:
-            return 0
-
-        deleted_count = 0
-        current_reminder_ids = set(current_reminders.keys())
-
-        # Создаем копию ключей для безопасного удаления
-        keys_to_check = list(message_ids.keys())
-
-        for key in keys_to_check:
-            try:
-                # Разделяем ключ на части
-                parts = key.split('_')
-                if len(parts) < 2:
-                    logger.warning(f"⚠️ Неверный формат ключа: {key}")
-                    # Удаляем некорректную запись
-                    del message_ids[key]
-                    continue
-
-                # Последняя часть - user_id
-                reminder_id = '_'.join(parts[:-1])  # Все части кроме последней
-                user_id_str = parts[-1]  # Последняя часть
-
-                # Пытаемся преобразовать user_id в число
-                try:
-                    user_id = int(user_id_str)
-                except ValueError:
-                    logger.warning(f"⚠️ Неверный формат user_id в ключе {key}: {user_id_str}")
-                    # Удаляем некорректную запись
-                    del message_ids[key]
-                    continue
-
-                # Если напоминание больше не существует в актуальном списке
-                if reminder_id not in current_reminder_ids:
-                    try:
-                        message_id = message_ids[key]
-                        await application.bot.delete_message(
-                            chat_id=user_id,
-                            message_id=message_id
-                        )
-                        del message_ids[key]
-                        deleted_count += 1
-                        logger.info(f"🗑 Удалено неактуальное сообщение {message_id} для пользователя {user_id} (reminder {reminder_id} не существует)")
-                    except Exception as e:
-                        if "Chat not found" in str(e):
-                            # Чат не найден - просто удаляем запись из базы
-                            logger.info(f"🗑 Чат не найден для пользователя {user_id}, удаляем запись из базы")
-                            del message_ids[key]
-                        elif "Message to delete not found" in str(e):
-                            # Сообщение уже удалено - удаляем запись из базы
-                            logger.info(f"🗑 Сообщение уже удалено для пользователя {user_id}, удаляем запись из базы")
-                            del message_ids[key]
-                        else:
-                            logger.error(f"❌ Ошибка удаления неактуального сообщения {message_ids[key]} для пользователя {user_id}: {e}")
-                            # Удаляем запись из базы в любом случае
-                            del message_ids[key]
-
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки ключа {key} в cleanup_old_messages: {e}")
-                continue
+        # Напоминания, которых больше нет в актуальном списке (списки покупок проверяются по плану)
+        stale_ids = [reminder_id for reminder_id in message_store.reminder_ids()
+                     if reminder_id not in current_reminders and not reminder_id.startswith(SHOPPING_LIST_KEY_PREFIX)]
+        stale_ids.extend(await stale_shopping_list_keys())
+        deleted_count = await delete_tracked_messages(application, stale_ids)
 
-        # Сохраняем изменения
         if deleted_count > 0:
-            save_message_ids_to_file(message_ids)
             logger.info(f"✅ Удалено {deleted_count} неактуальных сообщений")
 
         return deleted_count
@@ -438,192 +2268,412 @@ async def cleanup_old_messages(application, current_reminders):
         logger.error(f"❌ Ошибка в cleanup_old_messages: {e}")
         return 0
 
-async def cleanup_invalid_message_ids(application):
-    """Очищает базу message_ids от некорректных записей"""
-    try:
-        message_ids = load_message_ids()
-        original_count = len(message_ids)
-        deleted_count = 0
+# Страховочная сверка отслеживаемых сообщений с напоминаниями (секунды)
+MESSAGE_RECONCILE_INTERVAL = 6 * 3600
 
-        keys_to_delete = []
+# Как часто забывать сообщения старше окна удаления (секунды)
+MESSAGE_PRUNE_INTERVAL = 3600
 
-        for key, message_id in message_ids.items():
-            try:
-                # Проверяем формат ключа
-                parts = key.split('_')
-                if len(parts) < 2:
-                    logger.warning(f"⚠️ Неверный формат ключа: {key}")
-                    keys_to_delete.append(key)
-                    continue
+class MessageCleanup:
+    """Удаляет сообщения напоминания сразу после удаления самого напоминания"""
 
-                # Проверяем user_id
-                user_id_str = parts[-1]
-                try:
-                    user_id = int(user_id_str)
-                    # Проверяем, что user_id разумной длины (не более 20 символов)
-                    if len(user_id_str) > 20:
-                        logger.warning(f"⚠️ Слишком длинный user_id: {user_id_str} в ключе {key}")
-                        keys_to_delete.append(key)
-                        continue
-                except ValueError:
-                    logger.warning(f"⚠️ Неверный формат user_id: {user_id_str} в ключе {key}")
-                    keys_to_delete.append(key)
-                    continue
+    def __init__(self, repository, name='reminders'):
+        self.repository = repository
+        self.name = name
+        self._pending = set()
+        self._application = None
+        self._task = None
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка проверки ключа {key}: {e}")
-                keys_to_delete.append(key)
-                continue
+    def notify(self, name, record_id):
+        """Слушатель репозитория: напоминание удалено - его сообщения ставятся в очередь на удаление"""
+        if name != self.name or record_id in self.repository.collection(self.name):
+            return
+        self._pending.add(record_id)
+        self._schedule()
 
-        # Удаляем некорректные записи
-        for key in keys_to_delete:
-            del message_ids[key]
-            deleted_count += 1
+    def _schedule(self):
+        if self._application is None or self._task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._task = loop.create_task(self._run())
 
-        if deleted_count > 0:
-            save_message_ids_to_file(message_ids)
-            logger.info(f"✅ Очищено {deleted_count} некорректных записей из {original_count}")
+    async def _run(self):
+        try:
+            while self._pending:
+                reminder_ids, self._pending = self._pending, set()
+                # Вместе с последним ингредиентом плана уходит и список покупок
+                reminder_ids = list(reminder_ids) + await stale_shopping_list_keys()
+                deleted_count = await delete_tracked_messages(self._application, reminder_ids)
+                if deleted_count > 0:
+                    logger.info(f"🗑 Удалено {deleted_count} сообщений удаленных напоминаний ({len(reminder_ids)})")
+        except Exception as e:
+            logger.error(f"❌ Ошибка удаления сообщений удаленных напоминаний: {e}")
+        finally:
+            self._task = None
 
-        return deleted_count
+    def start(self, application):
+        """Начинает удалять сообщения (до запуска бота удаления копятся)"""
+        self._application = application
+        if self._pending:
+            self._schedule()
+
+message_cleanup = MessageCleanup(repository)
+repository.add_listener(message_cleanup.notify)
 
+async def prune_messages_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически забывает сообщения, которые удалить уже нельзя; у забытых снимаются кнопки"""
+    try:
+        expired = message_store.prune_expired()
+        # Кнопки забытого сообщения вели бы к текущему состоянию напоминания, которое оно уже не покажет
+        for user_id, message_id in {(user_id, message_id) for _, user_id, message_id in expired}:
+            strip_message_keyboard(context.application, user_id, message_id)
     except Exception as e:
-        logger.error(f"❌ Ошибка в cleanup_invalid_message_ids: {e}")
-        return 0
+        logger.error(f"❌ Ошибка очистки просроченных сообщений: {e}")
+
+async def reconcile_messages_job(context: ContextTypes.DEFAULT_TYPE):
+    """Страховочная сверка: удаляет сообщения напоминаний, которых больше нет"""
+    await cleanup_old_messages(context.application, repository.collection('reminders'))
 
 async def cleanup_message_ids_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Команда для очистки базы message_ids"""
+    """Команда для очистки базы message_ids от сообщений удаленных напоминаний"""
     try:
-        message_ids = load_message_ids()
-        original_count = len(message_ids)
-
-        # Удаляем все записи с некорректными ключами
-        keys_to_delete = []
-        for key in message_ids.keys():
-            parts = key.split('_')
-            if len(parts) < 2:
-                keys_to_delete.append(key)
-                logger.info(f"🗑 Удален некорректный ключ: {key}")
-                continue
+        original_count = message_store.count()
+        deleted_count = await cleanup_old_messages(context.application, repository.collection('reminders'))
 
-            # Проверяем user_id
-            user_id_str = parts[-1]
-            try:
-                user_id = int(user_id_str)
-                # Проверяем разумную длину user_id
-                if len(user_id_str) > 20:
-                    keys_to_delete.append(key)
-                    logger.info(f"🗑 Удален ключ с длинным user_id: {key}")
-            except ValueError:
-                keys_to_delete.append(key)
-                logger.info(f"🗑 Удален ключ с нечисловым user_id: {key}")
+        await update.message.reply_text(
+            f"✅ База message_ids очищена! Было записей: {original_count}, осталось: {message_store.count()}.\n"
+            f"🧹 Удалено неактуальных сообщений: {deleted_count}."
+        )
 
-        for key in keys_to_delete:
-            del message_ids[key]
+    except Exception as e:
+        logger.error(f"❌ Ошибка очистки message_ids: {e}")
+        await update.message.reply_text("❌ Ошибка при очистке базы message_ids")
 
-        save_message_ids_to_file(message_ids)
+async def quiet_hours_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /quiet: показать или задать свои тихие часы (/quiet 22:00-08:00, /quiet off, /quiet default)"""
+    user_id = str(update.effective_user.id)
+    users = load_users()
+    if user_id not in users:
+        await update.message.reply_text("❌ Сначала выполните /start")
+        return
 
-        # Также запускаем очистку некорректных записей
-        invalid_cleaned = await cleanup_invalid_message_ids(context.application)
+    if not context.args:
+        await update.message.reply_text(
+            f"🌙 Тихие часы: {quiet_hours_for(user_id)}\n"
+            f"По умолчанию: {QUIET_HOURS}\n\n"
+            "Изменить: /quiet 22:00-08:00, выключить: /quiet off, сбросить: /quiet default"
+        )
+        return
 
+    spec = context.args[0]
+    if spec.lower() == 'default':
+        spec = None
+    else:
+        try:
+            parse_quiet_hours(spec)
+        except ValueError:
+            await update.message.reply_text("❌ Неверный формат. Пример: /quiet 22:00-08:00")
+            return
+
+    users[user_id]['quiet_hours'] = spec
+    if not await save_users(users):
+        await update.message.reply_text("❌ Ошибка при сохранении. Попробуйте снова.")
+        return
+
+    # Время срабатывания напоминаний зависит от тихих часов получателей - пересчитываем их
+    for reminder_id, reminder in repository.collection('reminders').items():
+        if user_id in {str(user) for user in reminder.get('users') or ()}:
+            reminder_scheduler.notify('reminders', reminder_id)
+    logger.info(f"🌙 Тихие часы пользователя {user_id}: {spec or 'по умолчанию'}")
+    await update.message.reply_text(f"✅ Тихие часы: {quiet_hours_for(user_id)}")
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /timezone: показать или задать свой часовой пояс (/timezone Europe/Berlin, /timezone default)"""
+    user_id = str(update.effective_user.id)
+    users = load_users()
+    if user_id not in users:
+        await update.message.reply_text("❌ Сначала выполните /start")
+        return
+
+    if not context.args:
         await update.message.reply_text(
-            f"✅ База message_ids очищена! Удалено {len(keys_to_delete)} из {original_count} записей.\n"
-            f"🧹 Дополнительно очищено {invalid_cleaned} некорректных записей."
+            f"🌍 Часовой пояс: {user_timezone(user_id).key} (сейчас {user_now(user_id).strftime('%H:%M')})\n"
+            f"По умолчанию: {DEFAULT_TIMEZONE}\n\n"
+            "Изменить: /timezone Europe/Berlin, сбросить: /timezone default"
         )
+        return
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка очистки message_ids: {e}")
-        await update.message.reply_text("❌ Ошибка при очистке базы message_ids")
+    name = context.args[0]
+    if name.lower() == 'default':
+        name = None
+    elif get_timezone(name) is None:
+        await update.message.reply_text("❌ Неизвестный часовой пояс. Пример: /timezone Asia/Yekaterinburg")
+        return
 
-async def cleanup_past_meal_plans_and_reminders(application):
-    """Автоматически удаляет напоминания с прошедшей датой приготовления и создает новые планы"""
-    try:
-        reminders = load_reminders()
-        meal_plans = load_meal_plans()
-        current_time = datetime.now(MOSCOW_TZ)
+    users[user_id]['timezone'] = name
+    if not await save_users(users):
+        await update.message.reply_text("❌ Ошибка при сохранении. Попробуйте снова.")
+        return
+
+    # Тихие часы и повторы напоминаний считаются по местному времени - пересчитываем срабатывания
+    for reminder_id, reminder in repository.collection('reminders').items():
+        if user_id in {str(user) for user in reminder.get('users') or ()} or reminder.get('created_by') == user_id:
+            reminder_scheduler.notify('reminders', reminder_id)
+    logger.info(f"🌍 Часовой пояс пользователя {user_id}: {name or 'по умолчанию'}")
+    await update.message.reply_text(f"✅ Часовой пояс: {user_timezone(user_id).key}")
+
+# Сколько обновлений от разных пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = 32
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений: разные чаты - одновременно, один чат - строго по очереди (для диалогов)"""
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class EntityLocks:
+    """Блокировки отдельных напоминаний и планов: параллельные обработчики не перезаписывают изменения друг друга"""
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, kind, entity_id):
+        key = (kind, str(entity_id))
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, kind, entity_ids):
+        """Захватывает блокировки нескольких сущностей в одном порядке (без взаимных блокировок)"""
+        locks = [self.get(kind, entity_id) for entity_id in sorted({str(entity_id) for entity_id in entity_ids})]
+        async with contextlib.AsyncExitStack() as stack:
+            for lock in locks:
+                await stack.enter_async_context(lock)
+            yield
+
+entity_locks = EntityLocks()
+
+# Разделитель компактного формата callback_data: action:arg1:arg2
+CALLBACK_SEPARATOR = ':'
+
+def callback_data(action, *args):
+    """Собирает callback_data в компактном формате action:arg1:arg2"""
+    return CALLBACK_SEPARATOR.join([action, *map(str, args)])
+
+def parse_callback_data(data):
+    """Разбирает компактный callback_data: (action, [аргументы])"""
+    action, _, rest = data.partition(CALLBACK_SEPARATOR)
+    return action, rest.split(CALLBACK_SEPARATOR) if rest else []
+
+def locked_callback(kind, entity_id_from):
+    """Выполняет обработчик под блокировкой сущности; entity_id_from(update, context) возвращает ее ID"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            entity_id = entity_id_from(update, context)
+            if entity_id is None:
+                return await handler(update, context)
+            async with entity_locks.get(kind, entity_id):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+def callback_suffix(*prefixes):
+    """ID сущности из callback_data: первый аргумент action:id или суффикс после старого префикса action_"""
+    def extract(update, context):
+        data = update.callback_query.data if update.callback_query else None
+        if data and CALLBACK_SEPARATOR in data:
+            action, args = parse_callback_data(data)
+            if args and f"{action}_" in prefixes:
+                return args[0]
+        for prefix in prefixes:
+            if data and data.startswith(prefix):
+                return data[len(prefix):]
+        return None
+    return extract
+
+# Через сколько секунд удаляется служебное сообщение с результатом нажатия кнопки
+CONFIRMATION_DELETE_DELAY = 3
+
+async def delete_message_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отложенное удаление сообщения (задача JobQueue) через общую очередь запросов"""
+    chat_id, message_id = context.job.data
+    delivery_queue.enqueue(
+        chat_id,
+        context.bot.delete_message,
+        on_error=lambda e: logger.error(f"Ошибка при удалении сообщения: {e}"),
+        description=f"удаление сообщения {message_id}",
+        message_id=message_id
+    )
+
+def schedule_message_deletion(context, message, delay=CONFIRMATION_DELETE_DELAY):
+    """Удаляет сообщение через delay секунд, не задерживая обработчик"""
+    context.job_queue.run_once(
+        delete_message_job,
+        when=delay,
+        data=(message.chat_id, message.message_id),
+        name=f"delete_message_{message.chat_id}_{message.message_id}"
+    )
+
+class CallbackRouter(BaseHandler):
+    """Один обработчик для всех кнопок вместо списка CallbackQueryHandler с регулярными выражениями
+
+    Компактные данные action:arg1:arg2 разбираются один раз и ищутся в словаре
+    действий (аргументы попадают в context.args). Старые форматы остаются
+    псевдонимами: точные значения ищутся в словаре, префиксы - в префиксном
+    дереве. Из нескольких подходящих маршрутов побеждает зарегистрированный
+    раньше - как при проверке обработчиков по порядку.
+    """
+
+    def __init__(self):
+        super().__init__(self._unrouted)
+        self._actions = {}
+        self._exact = {}
+        self._trie = {}
+        self._count = 0
+
+    def add(self, handler, action=None, exact=(), prefixes=()):
+        """Регистрирует обработчик для действия action, точных значений exact и префиксов prefixes"""
+        route = (self._count, handler)
+        self._count += 1
+        if action is not None:
+            self._actions.setdefault(action, route)
+        for value in exact:
+            self._exact.setdefault(value, route)
+        for prefix in prefixes:
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            # Ключ None в узле - маршрут, заканчивающийся на этом префиксе
+            node.setdefault(None, route)
+
+    def resolve(self, data):
+        """Возвращает (обработчик, аргументы) для callback_data или None"""
+        if CALLBACK_SEPARATOR in data:
+            action, args = parse_callback_data(data)
+            route = self._actions.get(action)
+            if route is not None:
+                return route[1], args
+
+        best = self._exact.get(data)
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(None)
+            if route is not None and (best is None or route[0] < best[0]):
+                best = route
+        if best is None:
+            return None
+        return best[1], []
 
-        deleted_count = 0
-        created_count = 0
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query:
+            data = update.callback_query.data
+            if isinstance(data, str):
+                return self.resolve(data)
+        return None
 
-        # Находим ВСЕ напоминания с прошедшей датой приготовления (не только ингредиенты)
-        past_reminders = []
-        for reminder_id, reminder in reminders.items():
-            try:
-                # Для ингредиентов проверяем meal_date
-                if reminder.get('type') == 'ingredient':
-                    meal_date_str = reminder.get('meal_date')
-                    if meal_date_str:
-                        try:
-                            # Парсим дату приготовления (формат: DD.MM.YYYY)
-                            meal_date = datetime.strptime(meal_date_str, '%d.%m.%Y').replace(tzinfo=MOSCOW_TZ)
-
-                            # Если дата приготовления уже прошла (учитываем начало дня)
-                            if meal_date.date() < current_time.date():
-                                past_reminders.append((reminder_id, reminder))
-                        except ValueError as e:
-                            logger.error(f"❌ Ошибка парсинга даты приготовления {meal_date_str}: {e}")
-                            continue
-
-                # Для обычных напоминаний проверяем, не прошло ли 24 часа с последней отправки (для однократных)
-                else:
-                    # Если напоминание однократное и время прошло более 24 часов назад
-                    if reminder.get('interval_days', 0) == 0:
-                        last_sent = reminder.get('last_sent')
-                        if last_sent:
-                            last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                            hours_passed = (current_time - last_sent_time).total_seconds() / 3600
-                            if hours_passed >= 24:
-                                past_reminders.append((reminder_id, reminder))
+    async def handle_update(self, update, application, check_result, context):
+        handler, args = check_result
+        context.args = args
+        return await handler(update, context)
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка проверки напоминания {reminder_id}: {e}")
-                continue
+    @staticmethod
+    async def _unrouted(update, context):
+        return None
 
-        # Собираем уникальные meal_plan_id для создания новых планов
-        processed_plans = set()
+def build_callback_router():
+    """Маршруты кнопок вне диалогов; старые префиксы callback_data оставлены псевдонимами"""
+    router = CallbackRouter()
 
-        for reminder_id, reminder in past_reminders:
-            try:
-                # УДАЛЯЕМ СООБЩЕНИЯ ПЕРЕД УДАЛЕНИЕМ НАПОМИНАНИЯ
-                await delete_old_reminder_messages(application, reminder_id)
+    # Обработчики для кнопок "Все рецепты" и "Все планы"
+    router.add(list_recipes, exact=["list_recipes"])
+    router.add(list_meal_plans, exact=["list_meal_plans"])
 
-                # Удаляем напоминание
-                del reminders[reminder_id]
-                deleted_count += 1
-                logger.info(f"🗑 Удалено напоминание с прошедшей датой: {reminder_id}")
+    # И другие callback обработчики
+    router.add(handle_notification_selection, prefixes=["notify_"])
+    router.add(handle_assignment_completion, exact=["setup_notifications", "save_without_notifications", "continue_assignment"])
+    router.add(handle_reminders_pagination, action="rpage", prefixes=["regular_page_", "ingredients_page_", "current_page"])
+    router.add(handle_reminders_list_switch, prefixes=["switch_to_"])
+    # Обработчик для выбора напоминания для удаления
+    router.add(handle_delete_reminder, prefixes=["delete_reminder_"])
+    router.add(handle_custom_day_selection, exact=["show_calendar", "input_days", "back_to_day_selection"])
+    router.add(handle_calendar_selection, prefixes=["cal_", "back_to_custom_menu"])
+    router.add(ignore_callback, exact=["ignore"])
 
-                # Для ингредиентов добавляем meal_plan_id в обработанные
-                if reminder.get('type') == 'ingredient':
-                    meal_plan_id = reminder.get('meal_plan_id')
-                    if meal_plan_id and meal_plan_id not in processed_plans:
-                        processed_plans.add(meal_plan_id)
+    # Обработчик для кнопки "Мои напоминания"
+    router.add(my_reminders_for_deletion, exact=["my_reminders_delete"])
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка удаления напоминания {reminder_id}: {e}")
-                continue
+    # Обработчик для подтверждения удаления
+    router.add(handle_confirm_delete, prefixes=["confirm_delete_"])
 
-        # СОЗДАЕМ НОВЫЕ ПЛАНЫ ДЛЯ УДАЛЕННЫХ НАПОМИНАНИЙ ИНГРЕДИЕНТОВ
-        # ИСПОЛЬЗУЕМ КОПИЮ processed_plans ДЛЯ ИТЕРАЦИИ, ТАК КАК МНОЖЕСТВО БУДЕТ ИЗМЕНЯТЬСЯ
-        for meal_plan_id in list(processed_plans):
-            if meal_plans.get(meal_plan_id):
-                new_plan_id = await create_next_week_meal_plan(application, meal_plan_id)
-                if new_plan_id:
-                    created_count += 1
-                    logger.info(f"📅 Создан новый план на следующую неделю: {new_plan_id}")
-                    # УДАЛЯЕМ ИЗ ОБРАБОТАННЫХ, ЧТОБЫ ИЗБЕЖАТЬ ПОВТОРНОЙ ОБРАБОТКИ
-                    processed_plans.discard(meal_plan_id)
+    # ВАЖНО: Обработчик для кнопок "Купил" и "Еще не купил" должен быть ДО главного меню
+    router.add(handle_bought_not_bought, action="bought", prefixes=["bought_"])
+    router.add(handle_bought_not_bought, action="not_bought", prefixes=["not_bought_"])
+    router.add(handle_shopping_toggle, action="shop")
+    router.add(handle_shopping_later, action="shop_later")
+    router.add(handle_back_to_calendar_from_time, exact=["back_to_calendar_from_time"])
 
-        # Сохраняем изменения
-        if deleted_count > 0:
-            if not save_reminders(reminders):
-                logger.error("❌ Ошибка при сохранении напоминаний после очистки")
-            else:
-                logger.info(f"✅ Автоматическая очистка: удалено {deleted_count} напоминаний, создано {created_count} новых планов")
+    # Главный обработчик меню должен быть одним из последних
+    router.add(main_menu_callback, exact=["add_reminder", "list_reminders", "list_users", "recipes", "back_to_main",
+                                          "back_to_text_input", "back_to_day_selection", "back_to_interval",
+                                          "back_to_user_selection", "back_to_recipe_name", "back_to_recipes"])
 
-        return deleted_count
+    # Обработчик отмены
+    router.add(cancel_reminder, exact=["cancel_reminder"])
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка в cleanup_past_meal_plans_and_reminders: {e}")
-        return 0
+    # Остальные обработчики...
+    router.add(handle_user_selection_for_ingredient, exact=["select_user_", "back_to_assignment"])
+    router.add(handle_ingredient_assignment, exact=["assign_ing_", "back_to_recipe_selection", "finish_assignment"])
+    router.add(edit_recipes_menu, exact=["edit_recipes"])
+    router.add(manage_meal_plans, exact=["manage_plans"])
+    router.add(manage_day_plans, prefixes=["manage_day_"])
+    router.add(edit_meal_plan, prefixes=["edit_plan_"])
+    router.add(start_edit_plan_assignment, prefixes=["change_assignees_"])
+    router.add(handle_edit_plan_assignment, exact=["edit_assign_ing_", "back_to_edit_plan", "finish_edit_assignment"])
+    router.add(handle_change_plan_day, prefixes=["change_plan_day_"])
+    router.add(handle_update_plan_day, prefixes=["update_day_"])
+    router.add(handle_plan_notify_time, action="plan_time")
+    router.add(back_to_recipe_name_handler, exact=["back_to_recipe_name"])
+    router.add(back_to_edit_recipe_menu, exact=["back_to_edit_recipe_menu"], prefixes=["back_to_edit_recipe_menu_"])
+    router.add(back_to_edit_plan_handler, exact=["back_to_edit_plan"])
+    router.add(handle_delete_plan, prefixes=["delete_plan_"])
+    return router
 
 async def main():
     logger.info("🚀 Запуск бота...")
@@ -638,20 +2688,13 @@ async def main():
         Application.builder()
         .token(token)
         .job_queue(job_queue)
+        .concurrent_updates(PerChatUpdateProcessor())
         .build()
     )
     logger.info("✅ Приложение создано, начинаем регистрацию обработчиков...")
 
-    # Создаем файлы, если они отсутствуют
-    for load_func, file_name in [
-        (load_users, 'users.json'),
-        (load_reminders, 'reminders.json'),
-        (load_recipes, 'recipes.json'),
-        (load_meal_plans, 'meal_plans.json'),
-        (load_message_ids, 'message_ids.json')
-
-    ]:
-        load_func()
+    # Загружаем состояние в память (создает файлы, если они отсутствуют)
+    await repository.load_all_async()
 
     # СНАЧАЛА регистрируем ConversationHandler
     application.add_handler(remind_conv_handler)
@@ -667,92 +2710,24 @@ async def main():
     application.add_handler(CommandHandler("remind", start_add_reminder))
     application.add_handler(CommandHandler("recipes", recipes_command))
     application.add_handler(CommandHandler("cleanup_ids", cleanup_message_ids_command))
+    application.add_handler(CommandHandler("quiet", quiet_hours_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
 
-    # Обработчики для кнопок "Все рецепты" и "Все планы"
-    application.add_handler(CallbackQueryHandler(list_recipes, pattern="^list_recipes$"))
-    application.add_handler(CallbackQueryHandler(list_meal_plans, pattern="^list_meal_plans$"))
-
-    # И другие callback обработчики
-    application.add_handler(CallbackQueryHandler(handle_notification_selection, pattern="^notify_"))
-    application.add_handler(CallbackQueryHandler(handle_assignment_completion, pattern="^(setup_notifications|save_without_notifications|continue_assignment)$"))
-    application.add_handler(CallbackQueryHandler(handle_reminders_pagination, pattern="^(regular_page_|ingredients_page_|current_page)"))
-    application.add_handler(CallbackQueryHandler(handle_reminders_list_switch, pattern="^switch_to_"))
-    application.add_handler(CallbackQueryHandler(handle_delete_reminder, pattern="^delete_reminder_"))
-    application.add_handler(CallbackQueryHandler(handle_custom_day_selection, pattern="^(show_calendar|input_days|back_to_day_selection)$"))
-    application.add_handler(CallbackQueryHandler(handle_calendar_selection, pattern="^(cal_|back_to_custom_menu)"))
-    application.add_handler(CallbackQueryHandler(ignore_callback, pattern="^ignore$"))
-
-    # Обработчик для кнопки "Мои напоминания"
-    application.add_handler(CallbackQueryHandler(my_reminders_for_deletion, pattern="^my_reminders_delete$"))
-
-    # Обработчик для выбора напоминания для удаления
-    application.add_handler(CallbackQueryHandler(handle_delete_reminder, pattern="^delete_reminder_"))
-
-    # Обработчик для подтверждения удаления
-    application.add_handler(CallbackQueryHandler(handle_confirm_delete, pattern="^confirm_delete_"))
-
-    # ВАЖНО: Обработчик для кнопок "Купил" и "Еще не купил" должен быть ДО главного меню
-    application.add_handler(CallbackQueryHandler(handle_bought_not_bought, pattern="^(bought_|not_bought_)"))
-    application.add_handler(CallbackQueryHandler(handle_back_to_calendar_from_time, pattern="^back_to_calendar_from_time$"))
-
-    # Главный обработчик меню должен быть одним из последних
-    application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^(add_reminder|list_reminders|list_users|recipes|back_to_main|back_to_text_input|back_to_day_selection|back_to_interval|back_to_user_selection|back_to_recipe_name|back_to_recipes)$"))
-
-    # Обработчик отмены
-    application.add_handler(CallbackQueryHandler(cancel_reminder, pattern="^cancel_reminder$"))
-
-    # Остальные обработчики...
-    application.add_handler(CallbackQueryHandler(handle_user_selection_for_ingredient, pattern="^(select_user_|back_to_assignment)$"))
-    application.add_handler(CallbackQueryHandler(handle_ingredient_assignment, pattern="^(assign_ing_|back_to_recipe_selection|finish_assignment)$"))
-    application.add_handler(CallbackQueryHandler(edit_recipes_menu, pattern="^edit_recipes$"))
-    application.add_handler(CallbackQueryHandler(manage_meal_plans, pattern="^manage_plans$"))
-    application.add_handler(CallbackQueryHandler(manage_day_plans, pattern="^manage_day_"))
-    application.add_handler(CallbackQueryHandler(edit_meal_plan, pattern="^edit_plan_"))
-    application.add_handler(CallbackQueryHandler(start_edit_plan_assignment, pattern="^change_assignees_"))
-    application.add_handler(CallbackQueryHandler(handle_edit_plan_assignment, pattern="^(edit_assign_ing_|back_to_edit_plan|finish_edit_assignment)$"))
-    application.add_handler(CallbackQueryHandler(handle_change_plan_day, pattern="^change_plan_day_"))
-    application.add_handler(CallbackQueryHandler(handle_update_plan_day, pattern="^update_day_"))
-    application.add_handler(CallbackQueryHandler(back_to_recipe_name_handler, pattern="^back_to_recipe_name$"))
-    application.add_handler(CallbackQueryHandler(back_to_edit_recipe_menu, pattern="^back_to_edit_recipe_menu_"))
-    application.add_handler(CallbackQueryHandler(back_to_edit_recipe_menu, pattern="^back_to_edit_recipe_menu$"))
-    application.add_handler(CallbackQueryHandler(back_to_edit_plan_handler, pattern="^back_to_edit_plan$"))
-    application.add_handler(CallbackQueryHandler(handle_delete_plan, pattern="^delete_plan_"))
-    application.add_handler(CallbackQueryHandler(lambda update, context: update.callback_query.answer(), pattern="^ignore$"))
-
-    # ЗАПУСКАЕМ ПРОВЕРКУ ПРОПУЩЕННЫХ НАПОМИНАНИЙ ПРИ СТАРТЕ
-    async def send_missed_on_startup(application):
-        """Отправляет пропущенные напоминания при запуске бота"""
-        try:
-            logger.info("🔍 Запуск проверки пропущенных напоминаний при старте...")
-            missed_count = await send_missed_reminders(application)
-            if missed_count > 0:
-                logger.info(f"🚀 При старте отправлено {missed_count} пропущенных напоминаний")
-            else:
-                logger.info("✅ Пропущенных напоминаний при старте не найдено")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при отправке пропущенных напоминаний при старте: {e}")
-
-    # Запускаем проверку пропущенных напоминаний через 10 секунд после старта
-    application.job_queue.run_once(
-        lambda context: send_missed_on_startup(application),
-        when=10
-    )
-
-    application.job_queue.run_once(
-        lambda context: cleanup_invalid_message_ids(application),
-        when=5
-    )
-
-    # Обычная периодическая проверка каждую минуту
-    application.job_queue.run_repeating(check_all_reminders, interval=60, first=10)
+    # ВСЕ ОСТАЛЬНЫЕ КНОПКИ - через один маршрутизатор (порядок регистрации = приоритет)
+    application.add_handler(build_callback_router())
 
-    # В функции main() добавьте:
-    application.job_queue.run_repeating(cleanup_past_meal_plans_and_reminders, interval=3600, first=300)  # Каждый час
+    # Сообщения удаляются вместе с напоминаниями; редкая сверка - на всякий случай
+    application.job_queue.run_repeating(reconcile_messages_job, interval=MESSAGE_RECONCILE_INTERVAL, first=MESSAGE_RECONCILE_INTERVAL)
+    application.job_queue.run_repeating(prune_messages_job, interval=MESSAGE_PRUNE_INTERVAL, first=MESSAGE_PRUNE_INTERVAL)
 
     try:
         await application.initialize()
         await application.start()
         await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+        # Проверяем напоминания по мере наступления их времени (пропущенные за время простоя - с прошлого прохода)
+        reminder_scheduler.start(application)
+        message_cleanup.start(application)
         logger.info("✅ Бот успешно запущен!")
 
         # Бесконечный цикл для поддержания работы бота
@@ -763,9 +2738,14 @@ async def main():
         raise
     finally:
         try:
+            await reminder_scheduler.stop()
+            notification_coalescer.flush_all()
+            await delivery_queue.stop()
             await application.updater.stop()
             await application.stop()
             await application.shutdown()
+            # Записываем все несохраненные изменения и закрываем хранилище
+            repository.close()
             logger.info("🛑 Бот остановлен")
         except Exception as e:
             logger.error(f"❌ Ошибка при остановке бота: {e}")
@@ -783,12 +2763,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user = update.effective_user
     users = load_users()
 
+    # Свои тихие часы и часовой пояс пользователя сохраняются при повторном /start
+    existing = users.get(str(user.id))
     users[str(user.id)] = {
         'username': user.username or user.first_name,
         'first_name': user.first_name,
-        'last_name': user.last_name or ''
+        'last_name': user.last_name or '',
+        'quiet_hours': existing.get('quiet_hours') if existing is not None else None,
+        'timezone': existing.get('timezone') if existing is not None else None
     }
-    if not save_users(users):
+    if not await save_users(users):
         await update.message.reply_text("❌ Ошибка при сохранении пользователя. Проверьте права доступа к файлу users.json.")
         return
 
@@ -800,7 +2784,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 def parse_datetime(time_str: str, base_date: datetime) -> datetime:
-    """Парсинг строки времени в объект datetime с учетом базовой даты и проверкой на прошедшее время"""
+    """Парсинг строки времени в объект datetime с учетом базовой даты (и ее пояса) и проверкой на прошедшее время"""
     formats = ['%H:%M', '%H.%M', '%H:%M:%S', '%H %M']
 
     # Нормализуем строку времени
@@ -810,6 +2794,7 @@ def parse_datetime(time_str: str, base_date: datetime) -> datetime:
     if len(time_str.split(':')[0]) == 1:
         time_str = '0' + time_str
 
+    tz = base_date.tzinfo or DEFAULT_TZ
     for fmt in formats:
         try:
             dt = datetime.strptime(time_str, fmt)
@@ -817,11 +2802,11 @@ def parse_datetime(time_str: str, base_date: datetime) -> datetime:
                 year=base_date.year,
                 month=base_date.month,
                 day=base_date.day,
-                tzinfo=MOSCOW_TZ
+                tzinfo=tz
             )
 
             # Проверяем, не прошло ли время сегодня
-            current_time = datetime.now(MOSCOW_TZ)
+            current_time = datetime.now(tz)
             if dt < current_time:
                 # Если время уже прошло сегодня, устанавливаем на завтра
                 dt += timedelta(days=1)
@@ -883,33 +2868,16 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ADD_TEXT
     elif data == "back_to_day_selection":
         # ВОЗВРАТ К ВЫБОРУ ДНЯ: только кнопка "Отмена"
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         await query.edit_message_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
         return ADD_DAY
     elif data == "back_to_interval":
         # Возврат к выбору интервала: кнопки "Назад" и "Отмена"
-        keyboard = [
-            [InlineKeyboardButton("Однократно", callback_data="interval_0")],
-            [InlineKeyboardButton("Каждый день", callback_data="interval_1")],
-            [InlineKeyboardButton("Каждые 3 дня", callback_data="interval_3")],
-            [InlineKeyboardButton("Каждую неделю", callback_data="interval_7")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_day_selection")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         await query.edit_message_text(
             "🔄 Выберите интервал повторения:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=INTERVAL_KEYBOARD
         )
         return ADD_INTERVAL
     elif data == "back_to_user_selection":
@@ -994,19 +2962,10 @@ async def handle_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['reminder_text'] = update.message.text.strip()
         logger.info(f"Текст напоминания получен: {context.user_data['reminder_text']}")
 
-        # Клавиатура для выбора дня (только кнопка "Отмена")
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         # Отправляем новое сообщение и сохраняем его ID
         message = await update.message.reply_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
         logger.info(f"Сохранили новое instruction_message_id: {message.message_id}")
@@ -1018,17 +2977,9 @@ async def handle_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYP
         # Если не удалось удалить сообщения, все равно продолжаем
         context.user_data['reminder_text'] = update.message.text.strip()
 
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         message = await update.message.reply_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
 
@@ -1038,18 +2989,9 @@ async def handle_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYP
         # Если не удалось удалить сообщения, все равно продолжаем
         context.user_data['reminder_text'] = update.message.text.strip()
 
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_text_input")],
-            [InlineKeyboardButton("🔙 На главную", callback_data="back_to_main")]
-        ]
-
         message = await update.message.reply_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_BACK_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
 
@@ -1066,7 +3008,7 @@ async def skip_to_next_available_time(update: Update, context: ContextTypes.DEFA
             )
             return ADD_TIME
 
-        current_time = datetime.now(MOSCOW_TZ)
+        current_time = user_now(update.effective_user.id)
         selected_date = context.user_data['reminder_date']  # Это дата, выбранная пользователем
 
         # Получаем время для напоминания: текущее время +1 минута
@@ -1076,25 +3018,22 @@ async def skip_to_next_available_time(update: Update, context: ContextTypes.DEFA
         if selected_date.date() == current_time.date():
             next_available_time = reminder_time_candidate
 
-            # ПРОВЕРКА НОЧНОГО РЕЖИМА (23:00 - 9:00) только если дата сегодня
-            if next_available_time.hour >= 23 or next_available_time.hour < 9:
-                # Если ночное время, устанавливаем на 9:00 сегодня или завтра
-                next_available_time = next_available_time.replace(
-                    hour=9, minute=0, second=0, microsecond=0
-                )
-                if next_available_time <= current_time:
-                    next_available_time += timedelta(days=1)
+            # ПРОВЕРКА ТИХИХ ЧАСОВ только если дата сегодня
+            quiet_hours = quiet_hours_for(update.effective_user.id)
+            candidate_ts = int(next_available_time.timestamp())
+            if quiet_hours.is_quiet(candidate_ts):
+                # В тихие часы - на их окончание (со сдвигом по пользователю)
+                next_available_time = local_time(
+                    quiet_hours.next_allowed(candidate_ts, f"user_{update.effective_user.id}"), current_time.tzinfo)
 
-                time_description = f"9:00 {next_available_time.strftime('%d.%m.%Y')}"
+                time_description = next_available_time.strftime('%H:%M %d.%m.%Y')
             else:
                 time_description = f"{next_available_time.strftime('%H:%M')} (через 1 минуту)"
 
-        # Если выбранная дата в будущем - устанавливаем на 10:00 выбранной даты
+        # Если выбранная дата в будущем - устанавливаем на 10:00 выбранной даты (со сдвигом по пользователю)
         else:
-            next_available_time = selected_date.replace(
-                hour=10, minute=0, second=0, microsecond=0
-            )
-            time_description = f"10:00 {selected_date.strftime('%d.%m.%Y')}"
+            next_available_time = slot_time(selected_date, "10:00", f"user_{update.effective_user.id}")
+            time_description = next_available_time.strftime('%H:%M %d.%m.%Y')
 
         # Сохраняем время в контекст (не меняем дату!)
         context.user_data['reminder_time'] = next_available_time
@@ -1120,20 +3059,11 @@ async def skip_to_next_available_time(update: Update, context: ContextTypes.DEFA
                 logger.error(f"Ошибка при удалении сообщения с инструкцией: {e}")
 
         # Переходим к выбору интервала
-        keyboard = [
-            [InlineKeyboardButton("Однократно", callback_data="interval_0")],
-            [InlineKeyboardButton("Каждый день", callback_data="interval_1")],
-            [InlineKeyboardButton("Каждые 3 дня", callback_data="interval_3")],
-            [InlineKeyboardButton("Каждую неделю", callback_data="interval_7")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_day_selection")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         # ОТПРАВЛЯЕМ НОВОЕ СООБЩЕНИЕ И СОХРАНЯЕМ ЕГО ID
         message = await update.message.reply_text(
             f"✅ Время установлено на {time_description}\n\n"
             "🔄 Выберите интервал повторения:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=INTERVAL_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
         logger.info(f"Сохранили новое instruction_message_id: {message.message_id}")
@@ -1222,16 +3152,6 @@ async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYP
                 context.user_data['instruction_message_id'] = message.message_id
                 return ADD_TIME
 
-        # Переходим к выбору интервала
-        keyboard = [
-            [InlineKeyboardButton("Однократно", callback_data="interval_0")],
-            [InlineKeyboardButton("Каждый день", callback_data="interval_1")],
-            [InlineKeyboardButton("Каждые 3 дня", callback_data="interval_3")],
-            [InlineKeyboardButton("Каждую неделю", callback_data="interval_7")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_day_selection")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         # Удаляем предыдущее сообщение с инструкцией
         instruction_message_id = context.user_data.get('instruction_message_id')
         if instruction_message_id:
@@ -1246,7 +3166,7 @@ async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYP
         # Отправляем новое сообщение
         message = await update.message.reply_text(
             "🔄 Выберите интервал повторения:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=INTERVAL_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
 
@@ -1276,8 +3196,8 @@ async def handle_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['instruction_message_id'] = message.message_id
         return ADD_TIME
 
-def generate_single_month_calendar(year, month):
-    """Генерирует клавиатуру календаря для ОДНОГО месяца"""
+def generate_single_month_calendar(year, month, tz=None):
+    """Генерирует клавиатуру календаря для ОДНОГО месяца (сегодня - в поясе tz)"""
     keyboard = []
 
     # Заголовок с месяцем и годом
@@ -1291,7 +3211,7 @@ def generate_single_month_calendar(year, month):
 
     # Получаем календарь на месяц
     cal = calendar.monthcalendar(year, month)
-    today = datetime.now(MOSCOW_TZ).date()
+    today = datetime.now(tz or DEFAULT_TZ).date()
 
     for week in cal:
         row = []
@@ -1309,8 +3229,8 @@ def generate_single_month_calendar(year, month):
 
     return keyboard
 
-def get_calendar_navigation(year, month):
-    """Генерирует кнопки навигации для календаря"""
+def get_calendar_navigation(year, month, tz=None):
+    """Генерирует кнопки навигации для календаря (текущий месяц - в поясе tz)"""
     # Вычисляем предыдущий и следующий месяц
     prev_month = month - 1
     prev_year = year
@@ -1325,7 +3245,7 @@ def get_calendar_navigation(year, month):
         next_year = year + 1
 
     # Текущая дата для ограничений
-    current_date = datetime.now(MOSCOW_TZ)
+    current_date = datetime.now(tz or DEFAULT_TZ)
     current_year = current_date.year
     current_month = current_date.month
 
@@ -1359,8 +3279,8 @@ async def show_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, year
     query = update.callback_query
     await query.answer()
 
-    # Получаем текущую дату
-    current_date = datetime.now(MOSCOW_TZ)
+    # Получаем текущую дату (в поясе пользователя)
+    current_date = user_now(update.effective_user.id)
     if not year or not month:
         year = current_date.year
         month = current_date.month
@@ -1381,10 +3301,10 @@ async def show_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, year
             logger.error(f"Ошибка при удалении сообщения с инструкцией: {e}")
 
     # Генерируем календарь для ОДНОГО месяца
-    calendar_keyboard = generate_single_month_calendar(year, month)
+    calendar_keyboard = generate_single_month_calendar(year, month, current_date.tzinfo)
 
     # Добавляем навигацию
-    navigation = get_calendar_navigation(year, month)
+    navigation = get_calendar_navigation(year, month, current_date.tzinfo)
     calendar_keyboard.extend(navigation)
 
     # Отправляем сообщение с ОДНИМ календарем
@@ -1441,8 +3361,8 @@ async def handle_calendar_selection(update: Update, context: ContextTypes.DEFAUL
         month = int(month_str)
         day = int(day_str)
 
-        selected_date = datetime(year, month, day).replace(tzinfo=MOSCOW_TZ)
-        today = datetime.now(MOSCOW_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+        today = user_now(update.effective_user.id).replace(hour=0, minute=0, second=0, microsecond=0)
+        selected_date = datetime(year, month, day, tzinfo=today.tzinfo)
 
         # Вычисляем количество дней до выбранной даты
         days_difference = (selected_date - today).days
@@ -1478,8 +3398,9 @@ async def handle_calendar_selection(update: Update, context: ContextTypes.DEFAUL
         context.user_data['calendar_month'] = month
 
         # Генерируем новый календарь для ОДНОГО месяца
-        calendar_keyboard = generate_single_month_calendar(year, month)
-        navigation = get_calendar_navigation(year, month)
+        tz = user_timezone(update.effective_user.id)
+        calendar_keyboard = generate_single_month_calendar(year, month, tz)
+        navigation = get_calendar_navigation(year, month, tz)
         calendar_keyboard.extend(navigation)
 
         # Редактируем текущее сообщение
@@ -1554,7 +3475,7 @@ async def handle_back_to_calendar_from_time(update: Update, context: ContextType
 
     if not year or not month:
         # Если нет сохраненных значений, используем текущий месяц
-        current_date = datetime.now(MOSCOW_TZ)
+        current_date = user_now(update.effective_user.id)
         year = current_date.year
         month = current_date.month
 
@@ -1565,8 +3486,9 @@ async def handle_back_to_calendar_from_time(update: Update, context: ContextType
         logger.error(f"Ошибка при удалении сообщения с вводом времени: {e}")
 
     # Генерируем календарь для ОДНОГО месяца
-    calendar_keyboard = generate_single_month_calendar(year, month)
-    navigation = get_calendar_navigation(year, month)
+    tz = user_timezone(update.effective_user.id)
+    calendar_keyboard = generate_single_month_calendar(year, month, tz)
+    navigation = get_calendar_navigation(year, month, tz)
     calendar_keyboard.extend(navigation)
 
     message = await query.message.reply_text(
@@ -1602,8 +3524,8 @@ async def handle_reminder_day(update: Update, context: ContextTypes.DEFAULT_TYPE
             await cancel_reminder(update, context)
         return ConversationHandler.END
 
-    # Обработка выбора предопределенных дней
-    today = datetime.now(MOSCOW_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    # Обработка выбора предопределенных дней (в поясе пользователя)
+    today = user_now(update.effective_user.id).replace(hour=0, minute=0, second=0, microsecond=0)
 
     if data in ["day_today", "day_tomorrow", "day_after_tomorrow"]:
         days_to_add = {
@@ -1635,7 +3557,7 @@ async def handle_days_input(update, context, data, is_callback, query):
         if days < 0:
             raise ValueError("Количество дней не может быть отрицательным")
 
-        today = datetime.now(MOSCOW_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+        today = user_now(update.effective_user.id).replace(hour=0, minute=0, second=0, microsecond=0)
         context.user_data['reminder_date'] = today + timedelta(days=days)
         context.user_data.pop('waiting_for_days_input', None)  # Снимаем флаг
         logger.info(f"Выбран день: через {days} дней")
@@ -1678,17 +3600,9 @@ async def handle_invalid_day_selection(update, context, data, is_callback):
                 logger.error(f"Ошибка при удалении сообщения с инструкцией: {e}")
 
         # Показываем основное меню выбора дня с ошибкой
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         message = await update.message.reply_text(
             "❌ Неверный выбор. Выберите день из списка:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
         context.user_data['instruction_message_id'] = message.message_id
         return ADD_DAY
@@ -1802,17 +3716,9 @@ async def handle_reminder_interval(update: Update, context: ContextTypes.DEFAULT
     # Обработка возврата к выбору дня - РЕДАКТИРУЕМ СООБЩЕНИЕ
     if data == "back_to_day_selection":
         # РЕДАКТИРУЕМ текущее сообщение вместо отправки нового
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         await query.edit_message_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
 
         # Обновляем ID сообщения с инструкцией
@@ -1869,11 +3775,11 @@ async def handle_reminder_users(update: Update, context: ContextTypes.DEFAULT_TY
             reminder = {
                 'id': reminder_id,
                 'text': context.user_data.get('reminder_text', 'Без текста'),
-                'datetime': context.user_data['reminder_time'].isoformat(),
+                'datetime': int(context.user_data['reminder_time'].timestamp()),
                 'interval_days': context.user_data.get('reminder_interval', 0),
                 'users': selected_users,
                 'created_by': str(query.from_user.id),
-                'created_at': datetime.now(MOSCOW_TZ).isoformat(),
+                'created_at': datetime.now(DEFAULT_TZ).isoformat(),
                 'type': 'personal',
                 'confirmed_by': set(),
                 'postponed_by': set(),
@@ -1883,7 +3789,7 @@ async def handle_reminder_users(update: Update, context: ContextTypes.DEFAULT_TY
             }
 
             reminders[reminder_id] = reminder
-            if not save_reminders(reminders):
+            if not await save_reminders(reminders):
                 logger.error("Ошибка при записи напоминаний в файл reminders.json")
                 await query.edit_message_text(
                     "❌ Ошибка при создании напоминания. Проверьте права доступа к файлу reminders.json.",
@@ -1913,18 +3819,9 @@ async def handle_reminder_users(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif data == "back_to_interval":
         # Возврат к выбору интервала - РЕДАКТИРУЕМ СООБЩЕНИЕ
-        keyboard = [
-            [InlineKeyboardButton("Однократно", callback_data="interval_0")],
-            [InlineKeyboardButton("Каждый день", callback_data="interval_1")],
-            [InlineKeyboardButton("Каждые 3 дня", callback_data="interval_3")],
-            [InlineKeyboardButton("Каждую неделю", callback_data="interval_7")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_day_selection")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
-
         await query.edit_message_text(
             "🔄 Выберите интервал повторения:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=INTERVAL_KEYBOARD
         )
         return ADD_INTERVAL
 
@@ -1967,7 +3864,12 @@ async def handle_reminders_pagination(update: Update, context: ContextTypes.DEFA
         await query.answer()
         return
 
-    if data.startswith('regular_page_'):
+    cursor = parse_reminders_page_cursor(context.args or [])
+    if cursor:
+        # Курсор: страница начинается сразу после/перед последним показанным напоминанием
+        context.user_data['reminders_list_type'] = cursor[0]
+        context.user_data['reminders_cursor'] = cursor
+    elif data.startswith('regular_page_'):
         page = int(data.replace("regular_page_", ""))
         context.user_data['regular_page'] = page
         context.user_data['reminders_list_type'] = 'regular'
@@ -2046,14 +3948,16 @@ async def my_reminders_for_deletion(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
 
-    reminders = load_reminders()
     user_id = str(query.from_user.id)
 
-    # Фильтруем напоминания: только обычные и только созданные текущим пользователем
-    user_reminders = {
-        rid: rem for rid, rem in reminders.items()
-        if rem.get('created_by') == user_id and rem.get('type') != 'ingredient'
-    }
+    # Только обычные напоминания, созданные текущим пользователем: записи берутся прямо по индексу автора
+    own_reminders = []
+    for rid in await repository.find_ids('reminders', 'created_by', user_id):
+        reminder = repository.get('reminders', rid)
+        if reminder is not None and reminder.get('type') != 'ingredient':
+            own_reminders.append((rid, reminder))
+    own_reminders.sort(key=lambda item: reminder_sort_key(*item))
+    user_reminders = dict(own_reminders)
 
     if not user_reminders:
         await query.edit_message_text(
@@ -2073,8 +3977,8 @@ async def my_reminders_for_deletion(update: Update, context: ContextTypes.DEFAUL
         # Обрезаем длинный текст для кнопки
         button_text = reminder['text'][:35] + "..." if len(reminder['text']) > 35 else reminder['text']
 
-        # Добавляем дату для информации
-        reminder_time = datetime.fromisoformat(reminder['datetime']).strftime('%d.%m %H:%M')
+        # Добавляем дату для информации (в поясе пользователя)
+        reminder_time = local_time(reminder.due_ts, user_timezone(user_id)).strftime('%d.%m %H:%M')
 
         # Создаем кнопку с названием напоминания
         keyboard.append([
@@ -2141,7 +4045,7 @@ async def handle_delete_reminder(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     # Показываем подтверждение удаления
-    reminder_time = datetime.fromisoformat(reminder['datetime']).strftime('%d.%m.%Y %H:%M')
+    reminder_time = local_time(reminder.due_ts, user_timezone(query.from_user.id)).strftime('%d.%m.%Y %H:%M')
     interval_text = "однократно" if reminder.get('interval_days', 0) == 0 else f"каждые {reminder['interval_days']} дней"
 
     text = f"🗑 *Подтверждение удаления*\n\n"
@@ -2198,21 +4102,15 @@ async def handle_custom_day_selection(update: Update, context: ContextTypes.DEFA
 
     elif data == "back_to_day_selection":
         # Возврат к выбору дня - РЕДАКТИРУЕМ текущее сообщение
-        keyboard = [
-            [InlineKeyboardButton("Сегодня", callback_data="day_today")],
-            [InlineKeyboardButton("Завтра", callback_data="day_tomorrow")],
-            [InlineKeyboardButton("Послезавтра", callback_data="day_after_tomorrow")],
-            [InlineKeyboardButton("Другое", callback_data="day_custom")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reminder")]
-        ]
         await query.edit_message_text(
             "📅 Выберите день для напоминания:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DAY_SELECTION_KEYBOARD
         )
         return ADD_DAY
 
     return ADD_DAY_CUSTOM
 
+@locked_callback('reminder', callback_suffix("confirm_delete_"))
 async def handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка окончательного подтверждения удаления"""
     query = update.callback_query
@@ -2237,7 +4135,7 @@ async def handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Удаляем напоминание
     del reminders[reminder_id]
-    if not save_reminders(reminders):
+    if not await save_reminders(reminders):
         logger.error("Ошибка при удалении напоминания")
         await query.edit_message_text(
             "❌ Ошибка при удалении напоминания.",
@@ -2390,9 +4288,8 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Показать разделенные списки напоминаний с пагинацией"""
     query = update.callback_query
     await query.answer()
-    reminders = load_reminders()
 
-    if not reminders:
+    if not repository.collection('reminders'):
         await query.edit_message_text(
             "❌ Нет активных напоминаний.",
             reply_markup=InlineKeyboardMarkup([
@@ -2405,35 +4302,39 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Определяем тип списка (обычные или ингредиенты)
     list_type = context.user_data.get('reminders_list_type', 'regular')
 
-    # Разделяем напоминания
-    regular_reminders = {rid: rem for rid, rem in reminders.items() if rem.get('type') != 'ingredient'}
-    ingredient_reminders = {rid: rem for rid, rem in reminders.items() if rem.get('type') == 'ingredient'}
-
     # Выбираем активный список
     if list_type == 'regular':
-        active_reminders = list(regular_reminders.items())
         list_title = "📋 Обычные напоминания"
         page_key = 'regular_page'
     else:
-        active_reminders = list(ingredient_reminders.items())
         list_title = "🍽 Напоминания для блюд"
         page_key = 'ingredients_page'
 
-    items_per_page = 5
-    page = context.user_data.get(page_key, 0)
-    total_pages = max(1, (len(active_reminders) + items_per_page - 1) // items_per_page)
-
-    # Корректируем номер страницы, если он выходит за пределы
-    if page >= total_pages:
-        page = total_pages - 1
-        context.user_data[page_key] = page
+    items_per_page = REMINDERS_PER_PAGE
+
+    # Страница по курсору из кнопки или по сохраненному номеру страницы
+    cursor = context.user_data.pop('reminders_cursor', None)
+    if cursor and cursor[0] == list_type:
+        direction, key = cursor[1], cursor[2]
+        start_idx, current_reminders, total = reminder_list_index.page(
+            list_type,
+            after=key if direction == 'next' else None,
+            before=key if direction == 'prev' else None,
+            limit=items_per_page
+        )
+    else:
+        start_idx, current_reminders, total = reminder_list_index.page(
+            list_type, offset=context.user_data.get(page_key, 0) * items_per_page, limit=items_per_page
+        )
 
-    # Получаем напоминания для текущей страницы
-    start_idx = page * items_per_page
-    end_idx = start_idx + items_per_page
-    current_reminders = active_reminders[start_idx:end_idx]
+    total_pages = max(1, (total + items_per_page - 1) // items_per_page)
+    page = min((start_idx + items_per_page - 1) // items_per_page, total_pages - 1)
+    context.user_data[page_key] = page
+    end_idx = start_idx + len(current_reminders)
 
     text = f"{list_title} (страница {page + 1}/{total_pages})\n\n"
+    now = now_ts()
+    viewer_tz = user_timezone(update.effective_user.id)
 
     # Инициализируем клавиатуру
     keyboard = []
@@ -2471,12 +4372,9 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     text += f"👤 *Ответственный:* {responsible_info}\n"
 
                 # Статус срочного напоминания
-                if reminder.get('urgent_reminders'):
-                    urgent_until = reminder.get('urgent_until')
-                    if urgent_until:
-                        urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                        time_left = urgent_until_time - datetime.now(MOSCOW_TZ)
-                        hours_left = max(0, int(time_left.total_seconds() / 3600))
+                if reminder.urgent_reminders:
+                    if reminder.urgent_until_ts:
+                        hours_left = max(0, (reminder.urgent_until_ts - now) // 3600)
                         text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n"
                     else:
                         text += "🚨 *СРОЧНОЕ* (каждые 3 часа)\n"
@@ -2487,15 +4385,12 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 text += f"🔔 *{reminder['text'][:80]}...*\n" if len(reminder['text']) > 80 else f"🔔 *{reminder['text']}*\n"
                 interval_text = "однократно" if reminder.get('interval_days', 0) == 0 else f"каждые {reminder['interval_days']} дней"
                 text += f"🔄 {interval_text}\n"
-                text += f"⏰ {datetime.fromisoformat(reminder['datetime']).strftime('%d.%m.%Y %H:%M')}\n"
+                text += f"⏰ {local_time(reminder.due_ts, viewer_tz).strftime('%d.%m.%Y %H:%M')}\n"
 
                 # УЛУЧШЕННОЕ ОТОБРАЖЕНИЕ СРОЧНЫХ НАПОМИНАНИЙ
-                if reminder.get('urgent_reminders'):
-                    urgent_until = reminder.get('urgent_until')
-                    if urgent_until:
-                        urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                        time_left = urgent_until_time - datetime.now(MOSCOW_TZ)
-                        hours_left = max(0, int(time_left.total_seconds() / 3600))
+                if reminder.urgent_reminders:
+                    if reminder.urgent_until_ts:
+                        hours_left = max(0, (reminder.urgent_until_ts - now) // 3600)
                         text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n"
                     else:
                         text += "🚨 *СРОЧНОЕ* (каждые 3 часа)\n"
@@ -2512,14 +4407,18 @@ async def list_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Кнопки пагинации
     pagination_buttons = []
-    if page > 0:
-        pagination_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{list_type}_page_{page-1}"))
+    if start_idx > 0 and current_reminders:
+        first_id, first_reminder = current_reminders[0]
+        pagination_buttons.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=reminders_page_callback(list_type, 'prev', reminder_sort_key(first_id, first_reminder))))
 
     # Добавляем номер текущей страницы (опционально)
     pagination_buttons.append(InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data="current_page"))
 
-    if end_idx < len(active_reminders):
-        pagination_buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"{list_type}_page_{page+1}"))
+    if end_idx < total and current_reminders:
+        last_id, last_reminder = current_reminders[-1]
+        pagination_buttons.append(InlineKeyboardButton(
+            "Вперёд ➡️", callback_data=reminders_page_callback(list_type, 'next', reminder_sort_key(last_id, last_reminder))))
 
     if pagination_buttons:
         keyboard.append(pagination_buttons)
@@ -2872,7 +4771,7 @@ async def handle_recipe_confirmation(update: Update, context: ContextTypes.DEFAU
                 'name': context.user_data.get('recipe_name', 'Без названия'),
                 'ingredients': context.user_data.get('ingredients', []),
                 'created_by': str(query.from_user.id),
-                'created_at': datetime.now(MOSCOW_TZ).isoformat()
+                'created_at': datetime.now(DEFAULT_TZ).isoformat()
             }
 
             if not recipe['name'] or not recipe['ingredients']:
@@ -2886,7 +4785,7 @@ async def handle_recipe_confirmation(update: Update, context: ContextTypes.DEFAU
                 return RECIPE_INGREDIENTS
 
             recipes[recipe_id] = recipe
-            if save_recipes(recipes):
+            if await save_recipes(recipes):
                 logger.info(f"Рецепт сохранен: {recipe['name']} (ID: {recipe_id})")
                 await query.edit_message_text(
                     "✅ Рецепт успешно сохранен!",
@@ -3139,7 +5038,7 @@ async def handle_day_selection(update: Update, context: ContextTypes.DEFAULT_TYP
 
     day_name = WEEK_DAYS[day_key]
 
-    today = datetime.now(MOSCOW_TZ)
+    today = datetime.now(DEFAULT_TZ)
     current_weekday = today.weekday()
     target_weekday = list(WEEK_DAYS.keys()).index(day_key)
 
@@ -3229,7 +5128,7 @@ async def handle_recipe_selection(update: Update, context: ContextTypes.DEFAULT_
         'recipe_name': recipe['name'],
         'date': context.user_data['meal_date'],
         'date_str': context.user_data['meal_date_str'],
-        'ingredients': recipe['ingredients'].copy(),
+        'ingredients': [ingredient.copy() for ingredient in recipe['ingredients']],
         'day': context.user_data['meal_day']
     }
 
@@ -3410,8 +5309,12 @@ async def handle_user_selection_for_ingredient(update: Update, context: ContextT
         meal_plans = load_meal_plans()
         if plan_id in meal_plans:
             meal_plans[plan_id]['ingredients'] = meal_plan['ingredients']
-            meal_plans[plan_id]['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
-            save_meal_plans(meal_plans)
+            meal_plans[plan_id]['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
+            if await save_meal_plans(meal_plans):
+                # Черновик теперь основан на только что сохраненной версии плана
+                meal_plan['version'] = meal_plans[plan_id]['version']
+            else:
+                logger.error(f"❌ Не удалось сохранить распределение плана {plan_id}")
 
     # Возвращаемся к соответствующему экрану
     if context.user_data.get('editing_plan_id'):
@@ -3514,12 +5417,8 @@ async def save_meal_plan_without_notifications(update_or_query, context):
         meal_plan = context.user_data['meal_plan']
         meal_plan_id = str(int(datetime.now().timestamp()))
 
-        # Преобразуем datetime в строку для сохранения в JSON
-        meal_date = meal_plan['date']
-        if hasattr(meal_date, 'strftime'):
-            meal_date_str = meal_date.isoformat()
-        else:
-            meal_date_str = meal_date
+        # Дата приготовления хранится в секундах UTC, как и остальное время в хранилище
+        meal_ts = _parse_epoch(meal_plan['date'])
 
         meal_plan['id'] = meal_plan_id
 
@@ -3529,14 +5428,14 @@ async def save_meal_plan_without_notifications(update_or_query, context):
         else:
             meal_plan['created_by'] = str(update_or_query.message.from_user.id)
 
-        meal_plan['created_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        meal_plan['created_at'] = datetime.now(DEFAULT_TZ).isoformat()
         meal_plan['with_notifications'] = False
-        meal_plan['date'] = meal_date_str  # Сохраняем как строку
+        meal_plan['date'] = meal_ts
 
         meal_plans = load_meal_plans()
         meal_plans[meal_plan_id] = meal_plan
 
-        if not save_meal_plans(meal_plans):
+        if not await save_meal_plans(meal_plans):
             logger.error("Ошибка при записи плана питания в файл meal_plans.json")
             text = "❌ Ошибка при сохранении плана питания. Проверьте права доступа к файлу meal_plans.json."
             keyboard = [[InlineKeyboardButton("🔙 На главную", callback_data="back_to_main")]]
@@ -3596,12 +5495,8 @@ async def save_meal_plan_with_notifications(update_or_query, context):
         meal_plan = context.user_data['meal_plan']
         meal_plan_id = str(int(datetime.now().timestamp()))
 
-        # Преобразуем datetime в строку для сохранения в JSON
-        meal_date = meal_plan['date']
-        if hasattr(meal_date, 'strftime'):
-            meal_date_str = meal_date.isoformat()
-        else:
-            meal_date_str = meal_date
+        # Дата приготовления хранится в секундах UTC, как и остальное время в хранилище
+        meal_ts = _parse_epoch(meal_plan['date'])
 
         meal_plan['id'] = meal_plan_id
 
@@ -3611,15 +5506,15 @@ async def save_meal_plan_with_notifications(update_or_query, context):
         else:
             meal_plan['created_by'] = str(update_or_query.message.from_user.id)
 
-        meal_plan['created_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        meal_plan['created_at'] = datetime.now(DEFAULT_TZ).isoformat()
         meal_plan['with_notifications'] = True
         meal_plan['notification_time'] = meal_plan.get('notification_time', '1_day')
-        meal_plan['date'] = meal_date_str  # Сохраняем как строку
+        meal_plan['date'] = meal_ts
 
         meal_plans = load_meal_plans()
         meal_plans[meal_plan_id] = meal_plan
 
-        if not save_meal_plans(meal_plans):
+        if not await save_meal_plans(meal_plans):
             logger.error("Ошибка при записи плана питания в файл meal_plans.json")
             text = "❌ Ошибка при сохранении плана питания. Проверьте права доступа к файлу meal_plans.json."
             keyboard = [[InlineKeyboardButton("🔙 На главную", callback_data="back_to_main")]]
@@ -3677,6 +5572,13 @@ async def save_meal_plan_with_notifications(update_or_query, context):
         else:
             await update_or_query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
+def plan_cook_time(plan):
+    """Дата приготовления плана как datetime в общем поясе (в черновике мастера - уже datetime)"""
+    value = plan['date']
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=DEFAULT_TZ)
+    return local_time(_parse_epoch(value))
+
 async def create_ingredient_reminders(meal_plan, application):
     """Создание напоминаний для ингредиентов с привязкой к плану питания"""
     try:
@@ -3684,10 +5586,7 @@ async def create_ingredient_reminders(meal_plan, application):
         reminders = load_reminders()
         users = load_users()
 
-        # Восстанавливаем дату из строки если нужно
-        meal_date = meal_plan['date']
-        if isinstance(meal_date, str):
-            meal_date = datetime.fromisoformat(meal_date)
+        meal_date = plan_cook_time(meal_plan)
 
         notification_time = meal_plan.get('notification_time', '1_day')
 
@@ -3702,7 +5601,7 @@ async def create_ingredient_reminders(meal_plan, application):
         reminder_date = meal_date - timedelta(days=days_before)
 
         # Текущее время для сравнения
-        current_time = datetime.now(MOSCOW_TZ)
+        current_time = datetime.now(DEFAULT_TZ)
 
         # Если дата напоминания уже прошла, устанавливаем на сегодня в удобное время
         if reminder_date.date() < current_time.date():
@@ -3711,23 +5610,23 @@ async def create_ingredient_reminders(meal_plan, application):
             logger.info(f"⏰ Дата напоминания прошла, установлено на сегодня: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}")
         elif reminder_date.date() == current_time.date():
             # Если напоминание должно быть сегодня, проверяем время
-            reminder_datetime = reminder_date.replace(hour=10, minute=0, second=0)
+            reminder_datetime = ingredient_reminder_time(meal_plan, reminder_date)
             if reminder_datetime < current_time:
-                # Если 10:00 уже прошло, устанавливаем на ближайшие 5 минут
+                # Если время уже прошло, устанавливаем на ближайшие 5 минут
                 reminder_datetime = current_time + timedelta(minutes=5)
                 logger.info(f"⏰ Время напоминания прошло, установлено на ближайшие минуты: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}")
             else:
-                logger.info(f"⏰ Напоминание установлено на сегодня в 10:00: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}")
+                logger.info(f"⏰ Напоминание установлено на сегодня: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}")
         else:
-            # Напоминание в будущем - устанавливаем на 10:00
-            reminder_datetime = reminder_date.replace(hour=10, minute=0, second=0)
+            # Напоминание в будущем - в 10:00 (с разбросом) или во время, выбранное для плана
+            reminder_datetime = ingredient_reminder_time(meal_plan, reminder_date)
             logger.info(f"⏰ Напоминание установлено на будущее: {reminder_datetime.strftime('%d.%m.%Y %H:%M')}")
 
         # УДАЛЯЕМ СТАРЫЕ НАПОМИНАНИЯ ДЛЯ ЭТОГО ПЛАНА (если они есть)
-        reminders_to_delete = []
-        for reminder_id, reminder in reminders.items():
-            if reminder.get('meal_plan_id') == meal_plan['id'] and reminder.get('type') == 'ingredient':
-                reminders_to_delete.append(reminder_id)
+        reminders_to_delete = [
+            reminder_id for reminder_id in await repository.find_ids('reminders', 'meal_plan_id', meal_plan['id'])
+            if reminder_id in reminders and reminders[reminder_id].get('type') == 'ingredient'
+        ]
 
         for reminder_id in reminders_to_delete:
             del reminders[reminder_id]
@@ -3759,11 +5658,11 @@ async def create_ingredient_reminders(meal_plan, application):
                 reminder = {
                     'id': reminder_id,
                     'text': reminder_text,
-                    'datetime': reminder_datetime.isoformat(),
+                    'datetime': int(reminder_datetime.timestamp()),
                     'interval_days': 0,
                     'users': [ingredient['assigned_to']],
                     'created_by': meal_plan['created_by'],
-                    'created_at': datetime.now(MOSCOW_TZ).isoformat(),
+                    'created_at': datetime.now(DEFAULT_TZ).isoformat(),
                     'type': 'ingredient',
                     'meal_plan_id': meal_plan['id'],
                     'ingredient_id': ingredient['id'],
@@ -3785,7 +5684,7 @@ async def create_ingredient_reminders(meal_plan, application):
                 logger.info(f"Создано напоминание для ингредиента: {ingredient['name']} → {assigned_username} (время: {reminder_datetime.strftime('%d.%m.%Y %H:%M')})")
 
         if reminders_created > 0:
-            if not save_reminders(reminders):
+            if not await save_reminders(reminders):
                 logger.error("Ошибка при записи напоминаний в файл reminders.json")
                 return 0
             logger.info(f"Создано {reminders_created} напоминаний для плана питания {meal_plan['id']}")
@@ -3797,6 +5696,11 @@ async def create_ingredient_reminders(meal_plan, application):
         return 0
 
 async def create_next_week_meal_plan(application, current_plan_id):
+    """Создает план на следующую неделю под блокировкой исходного плана (без дублей при параллельных вызовах)"""
+    async with entity_locks.get('plan', current_plan_id):
+        return await _create_next_week_meal_plan(application, current_plan_id)
+
+async def _create_next_week_meal_plan(application, current_plan_id):
     """Создает копию плана питания на следующую неделю с СОХРАНЕНИЕМ распределения ингредиентов"""
     try:
         meal_plans = load_meal_plans()
@@ -3820,9 +5724,7 @@ async def create_next_week_meal_plan(application, current_plan_id):
             return None
 
         # Получаем текущую дату плана
-        current_plan_date = current_plan['date']
-        if isinstance(current_plan_date, str):
-            current_plan_date = datetime.fromisoformat(current_plan_date)
+        current_plan_date = plan_cook_time(current_plan)
 
         # Вычисляем дату на следующую неделю (тот же день недели)
         next_week_date = current_plan_date + timedelta(days=7)
@@ -3830,9 +5732,9 @@ async def create_next_week_meal_plan(application, current_plan_id):
 
         # Проверяем, существует ли уже план на следующую неделю для этого рецепта
         existing_plan_id = None
-        for plan_id, plan in meal_plans.items():
-            if (plan.get('recipe_id') == current_plan.get('recipe_id') and
-                plan.get('date_str') == next_week_date_str and
+        for plan_id in await repository.find_ids('meal_plans', 'recipe_id', current_plan.get('recipe_id')):
+            plan = meal_plans.get(plan_id)
+            if (plan and plan.get('date_str') == next_week_date_str and
                 plan_id != current_plan_id):
                 existing_plan_id = plan_id
                 logger.info(f"✅ План на следующую неделю уже существует: {existing_plan_id}")
@@ -3843,7 +5745,7 @@ async def create_next_week_meal_plan(application, current_plan_id):
             # УДАЛЯЕМ ТЕКУЩИЙ ПЛАН (если он еще существует)
             if current_plan_id in meal_plans:
                 del meal_plans[current_plan_id]
-                if save_meal_plans(meal_plans):
+                if await save_meal_plans(meal_plans):
                     logger.info(f"🗑 Старый план {current_plan_id} удален, используется существующий {existing_plan_id}")
                 else:
                     logger.error(f"❌ Ошибка при удалении старого плана {current_plan_id}")
@@ -3857,12 +5759,12 @@ async def create_next_week_meal_plan(application, current_plan_id):
             'id': new_plan_id,
             'recipe_id': current_plan['recipe_id'],
             'recipe_name': current_plan['recipe_name'],
-            'date': next_week_date.isoformat(),
+            'date': int(next_week_date.timestamp()),
             'date_str': next_week_date_str,
             'day': current_plan['day'],
             'ingredients': [],
             'created_by': current_plan.get('created_by', 'unknown'),
-            'created_at': datetime.now(MOSCOW_TZ).isoformat(),
+            'created_at': datetime.now(DEFAULT_TZ).isoformat(),
             'is_auto_created': True,
             'with_notifications': current_plan.get('with_notifications', False),
             'notification_time': current_plan.get('notification_time', '1_day')
@@ -3885,7 +5787,7 @@ async def create_next_week_meal_plan(application, current_plan_id):
         # Сохраняем новый план
         meal_plans[new_plan_id] = new_plan
 
-        if not save_meal_plans(meal_plans):
+        if not await save_meal_plans(meal_plans):
             logger.error("❌ Ошибка при сохранении плана на следующую неделю")
             return None
 
@@ -3909,199 +5811,169 @@ async def create_next_week_meal_plan(application, current_plan_id):
         logger.error(f"❌ Критическая ошибка при создании плана на следующую неделю: {e}")
         return None
 
-async def check_ingredient_reminders(application):
-    """Проверка и отправка напоминаний для ингредиентов с замещением срочных сообщений"""
-    try:
-        reminders = load_reminders()
-        current_time = datetime.now(MOSCOW_TZ)
-
-        # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ
-        current_hour = current_time.hour
-        is_night_time = current_hour >= 23 or current_hour < 9
-
-        ingredient_reminders = {rid: rem for rid, rem in reminders.items()
-                              if rem.get('type') == 'ingredient'}
+# Сколько отрисованных уведомлений хранится в кэше
+RENDER_CACHE_SIZE = 2048
+
+class RenderCache:
+    """Кэш отрисованных уведомлений: (reminder_id, версия, вариант) -> (текст, клавиатура)
+
+    Записи напоминания сбрасываются при его изменении (подписка на хранилище),
+    все записи - при изменении пользователей: их имена есть в тексте.
+    """
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = {}
+        self._keys_by_reminder = {}
+
+    def notify(self, name, record_id):
+        """Слушатель хранилища"""
+        if name == 'reminders':
+            self.invalidate(record_id)
+        elif name == 'users':
+            self.clear()
+
+    def invalidate(self, reminder_id):
+        for key in self._keys_by_reminder.pop(str(reminder_id), ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_reminder.clear()
+
+    def get_or_render(self, reminder, variant, render):
+        """Возвращает отрисовку из кэша или строит ее вызовом render()"""
+        reminder_id = str(reminder['id'])
+        key = (reminder_id, reminder.version, variant)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = render()
+            if len(self._entries) >= self.max_size:
+                # Вытесняем самую старую запись
+                oldest = next(iter(self._entries))
+                del self._entries[oldest]
+                keys = self._keys_by_reminder.get(oldest[0])
+                if keys is not None:
+                    keys.discard(oldest)
+                    if not keys:
+                        del self._keys_by_reminder[oldest[0]]
+            self._entries[key] = entry
+            self._keys_by_reminder.setdefault(reminder_id, set()).add(key)
+        return entry
+
+render_cache = RenderCache()
+repository.add_listener(render_cache.notify)
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def notification_keyboard(reminder_id):
+    """Кнопки "Купил" / "Еще не купил" уведомления (неизменяемы, строятся один раз на напоминание)"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Купил", callback_data=callback_data("bought", reminder_id)),
+            InlineKeyboardButton("❌ Еще не купил", callback_data=callback_data("not_bought", reminder_id))
+        ]
+    ])
 
-        if not ingredient_reminders:
-            return 0
+def urgent_hours_left(reminder, now):
+    """Сколько часов осталось срочному режиму (None - режим без срока или не срочное)"""
+    if not reminder.urgent_reminders or not reminder.urgent_until_ts:
+        return None
+    return max(0, (reminder.urgent_until_ts - now) // 3600)
 
-        sent_count = 0
-        reminders_to_remove = []
+def render_ingredient_notification(reminder, is_missed, hours_left):
+    """Текст и кнопки уведомления о покупке ингредиента"""
+    # Базовый текст
+    if is_missed:
+        message_text = f"⏰ *ПРОПУЩЕННОЕ НАПОМИНАНИЕ О ПОКУПКЕ!*\n\n"
+    else:
+        message_text = f"🛒 *НАПОМИНАНИЕ О ПОКУПКЕ!*\n\n"
 
-        for reminder_id, reminder in ingredient_reminders.items():
-            try:
-                # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ ДЛЯ СРОЧНЫХ НАПОМИНАНИЙ ИНГРЕДИЕНТОВ
-                if is_night_time and reminder.get('urgent_reminders'):
-                    logger.info(f"🌙 Пропущена проверка срочного ингредиента в ночное время: {reminder_id}")
-                    continue
-                # ПРОВЕРКА: УДАЛЕНИЕ ИНГРЕДИЕНТОВ ПОСЛЕ НАСТУПЛЕНИЯ ДНЯ ПРИГОТОВЛЕНИЯ
-                meal_date_str = reminder.get('meal_date')
-                if meal_date_str:
-                    try:
-                        # Парсим дату приготовления (формат: DD.MM.YYYY)
-                        meal_date = datetime.strptime(meal_date_str, '%d.%m.%Y').replace(tzinfo=MOSCOW_TZ)
-
-                        # Если дата приготовления уже прошла (учитываем начало дня)
-                        if meal_date.date() < current_time.date():
-                            # УДАЛЯЕМ НАПОМИНАНИЕ И СООБЩЕНИЯ ВНЕ ЗАВИСИМОСТИ ОТ СРОЧНОГО РЕЖИМА
-                            reminders_to_remove.append(reminder_id)
-                            await delete_old_reminder_messages(application, reminder_id)
-                            logger.info(f"🗑 Напоминание ингредиента {reminder_id} удалено после наступления дня приготовления")
-                            continue
-                    except ValueError as e:
-                        logger.error(f"❌ Ошибка парсинга даты приготовления {meal_date_str}: {e}")
-
-                reminder_time = datetime.fromisoformat(reminder['datetime']).replace(tzinfo=MOSCOW_TZ)
-                time_diff_minutes = (reminder_time - current_time).total_seconds() / 60
-
-                # ПРОВЕРКА ИСТЕЧЕНИЯ СРОЧНОГО РЕЖИМА ДЛЯ ИНГРЕДИЕНТОВ (только если день приготовления еще не наступил)
-                urgent_until = reminder.get('urgent_until')
-                if urgent_until:
-                    urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                    if current_time > urgent_until_time:
-                        # СРОЧНЫЙ РЕЖИМ ИСТЕК - но для ингредиентов мы НЕ удаляем напоминание,
-                        # а только снимаем срочный режим, так как удаление происходит по дате приготовления
-                        reminder['urgent_reminders'] = False
-                        reminder['urgent_until'] = None
-                        reminder['last_sent'] = None
-                        logger.info(f"🔄 Срочный режим истек для ингредиента {reminder_id}, но напоминание остается до дня приготовления")
-                        # Продолжаем обработку для обычного режима
-
-                should_send = False
-                send_reason = ""
-                is_urgent_update = False  # Флаг для замещения сообщений
-
-                # Для срочных напоминаний ингредиентов (только если день приготовления еще не наступил)
-                if reminder.get('urgent_reminders'):
-                    last_sent = reminder.get('last_sent')
+    # Текст напоминания
+    message_text += f"{reminder['text']}\n\n"
 
-                    if not last_sent:
-                        should_send = True
-                        send_reason = "первое срочное напоминание ингредиента"
-                        is_urgent_update = True
-                    else:
-                        last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                        hours_since_last = (current_time - last_sent_time).total_seconds() / 3600
-
-                        if hours_since_last >= 3:
-                            should_send = True
-                            send_reason = f"срочное напоминание ингредиента (прошло {hours_since_last:.1f} ч.)"
-                            is_urgent_update = True  # ВКЛЮЧАЕМ ЗАМЕЩЕНИЕ ДЛЯ ПОВТОРНЫХ СРОЧНЫХ
-
-                # Для обычных напоминаний ингредиентов
-                elif not reminder.get('urgent_reminders'):
-                    last_sent = reminder.get('last_sent')
-
-                    # Если напоминание уже отправлялось сегодня, пропускаем
-                    if last_sent:
-                        last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                        if last_sent_time.date() == current_time.date():
-                            continue
-
-                    # Отправляем если время напоминания в пределах ±30 минут
-                    if -30 <= time_diff_minutes <= 30:
-                        should_send = True
-                        send_reason = "обычное напоминание ингредиента"
-
-                if should_send:
-                    logger.info(f"⏰ ОТПРАВКА ИНГРЕДИЕНТА ({send_reason}): {reminder['text'][:50]}...")
-
-                    # ОТПРАВЛЯЕМ С ФЛАГОМ ЗАМЕЩЕНИЯ ДЛЯ СРОЧНЫХ НАПОМИНАНИЙ
-                    await send_ingredient_reminder_notification(application, reminder, is_urgent_update=is_urgent_update)
-                    sent_count += 1
-
-                    reminder['last_sent'] = current_time.isoformat()
-
-                    # Для срочных напоминаний планируем следующее
-                    if reminder.get('urgent_reminders'):
-                        next_time = current_time + timedelta(hours=3)
-                        if next_time.hour >= 23 or next_time.hour < 9:
-                            next_time = next_time.replace(hour=9, minute=0, second=0)
-                            if next_time <= current_time:
-                                next_time += timedelta(days=1)
-                        reminder['datetime'] = next_time.isoformat()
-                        logger.info(f"🔁 Следующее срочное напоминание ингредиента через 3 часа: {next_time.strftime('%d.%m.%Y %H:%M')}")
+    # Информация о срочности
+    if reminder.urgent_reminders:
+        if hours_left is not None:
+            message_text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n\n"
+        else:
+            message_text += "🚨 *СРОЧНОЕ* (повтор каждые 3 часа)\n\n"
+    else:
+        message_text += "\n"
 
-            except Exception as e:
-                logger.error(f"Ошибка обработки напоминания ингредиента {reminder_id}: {e}")
-                continue
+    # Дополнительная информация для пропущенных напоминаний
+    if is_missed:
+        message_text += "💡 *Примечание:* Это напоминание должно было прийти ранее, но было пропущено.\n\n"
 
-        # Удаляем напоминания с наступившей датой приготовления
-        for reminder_id in reminders_to_remove:
-            if reminder_id in reminders:
-                del reminders[reminder_id]
-                logger.info(f"✅ Удален ингредиент с наступившей датой приготовления: {reminder_id}")
+    # Совет
+    message_text += "💡 *Совет:* Купите ингредиент заранее, чтобы все было готово к приготовлению!"
 
-        # Сохраняем изменения
-        if sent_count > 0 or reminders_to_remove:
-            if not save_reminders(reminders):
-                logger.error("Ошибка при записи напоминаний в файл reminders.json")
-            logger.info(f"📤 Отправлено напоминаний ингредиентов: {sent_count}, удалено: {len(reminders_to_remove)}")
+    return message_text, notification_keyboard(reminder['id'])
 
-        return sent_count
+def render_reminder_notification(reminder, users, is_missed, hours_left, tz=None, due_ts=None):
+    """Текст и кнопки обычного уведомления-напоминания (время due_ts или самого напоминания - в поясе tz получателя)"""
+    # Определяем, кто должен купить
+    assigned_users = []
+    for user_id in reminder['users']:
+        user_data = users.get(str(user_id), {})
+        username = user_data.get('username', 'Unknown')
+        assigned_users.append(username)
 
-    except Exception as e:
-        logger.error(f"Ошибка в check_ingredient_reminders: {e}")
-        return 0
+    # Базовый текст в зависимости от типа
+    if is_missed:
+        message_text = f"⏰ *ПРОПУЩЕННОЕ НАПОМИНАНИЕ!*\n\n"
+    else:
+        message_text = f"🔔 *НАПОМИНАНИЕ!*\n\n"
 
-async def send_ingredient_reminder_notification(application, reminder, is_urgent_update=False, is_missed=False):
-    """Отправка уведомления о необходимости покупки ингредиента с проверкой ночного времени"""
-    try:
-        current_time = datetime.now(MOSCOW_TZ)
+    # Основной текст напоминания
+    message_text += f"{reminder['text']}\n\n"
 
-        # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ ДЛЯ ВСЕХ ТИПОВ НАПОМИНАНИЙ
-        current_hour = current_time.hour
-        is_night_time = current_hour >= 23 or current_hour < 9
+    # Информация о пользователях
+    if assigned_users:
+        message_text += f"👤 *Для:* {', '.join(assigned_users)}\n"
 
-        # Если ночное время и это не пропущенное напоминание, пропускаем отправку
-        if is_night_time and not is_missed:
-            logger.info(f"🌙 Пропущена отправка ингредиента в ночное время (сейчас {current_time.strftime('%H:%M')})")
-            return
+    # Информация о времени
+    reminder_time = local_time(due_ts if due_ts is not None else reminder.due_ts, tz)
+    if is_missed:
+        message_text += f"⏰ *Должно было прийти:* {reminder_time.strftime('%d.%m.%Y %H:%M')}\n"
+    else:
+        message_text += f"⏰ *Время:* {reminder_time.strftime('%d.%m.%Y %H:%M')}\n"
 
-        # ЕСЛИ ЭТО ОБНОВЛЕНИЕ СРОЧНОГО НАПОМИНАНИЯ - УДАЛЯЕМ СТАРЫЕ СООБЩЕНИЯ
-        if is_urgent_update:
-            await delete_old_reminder_messages(application, reminder['id'])
-            logger.info(f"🗑 Удалены старые сообщения для срочного напоминания ингредиента {reminder['id']}")
+    # Информация о интервале
+    interval_days = reminder.get('interval_days', 0)
+    if interval_days > 0:
+        interval_text = f"каждые {interval_days} дней"
+    else:
+        interval_text = "однократно"
+    message_text += f"🔄 *Повтор:* {interval_text}\n"
 
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Купил", callback_data=f"bought_{reminder['id']}"),
-                InlineKeyboardButton("❌ Еще не купил", callback_data=f"not_bought_{reminder['id']}")
-            ]
-        ]
+    # Информация о срочности
+    if reminder.urgent_reminders:
+        if hours_left is not None:
+            message_text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n\n"
+        else:
+            message_text += "🚨 *СРОЧНОЕ* (повтор каждые 3 часа)\n\n"
+    else:
+        message_text += "\n"
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Дополнительная информация для пропущенных напоминаний
+    if is_missed:
+        message_text += "💡 *Примечание:* Это напоминание должно было прийти ранее, но было пропущено.\n\n"
 
-        # Базовый текст
-        if is_missed:
-            message_text = f"⏰ *ПРОПУЩЕННОЕ НАПОМИНАНИЕ О ПОКУПКЕ!*\n\n"
-        else:
-            message_text = f"🛒 *НАПОМИНАНИЕ О ПОКУПКЕ!*\n\n"
-
-        # Текст напоминания
-        message_text += f"{reminder['text']}\n\n"
-
-        # Информация о срочности
-        if reminder.get('urgent_reminders'):
-            urgent_until = reminder.get('urgent_until')
-            if urgent_until:
-                urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                time_left = urgent_until_time - current_time
-                hours_left = max(0, int(time_left.total_seconds() / 3600))
-                message_text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n\n"
-            else:
-                message_text += "🚨 *СРОЧНОЕ* (повтор каждые 3 часа)\n\n"
-        else:
-            message_text += "\n"
+    return message_text, notification_keyboard(reminder['id'])
 
-        # Дополнительная информация для пропущенных напоминаний
-        if is_missed:
-            message_text += "💡 *Примечание:* Это напоминание должно было прийти ранее, но было пропущено.\n\n"
+async def send_ingredient_reminder_notification(application, reminder, is_urgent_update=False, is_missed=False):
+    """Отправка уведомления о необходимости покупки ингредиента с учетом тихих часов получателей"""
+    try:
+        now = now_ts()
 
-        # Совет
-        message_text += "💡 *Совет:* Купите ингредиент заранее, чтобы все было готово к приготовлению!"
+        # Текст и кнопки - из кэша отрисовки (одинаковы для всех получателей)
+        hours_left = urgent_hours_left(reminder, now)
+        message_text, reply_markup = render_cache.get_or_render(
+            reminder, ('ingredient', is_missed, hours_left),
+            lambda: render_ingredient_notification(reminder, is_missed, hours_left)
+        )
 
-        # Отправляем каждому пользователю и сохраняем ID сообщений
+        # Ставим в очередь отправку каждому пользователю (ID сообщений запоминаются после доставки)
         for user_id in reminder['users']:
             try:
                 # Преобразуем user_id в int
@@ -4111,25 +5983,17 @@ async def send_ingredient_reminder_notification(application, reminder, is_urgent
                     logger.error(f"❌ Неверный формат user_id: {user_id}, ошибка: {e}")
                     continue
 
-                # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ (23:00 - 9:00)
-                current_hour = current_time.hour
-
-                # Если ночное время (23:00 - 9:00) и это не срочное напоминание, пропускаем отправку
-                if not reminder.get('urgent_reminders') and (current_hour >= 23 or current_hour < 9):
-                    logger.info(f"🌙 Пропущена отправка в ночное время для пользователя {user_id_int} (сейчас {current_time.strftime('%H:%M')})")
+                # Тихие часы пользователя: не отправляем (планировщик учитывает их заранее)
+                quiet_hours = quiet_hours_for(user_id_int)
+                if quiet_hours.is_quiet(now):
+                    logger.info(f"🌙 Пропущена отправка в тихие часы для пользователя {user_id_int} (сейчас {local_time(now, quiet_hours.tz).strftime('%H:%M')})")
                     continue
 
-                message = await application.bot.send_message(
-                    chat_id=user_id_int,
-                    text=message_text,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-
-                # Сохраняем ID нового сообщения с правильным форматом
-                save_message_id(reminder['id'], user_id_int, message.message_id)
-
-                logger.info(f"✅ Уведомление ингредиента отправлено пользователю {user_id_int} с message_id {message.message_id}")
+                # Обновление срочного напоминания редактирует уже отправленное сообщение
+                if is_urgent_update:
+                    enqueue_notification_update(application, reminder['id'], user_id_int, message_text, reply_markup, kind="Уведомление ингредиента")
+                else:
+                    enqueue_notification(application, reminder['id'], user_id_int, message_text, reply_markup, kind="Уведомление ингредиента")
 
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки уведомления пользователю {user_id}: {e}")
@@ -4137,6 +6001,104 @@ async def send_ingredient_reminder_notification(application, reminder, is_urgent
     except Exception as e:
         logger.error(f"❌ Ошибка в send_ingredient_reminder_notification: {e}")
 
+# Ключ сообщения списка покупок в message_ids: одно сообщение на план для каждого пользователя
+SHOPPING_LIST_KEY_PREFIX = "shopping_"
+
+def shopping_list_key(meal_plan_id):
+    return f"{SHOPPING_LIST_KEY_PREFIX}{meal_plan_id}"
+
+def is_ingredient_bought(reminder, user_id=None):
+    """Ингредиент отмечен купленным (в списке покупок) - указанным или любым пользователем"""
+    confirmed_by = reminder.get('confirmed_by') or ()
+    if user_id is None:
+        return bool(confirmed_by)
+    return str(user_id) in {str(confirmed) for confirmed in confirmed_by}
+
+async def shopping_list_items(meal_plan_id, user_id):
+    """Напоминания ингредиентов плана, назначенные пользователю, в порядке ингредиентов"""
+    reminder_ids = await repository.find_ids('reminders', 'meal_plan_id', meal_plan_id)
+    items = []
+    for reminder_id in reminder_ids:
+        reminder = repository.get('reminders', reminder_id)
+        if reminder is None or reminder.type != 'ingredient':
+            continue
+        if str(user_id) in {str(user) for user in reminder.get('users', [])}:
+            items.append((reminder_id, reminder))
+    items.sort(key=lambda item: (str(item[1].get('ingredient_id')), item[0]))
+    return items
+
+def _shopping_item_label(reminder, ingredients):
+    ingredient = ingredients.get(reminder.get('ingredient_id'))
+    if ingredient:
+        return ingredient['name'], f"{ingredient['name']} - {ingredient['quantity']}"
+    # План уже удален - берем строку ингредиента из текста напоминания
+    first_line = reminder['text'].split('\n', 1)[0].lstrip('•').strip()
+    return first_line.split(' - ', 1)[0], first_line
+
+def render_shopping_list(meal_plan_id, user_id, items, now, is_missed=False):
+    """Текст и кнопки списка покупок пользователя по плану: по кнопке на ингредиент"""
+    plan = repository.get('meal_plans', meal_plan_id)
+    ingredients = {ingredient['id']: ingredient for ingredient in plan['ingredients']} if plan else {}
+    first = items[0][1]
+
+    if is_missed:
+        message_text = f"⏰ *ПРОПУЩЕННОЕ НАПОМИНАНИЕ О ПОКУПКЕ!*\n\n"
+    else:
+        message_text = f"🛒 *СПИСОК ПОКУПОК*\n\n"
+    message_text += f"🍽 *Блюдо:* {first.get('recipe_name', 'Неизвестно')}\n"
+    message_text += f"📅 *Дата приготовления:* {first.get('meal_date', 'Неизвестно')}\n\n"
+
+    keyboard = []
+    hours_left = []
+    urgent = False
+    for reminder_id, reminder in items:
+        bought = is_ingredient_bought(reminder, user_id)
+        icon = "✅" if bought else "⬜"
+        name, label = _shopping_item_label(reminder, ingredients)
+        message_text += f"{icon} {label}\n"
+        keyboard.append([InlineKeyboardButton(f"{icon} {name}", callback_data=callback_data("shop", reminder_id))])
+        if not bought and reminder.urgent_reminders:
+            urgent = True
+            left = urgent_hours_left(reminder, now)
+            if left is not None:
+                hours_left.append(left)
+
+    # Информация о срочности
+    if urgent:
+        if hours_left:
+            message_text += f"\n🚨 *СРОЧНОЕ* (осталось {min(hours_left)}ч.)\n"
+        else:
+            message_text += "\n🚨 *СРОЧНОЕ* (повтор каждые 3 часа)\n"
+
+    if is_missed:
+        message_text += "\n💡 *Примечание:* Это напоминание должно было прийти ранее, но было пропущено.\n"
+
+    message_text += "\n💡 Отмечайте купленное кнопками ниже - список обновится в этом же сообщении."
+    keyboard.append([InlineKeyboardButton("❌ Еще не купил", callback_data=callback_data("shop_later", meal_plan_id))])
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def send_shopping_list(application, meal_plan_id, user_id, is_missed=False):
+    """Отправляет или обновляет на месте список покупок пользователя по плану"""
+    try:
+        now = now_ts()
+        items = await shopping_list_items(meal_plan_id, user_id)
+        if not items:
+            return
+
+        # Тихие часы пользователя (как и для отдельных ингредиентов)
+        quiet_hours = quiet_hours_for(user_id)
+        if quiet_hours.is_quiet(now):
+            logger.info(f"🌙 Пропущена отправка списка покупок в тихие часы (сейчас {local_time(now, quiet_hours.tz).strftime('%H:%M')})")
+            return
+
+        message_text, reply_markup = render_shopping_list(meal_plan_id, user_id, items, now, is_missed)
+        # Одно сообщение на план: уже отправленный список редактируется
+        enqueue_notification_update(application, shopping_list_key(meal_plan_id), int(user_id), message_text,
+                                    reply_markup, kind="Список покупок")
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка в send_shopping_list: {e}")
+
 async def edit_recipes_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Меню редактирования рецептов"""
     query = update.callback_query
@@ -4171,121 +6133,852 @@ async def edit_recipes_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def send_missed_reminders(application):
-    """Отправляет напоминания, которые должны были прийти за последние 24 часа, включая ингредиенты"""
+# Сколько пропущенных напоминаний отправляется за один проход, остальные - в следующих
+MISSED_CATCHUP_LIMIT = 20
+
+def load_tick_watermark():
+    """Время последнего завершенного прохода проверки (None, если проходов еще не было)"""
+    state = repository.get('scheduler_state', 'tick')
+    if not state or not state.get('completed_at'):
+        return None
     try:
-        reminders = load_reminders()
-        users = load_users()
-        current_time = datetime.now(MOSCOW_TZ)
+        return _parse_epoch(state['completed_at'])
+    except (ValueError, TypeError):
+        return None
 
-        # Время, с которого проверяем пропущенные напоминания (24 часа назад)
-        check_from_time = current_time - timedelta(hours=24)
+def load_deferred_missed():
+    """ID пропущенных напоминаний, отложенных прошлыми проходами (тихие часы, лимит догоняния)"""
+    state = repository.get('scheduler_state', 'tick')
+    return set(state.get('deferred') or ()) if state else set()
+
+def save_tick_watermark(ts, deferred=()):
+    """Запоминает время (секунды UTC) завершенного прохода проверки и отложенные пропущенные напоминания.
+
+    Проходы планировщика проверяют только наступившие напоминания, поэтому отметка
+    сдвигается каждым проходом, а отложенные держатся по ID, пока их не отправят.
+    """
+    repository.put('scheduler_state', 'tick', {'completed_at': ts, 'deferred': sorted(deferred)})
+
+def select_reminders(reminders, reminder_ids=None):
+    """Возвращает пары (ID, напоминание) для проверки: все или только указанные"""
+    if reminder_ids is None:
+        return list(reminders.items())
+    return [(reminder_id, reminders[reminder_id]) for reminder_id in reminder_ids if reminder_id in reminders]
+
+class ReminderTick:
+    """Снимок состояния на один проход проверки и собранные этапами действия"""
+
+    def __init__(self, reminder_ids=None):
+        self.reminders = load_reminders()
+        self.users = load_users()
+        # Все сравнения прохода - в секундах UTC
+        self.now = now_ts()
+        self.reminder_ids = reminder_ids
+        # Окно прохода - с прошлого прохода этого запуска; все просроченное раньше (простой,
+        # тихие часы) идет через этап пропущенных с лимитом, а не обычными этапами
+        started_at = reminder_scheduler.started_at or self.now
+        watermark = load_tick_watermark()
+        self.window_start = max(watermark, started_at) if watermark else started_at
+        # Отложенные прошлыми проходами пропущенные напоминания проверяются независимо от отметки
+        self.carried = load_deferred_missed()
+        # (ID напоминания, показываемое время до переноса, флаги отправки)
+        self.sends = []
+        self.message_deletes = []
+        self.removed = set()
+        self.deferred = set()
+        self.updated = set()
+        self.plans_to_renew = set()
+        self.sent_by_stage = {}
+
+    def is_overdue(self, reminder):
+        """Время прошло, а с момента отправки к этому времени уведомления не было"""
+        due = reminder.due_ts
+        if due is None or due > self.now:
+            return False
+        if reminder.type == 'ingredient' and is_ingredient_bought(reminder):
+            return False
+        last_sent = reminder.last_sent_ts
+        return last_sent is None or last_sent < due - REMINDER_LEAD_TIME
+
+    def is_missed(self, reminder_id, reminder):
+        """Просрочено до начала окна прохода (или отложено прошлыми проходами)"""
+        if not self.is_overdue(reminder):
+            return False
+        return reminder.due_ts < self.window_start or reminder_id in self.carried
+
+    def still_deferred(self):
+        """Отложенные пропущенные напоминания для следующих проходов"""
+        checked = None if self.reminder_ids is None else set(self.reminder_ids)
+        # Не проверенные в этом проходе остаются отложенными, проверенные - если их отложили снова
+        kept = {reminder_id for reminder_id in self.carried
+                if checked is not None and reminder_id not in checked and reminder_id in self.reminders}
+        return kept | self.deferred
+
+    def is_quiet(self, reminder):
+        """Тихие часы у получателей: отправка ждет (планировщик разбудит после них)"""
+        return is_reminder_quiet(reminder, self.now)
+
+    def active(self):
+        """Напоминания для проверки, кроме удаленных и отложенных в этом проходе"""
+        return [(reminder_id, reminder) for reminder_id, reminder in select_reminders(self.reminders, self.reminder_ids)
+                if reminder_id not in self.removed and reminder_id not in self.deferred]
+
+    def send(self, stage, reminder_id, reminder, **flags):
+        """Планирует отправку и отмечает напоминание отправленным"""
+        if reminder.type == 'ingredient' and is_ingredient_bought(reminder):
+            # Отмечен купленным в списке покупок - больше не напоминаем
+            return
+        # Время в тексте - до переноса; остальное берется из сохраненной записи
+        self.sends.append((reminder_id, reminder.due_ts, flags))
+        self.sent_by_stage[stage] = self.sent_by_stage.get(stage, 0) + 1
+        reminder.last_sent_ts = self.now
+        self.updated.add(reminder_id)
+
+    def remove(self, reminder_id):
+        """Планирует удаление напоминания (его сообщения удалит message_cleanup)"""
+        self.removed.add(reminder_id)
+
+    async def commit(self, application):
+        """Один раз сохраняет состояние и выполняет собранные удаления и отправки
+
+        Возвращает False (ничего не отправляя), если напоминания прохода успели
+        изменить параллельно - проход нужно повторить на свежем снимке.
+        """
+        for reminder_id in self.removed:
+            if reminder_id in self.reminders:
+                del self.reminders[reminder_id]
+
+        if self.removed or self.updated:
+            if not repository.commit('reminders', self.reminders):
+                return False
+            # Единственная немедленная запись: отметки отправки должны попасть на диск до самих отправок,
+            # иначе после падения между ними проход повторит уже отправленные уведомления
+            if not await repository.flush_async():
+                logger.error("❌ Ошибка при записи напоминаний")
 
-        sent_count = 0
-        reminders_to_update = []
+        if self.message_deletes:
+            deleted_count = await delete_tracked_messages(application, self.message_deletes)
+            logger.info(f"✅ Удалено {deleted_count} старых сообщений для напоминаний: {len(self.message_deletes)}")
 
-        logger.info(f"🔍 Поиск пропущенных напоминаний за последние 24 часа (с {check_from_time.strftime('%d.%m.%Y %H:%M')})")
+        # В режиме списка покупок ингредиенты одного плана уходят одним сообщением на пользователя
+        shopping_lists = {}
+        for reminder_id, shown_due_ts, flags in self.sends:
+            # Сохраненная запись: ее версия однозначно задает содержимое для кэша отрисовки
+            reminder = self.reminders.get(reminder_id)
+            if reminder is None:
+                continue
+            if reminder.type == 'ingredient':
+                if SHOPPING_LIST_MODE == 'grouped' and reminder.get('meal_plan_id'):
+                    for user_id in reminder['users']:
+                        key = (reminder['meal_plan_id'], str(user_id))
+                        shopping_lists[key] = shopping_lists.get(key, False) or flags.get('is_missed', False)
+                    continue
+                await send_ingredient_reminder_notification(application, reminder, **flags)
+            else:
+                await send_reminder_notification(application, reminder, self.users, due_ts=shown_due_ts, **flags)
 
-        for reminder_id, reminder in reminders.items():
-            try:
-                reminder_time = datetime.fromisoformat(reminder['datetime']).replace(tzinfo=MOSCOW_TZ)
+        for (meal_plan_id, user_id), is_missed in shopping_lists.items():
+            await send_shopping_list(application, meal_plan_id, user_id, is_missed=is_missed)
 
-                # Проверяем, должно ли было напоминание прийти в последние 24 часа
-                if check_from_time <= reminder_time <= current_time:
-                    last_sent = reminder.get('last_sent')
+        # СОЗДАЕМ НОВЫЕ ПЛАНЫ ДЛЯ УДАЛЕННЫХ НАПОМИНАНИЙ ИНГРЕДИЕНТОВ
+        if self.plans_to_renew:
+            meal_plans = load_meal_plans()
+            for meal_plan_id in self.plans_to_renew:
+                if meal_plans.get(meal_plan_id):
+                    new_plan_id = await create_next_week_meal_plan(application, meal_plan_id)
+                    if new_plan_id:
+                        logger.info(f"📅 Создан новый план на следующую неделю: {new_plan_id}")
+        return True
 
-                    # Если напоминание еще не отправлялось
-                    if not last_sent:
-                        logger.info(f"⏰ Найдено пропущенное напоминание: {reminder['text'][:50]}... (время: {reminder_time.strftime('%d.%m.%Y %H:%M')})")
+def stage_expiry(tick):
+    """Удаляет прошедшие напоминания и снимает истекший срочный режим"""
+    now = tick.now
+    for reminder_id, reminder in tick.active():
+        try:
+            if reminder.type == 'ingredient':
+                # Дата приготовления уже прошла (учитываем начало дня)
+                if reminder.meal_day and now >= meal_day_end(reminder.meal_day):
+                    tick.remove(reminder_id)
+                    if reminder.get('meal_plan_id'):
+                        tick.plans_to_renew.add(reminder['meal_plan_id'])
+                    logger.info(f"🗑 Напоминание ингредиента {reminder_id} удалено после наступления дня приготовления")
+                    continue
+            elif reminder.last_sent_ts is not None and reminder.get('interval_days', 0) == 0:
+                # Однократное - через 24 часа после последней отправки
+                if now - reminder.last_sent_ts >= ONE_TIME_REMINDER_TTL:
+                    tick.remove(reminder_id)
+                    logger.info(f"🗑 Однократное напоминание {reminder_id} удалено через 24 часа после последней отправки")
+                    continue
 
-                        # Для ингредиентов
-                        if reminder.get('type') == 'ingredient':
-                            await send_ingredient_reminder_notification(application, reminder, is_missed=True)
-                        else:
-                            # Для обычных напоминаний
-                            await send_reminder_notification(application, reminder, users, is_missed=True)
+            # Срочные напоминания в тихие часы не проверяются
+            if reminder.urgent_until_ts is None or now <= reminder.urgent_until_ts:
+                continue
+            if reminder.urgent_reminders and tick.is_quiet(reminder):
+                continue
 
-                        sent_count += 1
+            # СРОЧНЫЙ РЕЖИМ ИСТЕК
+            if reminder.type == 'ingredient':
+                # Ингредиент остается до дня приготовления, только снимаем срочный режим
+                logger.info(f"🔄 Срочный режим истек для ингредиента {reminder_id}, но напоминание остается до дня приготовления")
+            else:
+                interval_days = reminder.get('interval_days', 0)
+                if interval_days == 0:
+                    # ОДНОКРАТНОЕ НАПОМИНАНИЕ - полное удаление
+                    tick.remove(reminder_id)
+                    logger.info(f"🗑 Однократное срочное напоминание {reminder_id} удалено по истечении срочного режима")
+                    continue
 
-                        # Обновляем время последней отправки
-                        reminder['last_sent'] = current_time.isoformat()
+                # ИНТЕРВАЛЬНОЕ НАПОМИНАНИЕ - восстанавливаем обычный режим
+                original_interval = reminder.get('original_interval', interval_days)
+                original_due = reminder.original_due_ts
+                if original_due is not None:
+                    # Интервалы считаются в календарных днях пояса напоминания
+                    tz = reminder_timezone(reminder)
+                    days_passed = (local_time(now, tz).date() - local_time(original_due, tz).date()).days
+                    intervals_passed = days_passed // original_interval
+                    next_interval_due = add_local_days(original_due, (intervals_passed + 1) * original_interval, tz)
 
-                        # Для интервальных напоминаний планируем следующее
-                        if reminder.get('type') != 'ingredient':  # Ингредиенты однократные
-                            interval_days = reminder.get('interval_days', 0)
-                            if interval_days > 0:
-                                next_reminder_time = reminder_time + timedelta(days=interval_days)
+                    if next_interval_due <= now:
+                        next_interval_due = add_local_days(next_interval_due, original_interval, tz)
 
-                                # Если следующее напоминание тоже в прошлом, вычисляем ближайшее будущее
-                                while next_reminder_time <= current_time:
-                                    next_reminder_time += timedelta(days=interval_days)
+                    reminder.due_ts = next_interval_due
+                    logger.info(f"🔄 Интервальное напоминание восстановлено: {local_time(next_interval_due, tz).strftime('%d.%m.%Y %H:%M')}")
 
-                                reminder['datetime'] = next_reminder_time.isoformat()
-                                logger.info(f"🔄 Интервальное напоминание перенесено на: {next_reminder_time.strftime('%d.%m.%Y %H:%M')}")
+                # УДАЛЯЕМ ВСЕ СТАРЫЕ СООБЩЕНИЯ ДЛЯ ЭТОГО НАПОМИНАНИЯ
+                tick.message_deletes.append(reminder_id)
+                logger.info(f"🔄 Срочный режим истек для {reminder_id}, восстановлен обычный режим")
 
-                        reminders_to_update.append(reminder_id)
+            reminder.urgent_reminders = False
+            reminder.urgent_until_ts = None
+            reminder.last_sent_ts = None
+            tick.updated.add(reminder_id)
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки пропущенного напоминания {reminder_id}: {e}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки истечения напоминания {reminder_id}: {e}")
+
+def stage_missed(tick):
+    """Догоняет просроченное до окна прохода (простой, тихие часы): срочные и свежие первыми, не больше лимита"""
+    now = tick.now
+    missed = []
+    for reminder_id, reminder in tick.active():
+        if tick.is_missed(reminder_id, reminder):
+            if tick.is_quiet(reminder):
+                # Тихие часы: ждет до их конца (остается отложенным до следующих проходов)
+                tick.deferred.add(reminder_id)
                 continue
+            missed.append((reminder_id, reminder))
+    if not missed:
+        return
 
-        # Сохраняем изменения
-        if reminders_to_update:
-            if not save_reminders(reminders):
-                logger.error("❌ Ошибка при сохранении обновленных напоминаний")
+    # После долгого простоя - сначала срочные, затем самые свежие; остальные в следующих проходах
+    missed.sort(key=lambda item: (not item[1].urgent_reminders, -item[1].due_ts))
+    for reminder_id, reminder in missed[MISSED_CATCHUP_LIMIT:]:
+        # Отложенные запоминаются по ID, чтобы следующий проход их нашел
+        tick.deferred.add(reminder_id)
+    if tick.deferred:
+        logger.info(f"⏳ Пропущенных напоминаний: {len(missed)}, отложено до следующих проходов: {len(tick.deferred)}")
+
+    for reminder_id, reminder in missed[:MISSED_CATCHUP_LIMIT]:
+        try:
+            due = reminder.due_ts
+            tz = reminder_timezone(reminder)
+            logger.info(f"⏰ Найдено пропущенное напоминание: {reminder.text[:50]}... (время: {local_time(due, tz).strftime('%d.%m.%Y %H:%M')})")
+            tick.send('missed', reminder_id, reminder, is_missed=True)
+
+            # Срочное - следующий повтор через 3 часа; интервальное - следующее по интервалу (ингредиенты однократные)
+            interval_days = reminder.get('interval_days', 0)
+            if reminder.urgent_reminders:
+                reminder.due_ts = next_send_time(reminder, now + URGENT_REPEAT_INTERVAL)
+            elif reminder.type != 'ingredient' and interval_days > 0:
+                next_due = add_local_days(due, interval_days, tz)
+
+                # Если следующее напоминание тоже в прошлом, вычисляем ближайшее будущее
+                while next_due <= now:
+                    next_due = add_local_days(next_due, interval_days, tz)
+
+                reminder.due_ts = next_due
+                logger.info(f"🔄 Интервальное напоминание перенесено на: {local_time(next_due, tz).strftime('%d.%m.%Y %H:%M')}")
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки пропущенного напоминания {reminder_id}: {e}")
+
+def stage_regular(tick):
+    """Обычные (не срочные) напоминания: за 30 минут до времени, не чаще раза в день"""
+    now = tick.now
+    for reminder_id, reminder in tick.active():
+        try:
+            if reminder.type == 'ingredient' or reminder.urgent_reminders:
+                continue
+
+            # В тихие часы не отправляем - планировщик вернется к напоминанию после них
+            if tick.is_quiet(reminder):
+                continue
+
+            # Если напоминание уже отправлялось сегодня, пропускаем
+            if sent_today(reminder, now):
+                continue
+
+            # ОТПРАВЛЯЕМ ДАЖЕ ЕСЛИ ПРОСРОЧЕНО, но только в окне прохода: более старые - этап пропущенных
+            due = reminder.due_ts
+            if due - now > REMINDER_LEAD_TIME or due < tick.window_start:
+                continue
+
+            logger.info(f"⏰ ОТПРАВКА (обычное напоминание): {reminder.text[:30]}... (тип: {reminder.get('type', 'personal')})")
+            tick.send('regular', reminder_id, reminder)
+
+            # Планируем следующее напоминание по интервалу
+            interval_days = reminder.get('interval_days', 0)
+            if interval_days > 0:
+                tz = reminder_timezone(reminder)
+                next_due = add_local_days(due, interval_days, tz)
+                reminder.due_ts = next_due
+                logger.info(f"🔄 Следующее интервальное напоминание через {interval_days} дней: {local_time(next_due, tz).strftime('%d.%m.%Y %H:%M')}")
             else:
-                logger.info(f"✅ Сохранены обновления для {len(reminders_to_update)} напоминаний")
+                # ОДНОКРАТНОЕ НАПОМИНАНИЕ - не удаляем сразу, удалим через 24 часа после отправки
+                logger.info(f"⏰ Однократное напоминание {reminder_id} отправлено, будет удалено через 24 часа")
 
-        if sent_count > 0:
-            logger.info(f"📤 Отправлено пропущенных напоминаний: {sent_count}")
-        else:
-            logger.info("✅ Пропущенных напоминаний не найдено")
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки напоминания {reminder_id}: {e}")
 
-        return sent_count
+def stage_urgent(tick):
+    """Срочные напоминания (обычные и ингредиенты): каждые 3 часа с замещением сообщений"""
+    now = tick.now
+    for reminder_id, reminder in tick.active():
+        try:
+            if not reminder.urgent_reminders:
+                continue
 
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка в send_missed_reminders: {e}")
-        return 0
+            # ТИХИЕ ЧАСЫ: срочное ждет их окончания
+            if tick.is_quiet(reminder):
+                logger.info(f"🌙 Срочное напоминание {reminder_id} отложено до конца тихих часов")
+                continue
+
+            if reminder.last_sent_ts is None:
+                send_reason = "первое срочное напоминание"
+            else:
+                if now - reminder.last_sent_ts < URGENT_REPEAT_INTERVAL:
+                    continue
+                hours_since_last = (now - reminder.last_sent_ts) / 3600
+                send_reason = f"срочное напоминание (прошло {hours_since_last:.1f} ч.)"
+
+            logger.info(f"⏰ ОТПРАВКА ({send_reason}): {reminder.text[:30]}... (тип: {reminder.get('type', 'personal')})")
+            tick.send('urgent', reminder_id, reminder, is_urgent_update=True)
+
+            # Следующее срочное - через 3 часа, но не в тихие часы
+            next_due = next_send_time(reminder, now + URGENT_REPEAT_INTERVAL)
+            reminder.due_ts = next_due
+            logger.info(f"🔁 Следующее срочное напоминание через 3 часа: {local_time(next_due, reminder_timezone(reminder)).strftime('%d.%m.%Y %H:%M')}")
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки срочного напоминания {reminder_id}: {e}")
 
-async def check_all_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Объединенная проверка всех типов напоминаний с автоматической очисткой"""
-    try:
-        application = context.application
-        total_sent = 0
+def stage_ingredient(tick):
+    """Обычные напоминания ингредиентов: в пределах ±30 минут от времени напоминания,
+    просроченные и еще не отправленные - один раз, как пропущенные"""
+    now = tick.now
+    for reminder_id, reminder in tick.active():
+        try:
+            if reminder.type != 'ingredient' or reminder.urgent_reminders:
+                continue
 
-        # Загружаем текущие напоминания для проверки актуальности
-        current_reminders = load_reminders()
+            # Если напоминание уже отправлялось сегодня, пропускаем
+            if sent_today(reminder, now):
+                continue
 
-        # СНАЧАЛА автоматически очищаем прошедшие напоминания и создаем новые планы
-        cleaned_count = await cleanup_past_meal_plans_and_reminders(application)
-        if cleaned_count > 0:
-            logger.info(f"🧹 Автоматически очищено {cleaned_count} прошедших напоминаний")
+            if tick.is_quiet(reminder):
+                continue
 
-        # УДАЛЯЕМ НЕАКТУАЛЬНЫЕ СООБЩЕНИЯ (которых нет в current_reminders)
-        old_messages_deleted = await cleanup_old_messages(application, current_reminders)
-        if old_messages_deleted > 0:
-            logger.info(f"🗑 Удалено {old_messages_deleted} неактуальных сообщений")
+            # Окно ±30 минут отсчитывается от времени, сдвинутого тихими часами
+            send_at = next_send_time(reminder, reminder.due_ts)
+            if now < send_at - REMINDER_LEAD_TIME:
+                continue
+            if now > send_at + REMINDER_LEAD_TIME:
+                # Окно прошло: ингредиент еще нужен до дня приготовления - напоминаем один раз
+                if reminder.last_sent_ts is not None:
+                    continue
+                logger.info(f"⏰ ОТПРАВКА ИНГРЕДИЕНТА (просроченное напоминание ингредиента): {reminder.text[:50]}...")
+                tick.send('ingredient', reminder_id, reminder, is_missed=True)
+                continue
 
-        # ПОТОМ проверяем и отправляем пропущенные напоминания
-        missed_sent = await send_missed_reminders(application)
-        total_sent += missed_sent
+            logger.info(f"⏰ ОТПРАВКА ИНГРЕДИЕНТА (обычное напоминание ингредиента): {reminder.text[:50]}...")
+            tick.send('ingredient', reminder_id, reminder)
 
-        # Проверка обычных напоминаний
-        regular_sent = await check_regular_reminders(application)
-        total_sent += regular_sent
+        except Exception as e:
+            logger.error(f"Ошибка обработки напоминания ингредиента {reminder_id}: {e}")
+
+# Этапы прохода проверки в порядке выполнения
+REMINDER_STAGES = [
+    ('expiry', stage_expiry),
+    ('missed', stage_missed),
+    ('regular', stage_regular),
+    ('urgent', stage_urgent),
+    ('ingredient', stage_ingredient),
+]
+
+async def check_all_reminders(application, reminder_ids=None):
+    """Один проход проверки напоминаний (всех или только наступивших): снимок, этапы, одно сохранение"""
+    try:
+        for attempt in range(1, CAS_MAX_ATTEMPTS + 1):
+            tick = ReminderTick(reminder_ids)
+
+            timings = []
+            for stage_name, stage in REMINDER_STAGES:
+                started = time.perf_counter()
+                stage(tick)
+                timings.append((stage_name, (time.perf_counter() - started) * 1000))
+
+            started = time.perf_counter()
+            committed = await tick.commit(application)
+            timings.append(('commit', (time.perf_counter() - started) * 1000))
+            if committed:
+                break
+            # Напоминания изменили параллельно (кнопкой) - повторяем проход на свежих данных
+            logger.info(f"🔁 Конфликт версий напоминаний, повтор прохода {attempt}")
+        else:
+            # Отметка прохода не сдвигается: пропущенные найдутся в следующий раз
+            logger.error(f"❌ Проход проверки не сохранен за {CAS_MAX_ATTEMPTS} попыток")
+            return 0
+        save_tick_watermark(tick.now, tick.still_deferred())
 
-        # Проверка напоминаний ингредиентов (включая срочные)
-        ingredient_sent = await check_ingredient_reminders(application)
-        total_sent += ingredient_sent
+        total_ms = sum(elapsed for _, elapsed in timings)
+        stages_text = ', '.join(f"{stage_name} {elapsed:.1f}" for stage_name, elapsed in timings)
+        logger.info(f"⏱ Проход проверки: {total_ms:.1f} мс ({stages_text})")
 
-        if total_sent > 0:
-            logger.info(f"✅ Всего отправлено напоминаний: {total_sent} (пропущенные: {missed_sent}, обычные: {regular_sent}, ингредиенты: {ingredient_sent})")
+        total_sent = len(tick.sends)
+        if total_sent > 0 or tick.removed:
+            by_stage = ', '.join(f"{stage_name}: {count}" for stage_name, count in tick.sent_by_stage.items())
+            logger.info(f"📤 ИТОГ: Отправлено {total_sent} ({by_stage}), обновлено {len(tick.updated)}, удалено {len(tick.removed)}")
 
         return total_sent
 
     except Exception as e:
         logger.error(f"❌ Ошибка в check_all_reminders: {e}")
         return 0
+# Страховочная полная пересборка очереди планировщика (секунды)
+SCHEDULER_RESCAN_INTERVAL = 3600
+# Минимальная пауза перед повторной проверкой того же напоминания (секунды)
+SCHEDULER_RETRY_DELAY = 60
+
+# Разброс отправок, попавших в один слот (10:00, 9:00 после ночи), в секундах.
+# При 30 сообщениях/с окно в 15 минут вмещает тысячи напоминаний без упора в лимит Telegram
+REMINDER_JITTER_WINDOW = int(os.getenv("REMINDER_JITTER_WINDOW", "900"))
+# Время напоминаний ингредиентов по умолчанию и варианты времени для плана
+INGREDIENT_REMINDER_TIME = "10:00"
+PLAN_NOTIFY_TIMES = ["08:00", "10:00", "12:00", "18:00", "20:00"]
+
+def jitter_seconds(key, window=None):
+    """Детерминированный сдвиг (секунды) внутри окна разброса: один и тот же для одного ключа"""
+    window = REMINDER_JITTER_WINDOW if window is None else window
+    if not key or window <= 0:
+        return 0
+    return zlib.crc32(str(key).encode()) % window
+
+def jitter_offset(key, window=None):
+    return timedelta(seconds=jitter_seconds(key, window))
+
+def reminder_jitter_key(reminder):
+    """Ключ разброса: ингредиенты одного плана приходят вместе (одним списком покупок)"""
+    if reminder.get('type') == 'ingredient' and reminder.get('meal_plan_id'):
+        return f"plan_{reminder['meal_plan_id']}"
+    return reminder.get('id')
+
+def slot_time(day, time_str, key=None):
+    """Момент слота time_str ("ЧЧ:ММ") в день day со сдвигом по ключу"""
+    hour, minute = map(int, time_str.split(':'))
+    return day.replace(hour=hour, minute=minute, second=0, microsecond=0) + jitter_offset(key)
+
+def ingredient_reminder_time(meal_plan, reminder_date):
+    """Время напоминаний ингредиентов плана: выбранное для плана точно, иначе 10:00 с разбросом"""
+    if meal_plan.get('notify_at'):
+        return slot_time(reminder_date, meal_plan['notify_at'])
+    return slot_time(reminder_date, INGREDIENT_REMINDER_TIME, f"plan_{meal_plan['id']}")
+
+class QuietHours:
+    """Тихие часы [start, end) по местному времени пояса tz (минуты от полуночи); start == end - без тихих часов"""
+
+    __slots__ = ('start', 'end', 'tz')
+
+    def __init__(self, start, end, tz=None):
+        self.start = start
+        self.end = end
+        self.tz = tz or DEFAULT_TZ
+
+    def is_quiet(self, ts):
+        local = local_time(ts, self.tz)
+        minute = local.hour * 60 + local.minute
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+    def next_allowed(self, ts, key=None):
+        """Ближайший момент (секунды UTC), когда можно отправлять: сам ts или конец тихих часов (со сдвигом по ключу)"""
+        if not self.is_quiet(ts):
+            return ts
+        local = local_time(ts, self.tz)
+        allowed = local.replace(hour=self.end // 60, minute=self.end % 60, second=0, microsecond=0)
+        if allowed <= local:
+            allowed += timedelta(days=1)
+        return int(allowed.timestamp()) + jitter_seconds(key)
+
+    def __str__(self):
+        if self.start == self.end:
+            return "выключены"
+        return f"{self.start // 60:02d}:{self.start % 60:02d}-{self.end // 60:02d}:{self.end % 60:02d}"
+
+@functools.lru_cache(maxsize=None)
+def parse_quiet_hours(spec, timezone=None):
+    """Разбирает "ЧЧ:ММ-ЧЧ:ММ" (или "off") в QuietHours пояса timezone; ValueError при неверном формате"""
+    tz = get_timezone(timezone) if timezone else None
+    if spec.strip().lower() == 'off':
+        return QuietHours(0, 0, tz)
+    start, end = (datetime.strptime(part.strip(), '%H:%M') for part in spec.split('-'))
+    return QuietHours(start.hour * 60 + start.minute, end.hour * 60 + end.minute, tz)
+
+# Тихие часы по умолчанию (пользователь может задать свои командой /quiet)
+QUIET_HOURS_SPEC = os.getenv("QUIET_HOURS", "23:00-09:00")
+QUIET_HOURS = parse_quiet_hours(QUIET_HOURS_SPEC)
+
+def quiet_hours_for(user_id):
+    """Тихие часы пользователя: свои или общие по умолчанию, в его часовом поясе"""
+    user = repository.get('users', str(user_id))
+    if user is None:
+        return QUIET_HOURS
+    spec = user.get('quiet_hours')
+    timezone = user.get('timezone')
+    if spec:
+        try:
+            return parse_quiet_hours(spec, timezone)
+        except ValueError:
+            logger.error(f"❌ Неверные тихие часы пользователя {user_id}: {spec}")
+    return parse_quiet_hours(QUIET_HOURS_SPEC, timezone) if timezone else QUIET_HOURS
+
+def reminder_quiet_hours(reminder):
+    """Тихие часы всех получателей напоминания"""
+    return [quiet_hours_for(user_id) for user_id in reminder.get('users') or ()] or [QUIET_HOURS]
+
+def is_reminder_quiet(reminder, ts):
+    """Сейчас тихие часы хотя бы у одного получателя - напоминание ждет"""
+    return any(policy.is_quiet(ts) for policy in reminder_quiet_hours(reminder))
+
+def next_send_time(reminder, ts):
+    """Ближайший момент (секунды UTC) не раньше ts, когда тихие часы закончились у всех получателей"""
+    policies = reminder_quiet_hours(reminder)
+    key = reminder_jitter_key(reminder)
+    for _ in range(len(policies) + 1):
+        allowed = max(policy.next_allowed(ts, key) for policy in policies)
+        if allowed == ts:
+            return ts
+        ts = allowed
+    # Общего окна у получателей нет - действуют тихие часы по умолчанию
+    return QUIET_HOURS.next_allowed(ts, key)
+
+# Интервалы правил напоминаний в секундах
+REMINDER_LEAD_TIME = 30 * 60
+URGENT_REPEAT_INTERVAL = 3 * 3600
+ONE_TIME_REMINDER_TTL = 24 * 3600
+
+def meal_day_end(meal_day):
+    """Конец дня приготовления (секунды UTC): планы питания живут в общем поясе"""
+    return int(datetime.combine(meal_day + timedelta(days=1), datetime.min.time(), tzinfo=DEFAULT_TZ).timestamp())
+
+def sent_today(reminder, now):
+    """Напоминание уже отправлялось сегодня (по календарю его пояса)"""
+    last_sent = reminder.last_sent_ts
+    return last_sent is not None and next_local_midnight(last_sent, reminder_timezone(reminder)) > now
+
+def reminder_fire_time(reminder, now=None):
+    """Ближайший момент (секунды UTC), когда напоминанию нужна проверка (None - проверять не нужно)"""
+    now = now_ts() if now is None else now
+    is_ingredient = reminder.type == 'ingredient'
+    last_sent = reminder.last_sent_ts
+    candidates = []
+
+    # Удаление: ингредиенты - после дня приготовления, однократные - через 24 часа после отправки
+    if is_ingredient and reminder.meal_day:
+        candidates.append(meal_day_end(reminder.meal_day))
+    elif not is_ingredient and last_sent is not None and reminder.get('interval_days', 0) == 0:
+        candidates.append(last_sent + ONE_TIME_REMINDER_TTL)
+
+    # Окончание срочного режима (в тихие часы срочные напоминания не проверяются)
+    if reminder.urgent_until_ts is not None:
+        candidates.append(next_send_time(reminder, reminder.urgent_until_ts))
+
+    if is_ingredient and is_ingredient_bought(reminder):
+        # Купленный ингредиент больше не напоминает - ждет только удаления
+        pass
+    elif reminder.urgent_reminders:
+        # Срочное - сразу, затем каждые 3 часа
+        candidates.append(next_send_time(reminder, last_sent + URGENT_REPEAT_INTERVAL if last_sent is not None else now))
+    elif reminder.due_ts is not None:
+        # Обычное - за 30 минут до времени, не чаще раза в день; в тихие часы - сразу после них
+        fire_at = reminder.due_ts - REMINDER_LEAD_TIME
+        if last_sent is not None:
+            fire_at = max(fire_at, next_local_midnight(last_sent, reminder_timezone(reminder)))
+        fire_at = next_send_time(reminder, fire_at)
+        # Ингредиенты отправляются в окне ±30 минут от времени напоминания (сдвинутого тихими часами),
+        # после окна - только еще не отправленные (один раз)
+        if not is_ingredient or last_sent is None or fire_at <= next_send_time(reminder, reminder.due_ts) + REMINDER_LEAD_TIME:
+            candidates.append(fire_at)
+
+    return min(candidates) if candidates else None
+
+class ReminderScheduler:
+    """Очередь напоминаний по времени срабатывания: спит до ближайшего и проверяет только наступившие"""
+
+    def __init__(self, repository, name='reminders', rescan_interval=SCHEDULER_RESCAN_INTERVAL):
+        self.repository = repository
+        self.name = name
+        self.rescan_interval = rescan_interval
+        # Куча (время, номер, ID); устаревшие элементы пропускаются по self._entries
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._pending = set()
+        self._wake = None
+        self._task = None
+        # Момент запуска: просроченное раньше него догоняется этапом пропущенных
+        self.started_at = None
+
+    def notify(self, name, record_id):
+        """Слушатель репозитория: напоминание изменилось - пересчитаем его при пробуждении"""
+        if name != self.name:
+            return
+        self._pending.add(record_id)
+        if self._wake is not None:
+            self._wake.set()
+
+    def schedule(self, reminder_id, now=None, not_before=None):
+        """Ставит (или переставляет) напоминание в очередь по времени следующей проверки"""
+        reminder = self.repository.get(self.name, reminder_id)
+        fire_ts = reminder_fire_time(reminder, now) if reminder is not None else None
+        if fire_ts is None:
+            self._entries.pop(reminder_id, None)
+            return
+        if not_before is not None and fire_ts < not_before:
+            fire_ts = not_before
+        entry = self._entries.get(reminder_id)
+        if entry is not None and entry[0] == fire_ts:
+            return
+        seq = next(self._counter)
+        self._entries[reminder_id] = (fire_ts, seq)
+        heapq.heappush(self._heap, (fire_ts, seq, reminder_id))
+
+    def rebuild(self):
+        """Полностью пересобирает очередь по текущим напоминаниям"""
+        now = now_ts()
+        self._heap = []
+        self._entries = {}
+        self._pending.clear()
+        for reminder_id in list(self.repository.collection(self.name)):
+            self.schedule(reminder_id, now)
+        logger.info(f"🗓 Очередь напоминаний пересобрана: {len(self._entries)} в расписании")
+
+    def _apply_pending(self, now):
+        pending, self._pending = self._pending, set()
+        for reminder_id in pending:
+            self.schedule(reminder_id, now)
+
+    def _pop_due(self, now_ts):
+        """Забирает из кучи все наступившие напоминания"""
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            fire_ts, seq, reminder_id = heapq.heappop(self._heap)
+            if self._entries.get(reminder_id) == (fire_ts, seq):
+                del self._entries[reminder_id]
+                due.append(reminder_id)
+        return due
+
+    def _next_fire_ts(self):
+        # Выбрасываем устаревшие элементы с вершины кучи
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][:2]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def _tick(self, application):
+        now = now_ts()
+        self._apply_pending(now)
+        due = self._pop_due(now)
+        if not due:
+            return
+        logger.info(f"⏰ Наступило напоминаний: {len(due)}")
+        # Пока идет проход, обработчики кнопок этих напоминаний ждут
+        async with entity_locks.hold('reminder', due):
+            await check_all_reminders(application, due)
+        # Измененные напоминания переставляем по новому времени, остальные - не раньше паузы
+        now = now_ts()
+        self._apply_pending(now)
+        not_before = now + SCHEDULER_RETRY_DELAY
+        for reminder_id in due:
+            self.schedule(reminder_id, now, not_before=not_before)
+
+    async def run(self, application):
+        """Основной цикл: спит до ближайшего напоминания или до изменения очереди"""
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self.rebuild()
+        rescan_at = loop.time() + self.rescan_interval
+        while True:
+            try:
+                if loop.time() >= rescan_at:
+                    self.rebuild()
+                    rescan_at = loop.time() + self.rescan_interval
+
+                self._wake.clear()
+                await self._tick(application)
+
+                timeout = rescan_at - loop.time()
+                next_ts = self._next_fire_ts()
+                if next_ts is not None:
+                    timeout = min(timeout, next_ts - time.time())
+                if self._pending:
+                    continue
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка в планировщике напоминаний: {e}")
+                await asyncio.sleep(SCHEDULER_RETRY_DELAY)
+
+    def start(self, application):
+        """Запускает цикл планировщика"""
+        if self._task is None:
+            self.started_at = now_ts()
+            self._task = asyncio.get_running_loop().create_task(self.run(application))
+
+    async def stop(self):
+        """Останавливает цикл планировщика"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+reminder_scheduler = ReminderScheduler(repository)
+repository.add_listener(reminder_scheduler.notify)
+
+# Сколько напоминаний показывается на одной странице списка
+REMINDERS_PER_PAGE = 5
+# Короткие коды списков для callback_data пагинации (лимит Telegram - 64 байта)
+REMINDER_LIST_CODES = {'regular': 'r', 'ingredients': 'i'}
+# Ключ сортировки напоминаний без времени - в конец списка
+NO_DUE_SORT_TS = 2 ** 53
+
+def reminder_list_type(reminder):
+    """В каком списке показывается напоминание"""
+    return 'ingredients' if reminder.get('type') == 'ingredient' else 'regular'
+
+def reminder_sort_key(reminder_id, reminder):
+    """Ключ сортировки списка: время следующего срабатывания, при равенстве - ID (порядок стабилен)"""
+    due_ts = reminder.due_ts
+    return (due_ts if due_ts is not None else NO_DUE_SORT_TS, reminder_id)
+
+class ReminderListIndex:
+    """Отсортированные по времени срабатывания индексы напоминаний для каждого списка
+
+    Индекс обновляется по изменениям записей (подписка на хранилище), поэтому
+    страница списка - это бинарный поиск и срез, без перебора всех напоминаний.
+    """
+
+    def __init__(self, repository, name='reminders'):
+        self.repository = repository
+        self.name = name
+        self._lists = None
+        # reminder_id -> (список, ключ сортировки)
+        self._keys = {}
+        self._pending = set()
+
+    def notify(self, name, record_id):
+        """Слушатель хранилища: запись изменилась - пересчитаем ее позицию при следующем чтении"""
+        if name == self.name and self._lists is not None:
+            self._pending.add(record_id)
+
+    def _rebuild(self):
+        self._lists = {list_type: [] for list_type in REMINDER_LIST_CODES}
+        self._keys = {}
+        for reminder_id, reminder in self.repository.collection(self.name).items():
+            entry = (reminder_list_type(reminder), reminder_sort_key(reminder_id, reminder))
+            self._keys[reminder_id] = entry
+            self._lists[entry[0]].append(entry[1])
+        for keys in self._lists.values():
+            keys.sort()
+        self._pending.clear()
+
+    def _apply_pending(self):
+        records = self.repository.collection(self.name)
+        for reminder_id in self._pending:
+            reminder = records.get(reminder_id)
+            entry = None
+            if reminder is not None:
+                entry = (reminder_list_type(reminder), reminder_sort_key(reminder_id, reminder))
+            old = self._keys.get(reminder_id)
+            if old == entry:
+                continue
+            if old is not None:
+                keys = self._lists[old[0]]
+                position = bisect.bisect_left(keys, old[1])
+                if position < len(keys) and keys[position] == old[1]:
+                    del keys[position]
+                del self._keys[reminder_id]
+            if entry is not None:
+                bisect.insort(self._lists[entry[0]], entry[1])
+                self._keys[reminder_id] = entry
+        self._pending.clear()
+
+    def sorted_keys(self, list_type):
+        """Отсортированные ключи списка (актуальные на момент вызова)"""
+        if self._lists is None:
+            self._rebuild()
+        elif self._pending:
+            self._apply_pending()
+        return self._lists[list_type]
+
+    def page(self, list_type, after=None, before=None, offset=0, limit=REMINDERS_PER_PAGE):
+        """Страница списка после курсора after, перед курсором before или со смещения offset.
+
+        Возвращает (индекс первого элемента, [(reminder_id, напоминание)], всего в списке).
+        """
+        keys = self.sorted_keys(list_type)
+        if after is not None:
+            start = bisect.bisect_right(keys, after)
+        elif before is not None:
+            start = max(0, bisect.bisect_left(keys, before) - limit)
+        else:
+            start = max(0, offset)
+        if start >= len(keys):
+            # Курсор за концом списка (последние напоминания удалены) - показываем последнюю страницу
+            start = max(0, (len(keys) - 1) // limit * limit)
+        records = self.repository.collection(self.name)
+        items = [(reminder_id, records[reminder_id]) for _, reminder_id in keys[start:start + limit]]
+        return start, items, len(keys)
+
+reminder_list_index = ReminderListIndex(repository)
+repository.add_listener(reminder_list_index.notify)
+
+def reminders_page_callback(list_type, direction, key):
+    """callback_data кнопки страницы: rpage:<список>:<next|prev>:<время>:<ID> (курсор - ключ сортировки)"""
+    return callback_data("rpage", REMINDER_LIST_CODES[list_type], direction, key[0], key[1])
+
+def parse_reminders_page_cursor(args):
+    """Разбирает аргументы rpage: (список, направление, ключ) или None"""
+    if len(args) < 4:
+        return None
+    list_types = {code: list_type for list_type, code in REMINDER_LIST_CODES.items()}
+    list_type = list_types.get(args[0])
+    if list_type is None or args[1] not in ('next', 'prev'):
+        return None
+    try:
+        timestamp = int(args[2])
+    except ValueError:
+        return None
+    # ID мог содержать разделитель - собираем его обратно
+    return list_type, args[1], (timestamp, CALLBACK_SEPARATOR.join(args[3:]))
 
 async def start_recipe_editing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало редактирования рецепта"""
@@ -4392,12 +7085,7 @@ async def handle_recipe_editing(update: Update, context: ContextTypes.DEFAULT_TY
                 if plan.get('recipe_id') == recipe_id:
                     meal_plans_to_delete.append(plan_id)
                     # Удаляем напоминания для этого плана
-                    total_reminders_deleted += delete_meal_plan_reminders(plan_id)
-                    # Удаляем сообщения из чатов
-                    reminders = load_reminders()
-                    for reminder_id, reminder in reminders.items():
-                        if reminder.get('meal_plan_id') == plan_id:
-                            await delete_old_reminder_messages(context.application, reminder_id)
+                    total_reminders_deleted += await delete_meal_plan_reminders(plan_id)
 
             # Удаляем планы питания
             for plan_id in meal_plans_to_delete:
@@ -4407,8 +7095,15 @@ async def handle_recipe_editing(update: Update, context: ContextTypes.DEFAULT_TY
             del recipes[recipe_id]
 
             # Сохраняем изменения
-            save_recipes(recipes)
-            save_meal_plans(meal_plans)
+            if not await save_recipes(recipes) or not await save_meal_plans(meal_plans):
+                await query.edit_message_text(
+                    "❌ Ошибка при удалении рецепта: данные изменили параллельно, попробуйте еще раз.",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🍽 К рецептам", callback_data="back_to_recipes")]
+                    ])
+                )
+                context.user_data.clear()
+                return ConversationHandler.END
 
             await query.edit_message_text(
                 f"✅ Рецепт и связанные планы питания удалены.\n"
@@ -4489,21 +7184,13 @@ async def back_to_edit_recipe_menu(update: Update, context: ContextTypes.DEFAULT
     )
     return ConversationHandler.END
 
-def delete_meal_plan_reminders(plan_id):
-    """Удаляет все напоминания, связанные с планом питания"""
-    reminders = load_reminders()
-    reminders_to_delete = []
-
-    for reminder_id, reminder in reminders.items():
-        if reminder.get('meal_plan_id') == plan_id:
-            reminders_to_delete.append(reminder_id)
+async def delete_meal_plan_reminders(plan_id):
+    """Удаляет все напоминания, связанные с планом питания (и, через message_cleanup, их сообщения)"""
+    reminders_to_delete = await repository.find_ids('reminders', 'meal_plan_id', plan_id)
 
     # Удаляем найденные напоминания
     for reminder_id in reminders_to_delete:
-        del reminders[reminder_id]
-
-    if reminders_to_delete:
-        save_reminders(reminders)
+        repository.delete('reminders', reminder_id)
 
     return len(reminders_to_delete)
 
@@ -4584,9 +7271,9 @@ async def handle_edit_recipe_name(update: Update, context: ContextTypes.DEFAULT_
 
         old_name = recipe['name']
         recipe['name'] = new_name
-        recipe['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        recipe['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
 
-        if save_recipes(recipes):
+        if await save_recipes(recipes):
             # Редактируем сообщение с инструкцией, превращая его в меню редактирования
             instruction_message_id = context.user_data.get('edit_instruction_message_id')
             if instruction_message_id:
@@ -4738,9 +7425,9 @@ async def handle_edit_recipe_ingredients(update: Update, context: ContextTypes.D
 
         old_ingredients_count = len(recipe['ingredients'])
         recipe['ingredients'] = ingredients
-        recipe['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        recipe['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
 
-        if save_recipes(recipes):
+        if await save_recipes(recipes):
             # Редактируем сообщение с инструкцией, превращая его в меню редактирования
             instruction_message_id = context.user_data.get('edit_instruction_message_id')
             if instruction_message_id:
@@ -4899,11 +7586,13 @@ async def edit_meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text += f"🍽 *{plan['recipe_name']}*\n"
     text += f"📅 День: {plan['day']}\n"
     text += f"📅 Дата: {plan['date_str']}\n"
-    text += f"👥 Распределено: {assigned_count}/{len(plan['ingredients'])} ингредиентов\n\n"
+    text += f"👥 Распределено: {assigned_count}/{len(plan['ingredients'])} ингредиентов\n"
+    text += f"⏰ Время уведомлений: {plan.get('notify_at') or INGREDIENT_REMINDER_TIME + ' (по умолчанию)'}\n\n"
 
     keyboard = [
         [InlineKeyboardButton("👥 Изменить исполнителей", callback_data=f"change_assignees_{plan_id}")],
         [InlineKeyboardButton("📅 Изменить день", callback_data=f"change_plan_day_{plan_id}")],
+        [InlineKeyboardButton("⏰ Время уведомлений", callback_data=callback_data("plan_time", plan_id))],
         [InlineKeyboardButton("🗑 Удалить план", callback_data=f"delete_plan_{plan_id}")],
         [InlineKeyboardButton("🔙 Назад", callback_data="manage_plans")]
     ]
@@ -4933,7 +7622,7 @@ async def start_edit_plan_assignment(update: Update, context: ContextTypes.DEFAU
         return ConversationHandler.END
 
     context.user_data['editing_plan_id'] = plan_id
-    context.user_data['meal_plan'] = plan
+    context.user_data['meal_plan'] = copy.deepcopy(plan)
 
     # Показываем распределение ингредиентов для редактирования
     await show_edit_ingredient_assignment(query, context)
@@ -4983,6 +7672,7 @@ async def show_edit_ingredient_assignment(query, context):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+@locked_callback('plan', lambda update, context: context.user_data.get('editing_plan_id'))
 async def handle_edit_plan_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка редактирования исполнителей плана питания"""
     query = update.callback_query
@@ -5017,65 +7707,74 @@ async def finish_edit_assignment(query, context):
         meal_plan = context.user_data['meal_plan']
         plan_id = context.user_data['editing_plan_id']
 
-        # Обновляем план питания
-        meal_plans = load_meal_plans()
-        if plan_id in meal_plans:
+        def apply_assignment(plan):
+            # Черновик основан на версии плана на момент начала редактирования
+            if plan['version'] != meal_plan.get('version'):
+                raise VersionConflict('meal_plans', [plan_id])
             # Полностью заменяем ингредиенты на обновленные
-            meal_plans[plan_id]['ingredients'] = meal_plan['ingredients']
-            meal_plans[plan_id]['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
+            plan['ingredients'] = meal_plan['ingredients']
+            plan['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
 
-            if save_meal_plans(meal_plans):
-                logger.info(f"План питания {plan_id} успешно обновлен")
+        # Обновляем план питания
+        try:
+            updated_plan = await repository.update('meal_plans', plan_id, apply_assignment)
+        except VersionConflict:
+            logger.warning(f"⚠️ План {plan_id} изменен во время редактирования, изменения не применены")
+            await query.edit_message_text(
+                "⚠️ План питания изменили, пока вы его редактировали.\n"
+                "Откройте редактирование заново.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✏️ К плану", callback_data=f"edit_plan_{plan_id}")],
+                    [InlineKeyboardButton("🔙 К планам", callback_data="manage_plans")]
+                ])
+            )
+            context.user_data.clear()
+            return
 
-                # ПЕРЕСОЗДАЕМ НАПОМИНАНИЯ ДЛЯ ОБНОВЛЕННОГО РАСПРЕДЕЛЕНИЯ
-                if meal_plan.get('with_notifications'):
-                    reminders_created = await create_ingredient_reminders(meal_plan, context)
-                else:
-                    # Если уведомления отключены, удаляем старые напоминания
-                    reminders = load_reminders()
-                    reminders_to_delete = []
-                    for reminder_id, reminder in reminders.items():
-                        if reminder.get('meal_plan_id') == plan_id and reminder.get('type') == 'ingredient':
-                            reminders_to_delete.append(reminder_id)
+        if updated_plan:
+            logger.info(f"План питания {plan_id} успешно обновлен")
 
-                    for reminder_id in reminders_to_delete:
-                        del reminders[reminder_id]
+            # ПЕРЕСОЗДАЕМ НАПОМИНАНИЯ ДЛЯ ОБНОВЛЕННОГО РАСПРЕДЕЛЕНИЯ
+            if meal_plan.get('with_notifications'):
+                reminders_created = await create_ingredient_reminders(meal_plan, context)
+            else:
+                # Если уведомления отключены, удаляем старые напоминания
+                reminders = load_reminders()
+                reminders_to_delete = []
+                for reminder_id, reminder in reminders.items():
+                    if reminder.get('meal_plan_id') == plan_id and reminder.get('type') == 'ingredient':
+                        reminders_to_delete.append(reminder_id)
 
-                    if reminders_to_delete:
-                        save_reminders(reminders)
-                    reminders_created = 0
+                for reminder_id in reminders_to_delete:
+                    del reminders[reminder_id]
 
-                # Показываем подтверждение
-                assigned_count = sum(1 for ing in meal_plan['ingredients'] if ing.get('assigned_to'))
-                total_ingredients = len(meal_plan['ingredients'])
+                if reminders_to_delete and not await save_reminders(reminders):
+                    logger.error(f"❌ Не удалось удалить напоминания ингредиентов плана {plan_id}")
+                reminders_created = 0
 
-                text = f"✅ *Распределение ингредиентов обновлено!*\n\n"
-                text += f"🍽 *{meal_plan['recipe_name']}*\n"
-                text += f"📅 Дата: {meal_plan['date_str']}\n"
-                text += f"👥 Распределено: {assigned_count}/{total_ingredients} ингредиентов\n"
+            # Показываем подтверждение
+            assigned_count = sum(1 for ing in meal_plan['ingredients'] if ing.get('assigned_to'))
+            total_ingredients = len(meal_plan['ingredients'])
 
-                if meal_plan.get('with_notifications'):
-                    text += f"🔔 Обновлено напоминаний: {reminders_created}\n"
+            text = f"✅ *Распределение ингредиентов обновлено!*\n\n"
+            text += f"🍽 *{meal_plan['recipe_name']}*\n"
+            text += f"📅 Дата: {meal_plan['date_str']}\n"
+            text += f"👥 Распределено: {assigned_count}/{total_ingredients} ингредиентов\n"
 
-                if assigned_count < total_ingredients:
-                    text += "\n⚠️ *Внимание:* Не все ингредиенты распределены!\n"
+            if meal_plan.get('with_notifications'):
+                text += f"🔔 Обновлено напоминаний: {reminders_created}\n"
 
-                await query.edit_message_text(
-                    text,
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✏️ Продолжить редактирование", callback_data=f"edit_plan_{plan_id}")],
-                        [InlineKeyboardButton("🔙 К планам", callback_data="manage_plans")]
-                    ])
-                )
-            else:
-                logger.error(f"Ошибка сохранения плана {plan_id}")
-                await query.edit_message_text(
-                    "❌ Ошибка при сохранении изменений.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 К планам", callback_data="manage_plans")]
-                    ])
-                )
+            if assigned_count < total_ingredients:
+                text += "\n⚠️ *Внимание:* Не все ингредиенты распределены!\n"
+
+            await query.edit_message_text(
+                text,
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✏️ Продолжить редактирование", callback_data=f"edit_plan_{plan_id}")],
+                    [InlineKeyboardButton("🔙 К планам", callback_data="manage_plans")]
+                ])
+            )
         else:
             await query.edit_message_text(
                 "❌ План питания не найден.",
@@ -5095,6 +7794,75 @@ async def finish_edit_assignment(query, context):
 
     context.user_data.clear()
 
+@locked_callback('plan', callback_suffix("plan_time_"))
+async def handle_plan_notify_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выбор времени уведомлений плана питания: plan_time:<id> - меню, plan_time:<id>:<ЧЧММ|default> - выбор"""
+    query = update.callback_query
+    await query.answer()
+
+    plan_id = context.args[0] if context.args else None
+    meal_plans = load_meal_plans()
+    plan = meal_plans.get(plan_id) if plan_id else None
+    if not plan:
+        await query.edit_message_text(
+            "❌ План питания не найден.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data="manage_plans")]
+            ])
+        )
+        return
+
+    if len(context.args) < 2:
+        current = plan.get('notify_at')
+        keyboard = [
+            [InlineKeyboardButton(f"{'✅ ' if notify_at == current else ''}{notify_at}",
+                                  callback_data=callback_data("plan_time", plan_id, notify_at.replace(':', '')))]
+            for notify_at in PLAN_NOTIFY_TIMES
+        ]
+        keyboard.append([InlineKeyboardButton(f"{'✅ ' if not current else ''}По умолчанию ({INGREDIENT_REMINDER_TIME})",
+                                              callback_data=callback_data("plan_time", plan_id, "default"))])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"edit_plan_{plan_id}")])
+        await query.edit_message_text(
+            f"⏰ *Время уведомлений о покупках*\n\n"
+            f"🍽 {plan['recipe_name']}\n\n"
+            f"По умолчанию напоминания приходят около {INGREDIENT_REMINDER_TIME} "
+            f"(с небольшим разбросом), выбранное время соблюдается точно.",
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+
+    choice = context.args[1]
+    notify_at = None if choice == "default" else f"{choice[:2]}:{choice[2:]}"
+    if notify_at is not None and notify_at not in PLAN_NOTIFY_TIMES:
+        logger.error(f"❌ Неизвестное время уведомлений: {choice}")
+        return
+
+    def set_notify_at(draft):
+        draft['notify_at'] = notify_at
+        draft['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
+
+    plan = await repository.update('meal_plans', plan_id, set_notify_at)
+    reminders_created = 0
+    if plan is not None and plan.get('with_notifications'):
+        # Пересоздаем напоминания ингредиентов на новое время (их сообщения удалит message_cleanup)
+        await delete_meal_plan_reminders(plan_id)
+        reminders_created = await create_ingredient_reminders(plan, context.application)
+
+    text = f"✅ Время уведомлений: {notify_at or INGREDIENT_REMINDER_TIME + ' (по умолчанию)'}"
+    if plan is None:
+        text = "❌ Ошибка при сохранении изменений."
+    elif reminders_created > 0:
+        text += f"\n🔔 Напоминаний перенесено: {reminders_created}"
+    logger.info(f"⏰ Время уведомлений плана {plan_id}: {notify_at or 'по умолчанию'}")
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✏️ Продолжить редактирование", callback_data=f"edit_plan_{plan_id}")],
+            [InlineKeyboardButton("🔙 К планам", callback_data="manage_plans")]
+        ])
+    )
+
 async def update_ingredient_reminders_for_plan(plan_id, new_date, new_date_str):
     """Обновляет напоминания для ингредиентов при изменении даты плана питания"""
     try:
@@ -5135,8 +7903,8 @@ async def update_ingredient_reminders_for_plan(plan_id, new_date, new_date_str):
                 }.get(notification_time, 1)
 
                 reminder_date = new_date - timedelta(days=days_before)
-                reminder_datetime = reminder_date.replace(hour=10, minute=0, second=0)
-                reminder['datetime'] = reminder_datetime.isoformat()
+                reminder_datetime = ingredient_reminder_time(plan, reminder_date)
+                reminder['datetime'] = int(reminder_datetime.timestamp())
 
                 # Если напоминание в срочном режиме, сбрасываем его
                 if reminder.get('urgent_reminders'):
@@ -5148,7 +7916,7 @@ async def update_ingredient_reminders_for_plan(plan_id, new_date, new_date_str):
                 logger.info(f"Обновлено напоминание ингредиента {reminder_id} для плана {plan_id}")
 
         if updated_count > 0:
-            if not save_reminders(reminders):
+            if not await save_reminders(reminders):
                 logger.error("Ошибка при сохранении обновленных напоминаний")
                 return 0
 
@@ -5168,13 +7936,8 @@ async def update_meal_plan_day(application, plan_id, new_day_key):
             logger.error(f"❌ План питания {plan_id} не найден")
             return False
 
-        # Получаем текущую дату плана
-        current_date = plan['date']
-        if isinstance(current_date, str):
-            current_date = datetime.fromisoformat(current_date)
-
         # Вычисляем новую дату на основе выбранного дня недели
-        today = datetime.now(MOSCOW_TZ)
+        today = datetime.now(DEFAULT_TZ)
         current_weekday = today.weekday()
         target_weekday = list(WEEK_DAYS.keys()).index(new_day_key)
 
@@ -5187,12 +7950,12 @@ async def update_meal_plan_day(application, plan_id, new_day_key):
 
         # Обновляем план
         plan['day'] = WEEK_DAYS[new_day_key]
-        plan['date'] = new_date.isoformat()
+        plan['date'] = int(new_date.timestamp())
         plan['date_str'] = new_date_str
-        plan['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        plan['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
 
         # Сохраняем изменения
-        if not save_meal_plans(meal_plans):
+        if not await save_meal_plans(meal_plans):
             logger.error("❌ Ошибка при сохранении обновленного плана")
             return False
 
@@ -5210,28 +7973,17 @@ async def update_meal_plan_day(application, plan_id, new_day_key):
 async def update_meal_plan_reminders(plan_id, meal_plan, context):
     """Обновляет напоминания для плана питания после изменения распределения"""
     try:
-        reminders = load_reminders()
         updated_count = 0
 
-        # Удаляем старые напоминания для этого плана
-        reminders_to_delete = []
-        for reminder_id, reminder in reminders.items():
-            if reminder.get('meal_plan_id') == plan_id:
-                reminders_to_delete.append(reminder_id)
-
-        for reminder_id in reminders_to_delete:
-            del reminders[reminder_id]
+        # Удаляем старые напоминания для этого плана (их сообщения удалит message_cleanup)
+        deleted_count = await delete_meal_plan_reminders(plan_id)
 
         # Создаем новые напоминания на основе обновленного распределения
         if meal_plan.get('with_notifications', False):
             reminders_created = await create_ingredient_reminders(meal_plan, context)
             updated_count = reminders_created
-        else:
-            # Если уведомления отключены, просто сохраняем пустой список
-            save_reminders(reminders)
-            updated_count = 0
 
-        logger.info(f"Обновлены напоминания для плана {plan_id}: удалено {len(reminders_to_delete)}, создано {updated_count}")
+        logger.info(f"Обновлены напоминания для плана {plan_id}: удалено {deleted_count}, создано {updated_count}")
         return updated_count
 
     except Exception as e:
@@ -5267,6 +8019,7 @@ async def handle_change_plan_day(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+@locked_callback('plan', callback_suffix("delete_plan_"))
 async def handle_delete_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка удаления плана питания с удалением всех связанных напоминаний и сообщений"""
     query = update.callback_query
@@ -5287,20 +8040,14 @@ async def handle_delete_plan(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Сохраняем информацию о плане для сообщения
     plan_name = meal_plans[plan_id]['recipe_name']
 
-    # УДАЛЯЕМ ВСЕ СВЯЗАННЫЕ НАПОМИНАНИЯ И СООБЩЕНИЯ
-    reminders_deleted = delete_meal_plan_reminders(plan_id)
-
-    # Дополнительно удаляем сообщения из чатов
-    reminders = load_reminders()
-    for reminder_id, reminder in reminders.items():
-        if reminder.get('meal_plan_id') == plan_id:
-            await delete_old_reminder_messages(context.application, reminder_id)
+    # УДАЛЯЕМ ВСЕ СВЯЗАННЫЕ НАПОМИНАНИЯ (их сообщения удалит message_cleanup)
+    reminders_deleted = await delete_meal_plan_reminders(plan_id)
 
     # Удаляем план питания
     del meal_plans[plan_id]
 
     # Сохраняем изменения
-    plans_saved = save_meal_plans(meal_plans)
+    plans_saved = await save_meal_plans(meal_plans)
 
     if plans_saved:
         text = f"✅ *План питания удален!*\n\n"
@@ -5343,6 +8090,7 @@ async def back_to_edit_plan_handler(update: Update, context: ContextTypes.DEFAUL
             ])
         )
 
+@locked_callback('plan', lambda update, context: update.callback_query.data.split('_')[3])
 async def handle_update_plan_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обновление дня плана питания с удалением старых напоминаний"""
     query = update.callback_query
@@ -5365,7 +8113,7 @@ async def handle_update_plan_day(update: Update, context: ContextTypes.DEFAULT_T
     day_name = WEEK_DAYS[day_key]
 
     # Обновляем дату
-    today = datetime.now(MOSCOW_TZ)
+    today = datetime.now(DEFAULT_TZ)
     current_weekday = today.weekday()
     target_weekday = list(WEEK_DAYS.keys()).index(day_key)
 
@@ -5379,21 +8127,15 @@ async def handle_update_plan_day(update: Update, context: ContextTypes.DEFAULT_T
     # Обновляем план
     meal_plans = load_meal_plans()
     if plan_id in meal_plans:
-        # УДАЛЯЕМ ВСЕ СТАРЫЕ НАПОМИНАНИЯ ДЛЯ ЭТОГО ПЛАНА
-        deleted_reminders_count = delete_meal_plan_reminders(plan_id)
-
-        # Также удаляем сообщения из чатов
-        reminders = load_reminders()
-        for reminder_id, reminder in reminders.items():
-            if reminder.get('meal_plan_id') == plan_id:
-                await delete_old_reminder_messages(context.application, reminder_id)
+        # УДАЛЯЕМ ВСЕ СТАРЫЕ НАПОМИНАНИЯ ДЛЯ ЭТОГО ПЛАНА (их сообщения удалит message_cleanup)
+        deleted_reminders_count = await delete_meal_plan_reminders(plan_id)
 
         meal_plans[plan_id]['day'] = day_name
-        meal_plans[plan_id]['date'] = new_date.isoformat()
+        meal_plans[plan_id]['date'] = int(new_date.timestamp())
         meal_plans[plan_id]['date_str'] = new_date_str
-        meal_plans[plan_id]['updated_at'] = datetime.now(MOSCOW_TZ).isoformat()
+        meal_plans[plan_id]['updated_at'] = datetime.now(DEFAULT_TZ).isoformat()
 
-        if save_meal_plans(meal_plans):
+        if await save_meal_plans(meal_plans):
             # СОЗДАЕМ НОВЫЕ НАПОМИНАНИЯ, если у плана включены уведомления
             plan = meal_plans[plan_id]
             reminders_created = 0
@@ -5422,288 +8164,18 @@ async def handle_update_plan_day(update: Update, context: ContextTypes.DEFAULT_T
                 ])
             )
 
-async def check_and_send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    """Объединенная проверка всех типов напоминаний"""
-    try:
-        application = context.application
-        total_sent = 0
-
-        # Вызываем функцию для проверки обычных напоминаний
-        regular_sent = await check_regular_reminders(application)
-        total_sent += regular_sent
-
-        # Вызываем функцию для проверки напоминаний ингредиентов
-        ingredient_sent = await check_ingredient_reminders(application)
-        total_sent += ingredient_sent
-
-        if total_sent > 0:
-            logger.info(f"✅ Всего отправлено напоминаний: {total_sent} (обычные: {regular_sent}, ингредиенты: {ingredient_sent})")
-
-        return total_sent
-
-    except Exception as e:
-        logger.error(f"❌ Ошибка в check_and_send_reminders: {e}")
-        return 0
-
-async def check_regular_reminders(application):
-
-    """Проверяет и отправляет обычные напоминания с удалением через 24 часа после последней отправки"""
-    try:
-        reminders = load_reminders()
-        users = load_users()
-        current_time = datetime.now(MOSCOW_TZ)
-
-        # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ
-        current_hour = current_time.hour
-        is_night_time = current_hour >= 23 or current_hour < 9
-
-        logger.info(f"🔍 Проверка обычных напоминаний в {current_time.strftime('%d.%m.%Y %H:%M:%S')} МСК")
-
-        sent_count = 0
-        reminders_to_update = []
-        reminders_to_remove = []
-
-        # ПРОВЕРКА АКТУАЛЬНОСТИ СУЩЕСТВУЮЩИХ СООБЩЕНИЙ
-        await cleanup_old_messages(application, reminders)
-
-        for reminder_id, reminder in reminders.items():
-            try:
-                # Пропускаем напоминания ингредиентов
-                if reminder.get('type') == 'ingredient':
-                    continue
-
-                reminder_time = datetime.fromisoformat(reminder['datetime']).replace(tzinfo=MOSCOW_TZ)
-                time_diff_minutes = (reminder_time - current_time).total_seconds() / 60
-
-                # ПРОВЕРКА: УДАЛЕНИЕ ОДНОКРАТНЫХ НАПОМИНАНИЙ ЧЕРЕЗ 24 ЧАСА ПОСЛЕ ПОСЛЕДНЕЙ ОТПРАВКИ
-                last_sent = reminder.get('last_sent')
-                if last_sent and reminder.get('interval_days', 0) == 0:
-                    last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                    hours_since_last_sent = (current_time - last_sent_time).total_seconds() / 3600
-
-                    # Если прошло более 24 часов с последней отправки и это однократное напоминание
-                    if hours_since_last_sent >= 24:
-                        reminders_to_remove.append(reminder_id)
-                        await delete_old_reminder_messages(application, reminder_id)
-                        logger.info(f"🗑 Однократное напоминание {reminder_id} удалено через 24 часа после последней отправки")
-                        continue
-
-                # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ ДЛЯ СРОЧНЫХ НАПОМИНАНИЙ
-                if is_night_time and reminder.get('urgent_reminders'):
-                    logger.info(f"🌙 Пропущена проверка срочного напоминания в ночное время: {reminder_id}")
-                    continue
-
-                # Проверяем истек ли срочный режим
-                urgent_until = reminder.get('urgent_until')
-                if urgent_until:
-                    urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                    if current_time > urgent_until_time:
-                        # СРОЧНЫЙ РЕЖИМ ИСТЕК
-                        interval_days = reminder.get('interval_days', 0)
-
-                        if interval_days == 0:
-                            # ОДНОКРАТНОЕ НАПОМИНАНИЕ - полное удаление
-                            reminders_to_remove.append(reminder_id)
-                            await delete_old_reminder_messages(application, reminder_id)
-                            logger.info(f"🗑 Однократное срочное напоминание {reminder_id} удалено по истечении срочного режима")
-                            continue
-                        else:
-                            # ИНТЕРВАЛЬНОЕ НАПОМИНАНИЕ - восстанавливаем обычный режим
-                            original_interval = reminder.get('original_interval', interval_days)
-                            original_datetime_str = reminder.get('original_datetime')
-
-                            if original_datetime_str:
-                                original_datetime = datetime.fromisoformat(original_datetime_str).replace(tzinfo=MOSCOW_TZ)
-                                days_passed = (current_time.date() - original_datetime.date()).days
-                                intervals_passed = days_passed // original_interval
-                                next_interval_date = original_datetime + timedelta(days=(intervals_passed + 1) * original_interval)
-
-                                if next_interval_date <= current_time:
-                                    next_interval_date += timedelta(days=original_interval)
-
-                                reminder['datetime'] = next_interval_date.isoformat()
-                                logger.info(f"🔄 Интервальное напоминание восстановлено: {next_interval_date.strftime('%d.%m.%Y %H:%M')}")
-
-                            # Снимаем срочный режим и удаляем старые сообщения
-                            reminder['urgent_reminders'] = False
-                            reminder['urgent_until'] = None
-                            reminder['last_sent'] = None
-                            reminders_to_update.append(reminder_id)
-
-                            # УДАЛЯЕМ ВСЕ СТАРЫЕ СООБЩЕНИЯ ДЛЯ ЭТОГО НАПОМИНАНИЯ
-                            await delete_old_reminder_messages(application, reminder_id)
-                            logger.info(f"🔄 Срочный режим истек для {reminder_id}, восстановлен обычный режим")
-                            continue
-
-                should_send = False
-                send_reason = ""
-
-                # Для срочных напоминаний
-                if reminder.get('urgent_reminders'):
-                    if not last_sent:
-                        should_send = True
-                        send_reason = "первое срочное напоминание"
-                    else:
-                        last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                        hours_since_last = (current_time - last_sent_time).total_seconds() / 3600
-
-                        if hours_since_last >= 3:
-                            should_send = True
-                            send_reason = f"срочное напоминание (прошло {hours_since_last:.1f} ч.)"
-
-                # Для обычных напоминаний (только если не срочные)
-                elif not reminder.get('urgent_reminders'):
-                    # Если напоминание уже отправлялось сегодня, пропускаем
-                    if last_sent:
-                        last_sent_time = datetime.fromisoformat(last_sent).replace(tzinfo=MOSCOW_TZ)
-                        if last_sent_time.date() == current_time.date():
-                            continue
-
-                    # ОТПРАВЛЯЕМ ДАЖЕ ЕСЛИ ПРОСРОЧЕНО (время напоминания уже прошло)
-                    if time_diff_minutes <= 30:  # Отправляем если время напоминания прошло не более чем 30 минут назад
-                        should_send = True
-                        send_reason = "обычное напоминание"
-                    elif time_diff_minutes < 0:  # Если просрочено более чем на 30 минут, все равно отправляем один раз
-                        should_send = True
-                        send_reason = "просроченное напоминание"
-
-                if should_send:
-                    logger.info(f"⏰ ОТПРАВКА ({send_reason}): {reminder['text'][:30]}... (тип: {reminder.get('type', 'personal')})")
-
-                    await send_reminder_notification(application, reminder, users, is_urgent_update=reminder.get('urgent_reminders', False))
-                    sent_count += 1
-
-                    reminder['last_sent'] = current_time.isoformat()
-
-                    # Планируем следующее напоминание
-                    if reminder.get('urgent_reminders'):
-                        # Срочное - через 3 часа
-                        next_time = current_time + timedelta(hours=3)
-                        if next_time.hour >= 23 or next_time.hour < 9:
-                            next_time = next_time.replace(hour=9, minute=0, second=0)
-                            if next_time <= current_time:
-                                next_time += timedelta(days=1)
-                        reminder['datetime'] = next_time.isoformat()
-                        logger.info(f"🔁 Следующее срочное напоминание через 3 часа: {next_time.strftime('%d.%m.%Y %H:%M')}")
-                    else:
-                        # Обычное - по интервалу
-                        interval_days = reminder.get('interval_days', 0)
-                        if interval_days > 0:
-                            next_time = reminder_time + timedelta(days=interval_days)
-                            reminder['datetime'] = next_time.isoformat()
-                            logger.info(f"🔄 Следующее интервальное напоминание через {interval_days} дней: {next_time.strftime('%d.%m.%Y %H:%M')}")
-                        else:
-                            # ОДНОКРАТНОЕ НАПОМИНАНИЕ - не удаляем сразу, удалим через 24 часа после отправки
-                            logger.info(f"⏰ Однократное напоминание {reminder_id} отправлено, будет удалено через 24 часа")
-
-                    reminders_to_update.append(reminder_id)
-
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки напоминания {reminder_id}: {e}")
-                continue
-
-        # УДАЛЯЕМ НАПОМИНАНИЯ, ПОМЕЧЕННЫЕ ДЛЯ УДАЛЕНИЯ
-        for reminder_id in reminders_to_remove:
-            if reminder_id in reminders:
-                del reminders[reminder_id]
-                logger.info(f"✅ Удалено напоминание {reminder_id}")
-
-        # Сохраняем изменения
-        if reminders_to_update or reminders_to_remove or sent_count > 0:
-            if not save_reminders(reminders):
-                logger.error("❌ Ошибка при записи напоминаний")
-            else:
-                logger.info(f"📤 ИТОГ: Отправлено {sent_count}, обновлено {len(reminders_to_update)}, удалено {len(reminders_to_remove)}")
-
-        return sent_count
-
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка в check_regular_reminders: {e}")
-        return 0
+async def send_reminder_notification(application, reminder, users, is_urgent_update=False, is_missed=False, due_ts=None):
+    """Отправляет уведомление-напоминание с управлением старыми сообщениями и учетом тихих часов получателей
 
-async def send_reminder_notification(application, reminder, users, is_urgent_update=False, is_missed=False):
-    """Отправляет уведомление-напоминание с управлением старыми сообщениями и проверкой ночного времени"""
+    due_ts - показываемое время, если оно отличается от уже перенесенного времени напоминания.
+    """
     try:
-        current_time = datetime.now(MOSCOW_TZ)
-
-        # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ ДЛЯ ВСЕХ ТИПОВ НАПОМИНАНИЙ
-        current_hour = current_time.hour
-        is_night_time = current_hour >= 23 or current_hour < 9
-
-        # Если ночное время и это не пропущенное напоминание, пропускаем отправку
-        if is_night_time and not is_missed:
-            logger.info(f"🌙 Пропущена отправка в ночное время (сейчас {current_time.strftime('%H:%M')})")
-            return
-        # Если это обновление срочного напоминания, удаляем старые сообщения
-        if is_urgent_update:
-            await delete_old_reminder_messages(application, reminder['id'])
-
-        # Определяем, кто должен купить
-        assigned_users = []
-        for user_id in reminder['users']:
-            user_data = users.get(str(user_id), {})
-            username = user_data.get('username', 'Unknown')
-            assigned_users.append(username)
-
-        # Формируем текст напоминания
-        current_time = datetime.now(MOSCOW_TZ)
-
-        # Базовый текст в зависимости от типа
-        if is_missed:
-            message_text = f"⏰ *ПРОПУЩЕННОЕ НАПОМИНАНИЕ!*\n\n"
-        else:
-            message_text = f"🔔 *НАПОМИНАНИЕ!*\n\n"
-
-        # Основной текст напоминания
-        message_text += f"{reminder['text']}\n\n"
-
-        # Информация о пользователях
-        if assigned_users:
-            message_text += f"👤 *Для:* {', '.join(assigned_users)}\n"
-
-        # Информация о времени
-        reminder_time = datetime.fromisoformat(reminder['datetime']).replace(tzinfo=MOSCOW_TZ)
-        if is_missed:
-            message_text += f"⏰ *Должно было прийти:* {reminder_time.strftime('%d.%m.%Y %H:%M')}\n"
-        else:
-            message_text += f"⏰ *Время:* {reminder_time.strftime('%d.%m.%Y %H:%M')}\n"
-
-        # Информация о интервале
-        interval_days = reminder.get('interval_days', 0)
-        if interval_days > 0:
-            interval_text = f"каждые {interval_days} дней"
-        else:
-            interval_text = "однократно"
-        message_text += f"🔄 *Повтор:* {interval_text}\n"
-
-        # Информация о срочности
-        if reminder.get('urgent_reminders'):
-            urgent_until = reminder.get('urgent_until')
-            if urgent_until:
-                urgent_until_time = datetime.fromisoformat(urgent_until).replace(tzinfo=MOSCOW_TZ)
-                time_left = urgent_until_time - current_time
-                hours_left = max(0, int(time_left.total_seconds() / 3600))
-                message_text += f"🚨 *СРОЧНОЕ* (осталось {hours_left}ч.)\n\n"
-            else:
-                message_text += "🚨 *СРОЧНОЕ* (повтор каждые 3 часа)\n\n"
-        else:
-            message_text += "\n"
+        now = now_ts()
+        hours_left = urgent_hours_left(reminder, now)
+        if due_ts is None:
+            due_ts = reminder.due_ts
 
-        # Дополнительная информация для пропущенных напоминаний
-        if is_missed:
-            message_text += "💡 *Примечание:* Это напоминание должно было прийти ранее, но было пропущено.\n\n"
-
-        # Создаем кнопки
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Купил", callback_data=f"bought_{reminder['id']}"),
-                InlineKeyboardButton("❌ Еще не купил", callback_data=f"not_bought_{reminder['id']}")
-            ]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Отправляем каждому пользователю и сохраняем ID сообщений
+        # Ставим в очередь отправку каждому пользователю (ID сообщений запоминаются после доставки)
         for user_id in reminder['users']:
             try:
                 # Преобразуем user_id в int
@@ -5713,25 +8185,24 @@ async def send_reminder_notification(application, reminder, users, is_urgent_upd
                     logger.error(f"❌ Неверный формат user_id: {user_id}, ошибка: {e}")
                     continue
 
-                # ПРОВЕРКА НОЧНОГО ВРЕМЕНИ (23:00 - 9:00)
-                current_hour = current_time.hour
-
-                # Если ночное время (23:00 - 9:00) и это не срочное напоминание, пропускаем отправку
-                if not reminder.get('urgent_reminders') and (current_hour >= 23 or current_hour < 9):
-                    logger.info(f"🌙 Пропущена отправка в ночное время для пользователя {user_id_int} (сейчас {current_time.strftime('%H:%M')})")
+                # Тихие часы пользователя: не отправляем (планировщик учитывает их заранее)
+                quiet_hours = quiet_hours_for(user_id_int)
+                if quiet_hours.is_quiet(now):
+                    logger.info(f"🌙 Пропущена отправка в тихие часы для пользователя {user_id_int} (сейчас {local_time(now, quiet_hours.tz).strftime('%H:%M')})")
                     continue
 
-                message = await application.bot.send_message(
-                    chat_id=user_id_int,
-                    text=message_text,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
+                # Текст и кнопки - из кэша отрисовки (одинаковы для получателей из одного пояса)
+                tz = user_timezone(user_id_int)
+                message_text, reply_markup = render_cache.get_or_render(
+                    reminder, ('regular', is_missed, hours_left, tz.key, due_ts),
+                    lambda: render_reminder_notification(reminder, users, is_missed, hours_left, tz, due_ts)
                 )
 
-                # Сохраняем ID нового сообщения с правильным форматом
-                save_message_id(reminder['id'], user_id_int, message.message_id)
-
-                logger.info(f"✅ Уведомление отправлено пользователю {user_id_int} с message_id {message.message_id}")
+                # Обновление срочного напоминания редактирует уже отправленное сообщение
+                if is_urgent_update:
+                    enqueue_notification_update(application, reminder['id'], user_id_int, message_text, reply_markup)
+                else:
+                    enqueue_notification(application, reminder['id'], user_id_int, message_text, reply_markup)
 
             except Exception as e:
                 logger.error(f"❌ Ошибка отправки уведомления пользователю {user_id}: {e}")
@@ -5739,6 +8210,46 @@ async def send_reminder_notification(application, reminder, users, is_urgent_upd
     except Exception as e:
         logger.error(f"❌ Ошибка в send_reminder_notification: {e}")
 
+def activate_urgent_mode(reminder, now, next_urgent_ts):
+    """Включает срочный режим после "Еще не купил": повтор каждые 3 часа, следующий - в next_urgent_ts"""
+    reminder_type = reminder.get('type', 'personal')
+    # ДЛЯ ИНГРЕДИЕНТОВ: срочный режим работает до дня приготовления
+    if reminder_type == 'ingredient':
+        # Устанавливаем срочный режим для ингредиента
+        reminder['urgent_reminders'] = True
+
+        # Устанавливаем urgent_until на день приготовления (в 00:00)
+        meal_date_str = reminder.get('meal_date')
+        if meal_date_str:
+            try:
+                # Начало дня приготовления (планы питания живут в поясе по умолчанию)
+                meal_date = datetime.strptime(meal_date_str, '%d.%m.%Y').replace(tzinfo=DEFAULT_TZ)
+                reminder['urgent_until'] = int(meal_date.timestamp())
+                logger.info(f"⏰ Срочный режим для ингредиента установлен до дня приготовления: {meal_date_str}")
+            except ValueError as e:
+                logger.error(f"❌ Ошибка парсинга даты приготовления: {e}")
+                # Резервный вариант: 24 часа
+                reminder['urgent_until'] = now + ONE_TIME_REMINDER_TTL
+        else:
+            # Резервный вариант: 24 часа
+            reminder['urgent_until'] = now + ONE_TIME_REMINDER_TTL
+
+    else:
+        # Обычные напоминания - 24 часа срочного режима
+        reminder['urgent_reminders'] = True
+        reminder['urgent_until'] = now + ONE_TIME_REMINDER_TTL
+
+    # Для интервальных напоминаний сохраняем оригинальные данные
+    interval_days = reminder.get('interval_days', 0)
+    if interval_days > 0:
+        reminder['original_interval'] = interval_days
+        reminder['original_datetime'] = reminder['datetime']
+
+    reminder['datetime'] = next_urgent_ts
+    reminder['not_bought_count'] = reminder.get('not_bought_count', 0) + 1
+    reminder['last_sent'] = None
+
+@locked_callback('reminder', callback_suffix("bought_", "not_bought_"))
 async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка кнопок 'Купил' и 'Еще не купил' для всех типов напоминаний"""
     query = update.callback_query
@@ -5747,8 +8258,11 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
     data = query.data
     logger.info(f"🟢 ОБРАБОТКА КНОПКИ: {data}")
 
-    # Извлекаем reminder_id из callback_data
-    if data.startswith("bought_"):
+    # Извлекаем reminder_id из callback_data: bought:<id> или старый формат bought_<id>
+    action, args = parse_callback_data(data)
+    if action in ("bought", "not_bought") and args:
+        reminder_id = args[0]
+    elif data.startswith("bought_"):
         reminder_id = data.replace("bought_", "")
         action = "bought"
     elif data.startswith("not_bought_"):
@@ -5765,12 +8279,8 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
 
     if not reminder:
         logger.error(f"❌ Напоминание с ID {reminder_id} не найдено в базе")
-        await query.edit_message_text("❌ Напоминание не найдено.")
-        await asyncio.sleep(3)
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения: {e}")
+        reply_message = await reply_to_notification(query, reminder_id, "❌ Напоминание не найдено.")
+        schedule_message_deletion(context, reply_message)
         return
 
     user_id = str(query.from_user.id)
@@ -5782,14 +8292,11 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
 
     if action == "bought":
         # НЕМЕДЛЕННО УДАЛЯЕМ СООБЩЕНИЕ ИЗ БАЗЫ message_ids
-        message_ids = load_message_ids()
-        user_message_key = f"{reminder_id}_{user_id}"
-        if user_message_key in message_ids:
-            del message_ids[user_message_key]
-            save_message_ids_to_file(message_ids)
+        if message_store.discard(reminder_id, user_id):
             logger.info(f"🗑 Удален message_id для пользователя {user_id} и reminder {reminder_id}")
 
-        # ОБРАБОТКА "КУПИЛ" ДЛЯ ВСЕХ ТИПОВ
+        # ОБРАБОТКА "КУПИЛ" ДЛЯ ВСЕХ ТИПОВ (ответ заменяет уведомление, в сводке - только его пункт)
+        reply_message = query.message
         reminder_type = reminder.get('type', 'personal')
 
         # Для ингредиентов создаем план на следующую неделю и удаляем напоминание
@@ -5798,7 +8305,7 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
 
             # Удаляем напоминание ингредиента
             del reminders[reminder_id]
-            if not save_reminders(reminders):
+            if not await save_reminders(reminders):
                 logger.error("❌ Ошибка при удалении напоминания ингредиента")
                 await query.edit_message_text("❌ Ошибка при обработке. Попробуйте снова.")
                 return
@@ -5813,7 +8320,8 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
                     # РАЗЛИЧНЫЕ СЦЕНАРИИ УСПЕХА
                     if result == "plan_already_exists":
                         # План уже был создан ранее (при обработке другого ингредиента)
-                        await query.edit_message_text(
+                        reply_message = await reply_to_notification(
+                            query, reminder_id,
                             f"✅ {username} подтвердил(а) покупку.\n"
                             f"🍽 Напоминание удалено.\n"
                             f"📅 План на следующую неделю уже был создан ранее!"
@@ -5821,7 +8329,8 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
                         logger.info(f"✅ План на следующую неделю уже существует для {meal_plan_id}")
                     elif result:
                         # План успешно создан
-                        await query.edit_message_text(
+                        reply_message = await reply_to_notification(
+                            query, reminder_id,
                             f"✅ {username} подтвердил(а) покупку.\n"
                             f"🍽 Напоминание удалено.\n"
                             f"📅 Автоматически создан план на следующую неделю!"
@@ -5829,7 +8338,8 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
                         logger.info(f"✅ Успешно создан план на следующую неделю: {result}")
                     else:
                         # Не удалось создать план
-                        await query.edit_message_text(
+                        reply_message = await reply_to_notification(
+                            query, reminder_id,
                             f"✅ {username} подтвердил(а) покупку.\n"
                             f"🍽 Напоминание удалено.\n"
                             f"⚠️ Не удалось создать план на следующую неделю."
@@ -5838,13 +8348,15 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
 
                 except Exception as e:
                     logger.error(f"❌ Исключение при создании плана на следующую неделю: {e}")
-                    await query.edit_message_text(
+                    reply_message = await reply_to_notification(
+                        query, reminder_id,
                         f"✅ {username} подтвердил(а) покупку.\n"
                         f"🍽 Напоминание удалено.\n"
                         f"⚠️ Ошибка при создании плана на следующую неделю."
                     )
             else:
-                await query.edit_message_text(
+                reply_message = await reply_to_notification(
+                    query, reminder_id,
                     f"✅ {username} подтвердил(а) покупку.\n"
                     f"🍽 Напоминание удалено."
                 )
@@ -5853,11 +8365,11 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
             interval_days = reminder.get('interval_days', 0)
             if interval_days > 0:
                 # Интервальное напоминание - планируем следующее
-                current_time = datetime.now(MOSCOW_TZ)
-                next_reminder_time = current_time + timedelta(days=interval_days)
+                tz = reminder_timezone(reminder)
+                next_reminder_time = local_time(add_local_days(now_ts(), interval_days, tz), tz)
 
-                # Сохраняем оригинальное время
-                original_time = datetime.fromisoformat(reminder['datetime']).replace(tzinfo=MOSCOW_TZ)
+                # Сохраняем оригинальное местное время
+                original_time = local_time(reminder.due_ts, tz)
                 next_reminder_time = next_reminder_time.replace(
                     hour=original_time.hour,
                     minute=original_time.minute,
@@ -5865,19 +8377,23 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
                     microsecond=0
                 )
 
-                reminder['datetime'] = next_reminder_time.isoformat()
-                # Снимаем срочный режим если был
-                reminder['urgent_reminders'] = False
-                reminder['urgent_until'] = None
-                reminder['last_sent'] = None
+                def schedule_next(draft):
+                    draft['datetime'] = int(next_reminder_time.timestamp())
+                    # Снимаем срочный режим если был
+                    draft['urgent_reminders'] = False
+                    draft['urgent_until'] = None
+                    draft['last_sent'] = None
 
-                if not save_reminders(reminders):
+                updated = await repository.update('reminders', reminder_id, schedule_next)
+                if updated is None:
                     logger.error("❌ Ошибка при сохранении напоминания")
                 else:
+                    reminder = updated
                     logger.info(f"✅ Напоминание обновлено: urgent_reminders={reminder['urgent_reminders']}, urgent_until={reminder['urgent_until']}")
 
                 next_time_str = next_reminder_time.strftime('%d.%m.%Y %H:%M')
-                await query.edit_message_text(
+                reply_message = await reply_to_notification(
+                    query, reminder_id,
                     f"✅ {username} подтвердил(а) покупку.\n"
                     f"🔄 Следующее напоминание будет {next_time_str}.\n"
                     f"📝 Текст: {reminder['text'][:50]}..."
@@ -5885,103 +8401,153 @@ async def handle_bought_not_bought(update: Update, context: ContextTypes.DEFAULT
             else:
                 # Однократное напоминание - удаляем
                 del reminders[reminder_id]
-                if not save_reminders(reminders):
+                if not await save_reminders(reminders):
                     logger.error("❌ Ошибка при удалении напоминания")
                 else:
                     logger.info(f"✅ Однократное напоминание {reminder_id} удалено")
 
-                await query.edit_message_text(
+                reply_message = await reply_to_notification(
+                    query, reminder_id,
                     f"✅ {username} подтвердил(а) покупку.\n"
                     f"🗑 Напоминание удалено.\n"
                     f"📝 Текст: {reminder['text'][:50]}..."
                 )
 
-        await asyncio.sleep(3)
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения: {e}")
+        schedule_message_deletion(context, reply_message)
 
     elif action == "not_bought":
         # ОБРАБОТКА "ЕЩЕ НЕ КУПИЛ" ДЛЯ ВСЕХ ТИПОВ
-        current_time = datetime.now(MOSCOW_TZ)
+        now = now_ts()
         reminder_type = reminder.get('type', 'personal')
 
-        # ДЛЯ ИНГРЕДИЕНТОВ: срочный режим работает до дня приготовления
-        if reminder_type == 'ingredient':
-            # Устанавливаем срочный режим для ингредиента
-            reminder['urgent_reminders'] = True
-
-            # Устанавливаем urgent_until на день приготовления (в 00:00)
-            meal_date_str = reminder.get('meal_date')
-            if meal_date_str:
-                try:
-                    meal_date = datetime.strptime(meal_date_str, '%d.%m.%Y').replace(tzinfo=MOSCOW_TZ)
-                    # Устанавливаем на начало дня приготовления
-                    urgent_until = meal_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                    reminder['urgent_until'] = urgent_until.isoformat()
-                    logger.info(f"⏰ Срочный режим для ингредиента установлен до дня приготовления: {meal_date_str}")
-                except ValueError as e:
-                    logger.error(f"❌ Ошибка парсинга даты приготовления: {e}")
-                    # Резервный вариант: 24 часа
-                    reminder['urgent_until'] = (current_time + timedelta(days=1)).isoformat()
-            else:
-                # Резервный вариант: 24 часа
-                reminder['urgent_until'] = (current_time + timedelta(days=1)).isoformat()
-
-        else:
-            # Обычные напоминания - 24 часа срочного режима
-            reminder['urgent_reminders'] = True
-            reminder['urgent_until'] = (current_time + timedelta(days=1)).isoformat()
-
-        # Для интервальных напоминаний сохраняем оригинальные данные
-        interval_days = reminder.get('interval_days', 0)
-        if interval_days > 0:
-            reminder['original_interval'] = interval_days
-            reminder['original_datetime'] = reminder['datetime']
-
-        # Следующее срочное напоминание через 3 часа
-        next_urgent_time = current_time + timedelta(hours=3)
-        if next_urgent_time.hour >= 23 or next_urgent_time.hour < 9:
-            next_urgent_time = next_urgent_time.replace(hour=9, minute=0, second=0)
-            if next_urgent_time <= current_time:
-                next_urgent_time += timedelta(days=1)
-
-        reminder['datetime'] = next_urgent_time.isoformat()
-        reminder['not_bought_count'] = reminder.get('not_bought_count', 0) + 1
-        reminder['last_sent'] = None
+        # Следующее срочное напоминание через 3 часа, но не в тихие часы
+        next_urgent_ts = next_send_time(reminder, now + URGENT_REPEAT_INTERVAL)
 
-        # Сохраняем изменения
-        if not save_reminders(reminders):
+        # Сохраняем изменения (на свежей версии напоминания)
+        reminder = await repository.update(
+            'reminders', reminder_id, lambda draft: activate_urgent_mode(draft, now, next_urgent_ts))
+        if reminder is None:
             logger.error("❌ Ошибка при сохранении напоминания после активации срочного режима")
             await query.edit_message_text("❌ Ошибка при сохранении. Попробуйте снова.")
             return
 
-        next_time_str = next_urgent_time.strftime('%d.%m.%Y %H:%M')
+        next_time_str = local_time(next_urgent_ts, user_timezone(query.from_user.id)).strftime('%d.%m.%Y %H:%M')
         logger.info(f"✅ Срочный режим активирован для {reminder_id}. Следующее напоминание: {next_time_str}")
 
-        # УДАЛЯЕМ ТЕКУЩЕЕ СООБЩЕНИЕ
-        try:
-            await query.message.delete()
-            logger.info(f"🗑 Удалено текущее сообщение с кнопками для reminder {reminder_id}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при удалении текущего сообщения: {e}")
+        # ТЕКУЩЕЕ СООБЩЕНИЕ ОБНОВИТСЯ НА МЕСТЕ; удаляем его, только если оно не отслеживается
+        if message_store.message_id(reminder_id, query.from_user.id) != query.message.message_id:
+            try:
+                await query.message.delete()
+                logger.info(f"🗑 Удалено текущее сообщение с кнопками для reminder {reminder_id}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка при удалении текущего сообщения: {e}")
 
         # Немедленно отправляем срочное напоминание всем пользователям С ЗАМЕЩЕНИЕМ СТАРЫХ СООБЩЕНИЙ
         try:
-            # ДЛЯ ИНГРЕДИЕНТОВ: используем флаг замещения для удаления старых сообщений
+            # Флаг замещения: отправленные сообщения редактируются на месте
             if reminder_type == 'ingredient':
                 await send_ingredient_reminder_notification(context.application, reminder, is_urgent_update=True)
             else:
                 await send_reminder_notification(context.application, reminder, users, is_urgent_update=True)
 
             # Обновляем last_sent после отправки
-            reminder['last_sent'] = current_time.isoformat()
-            save_reminders(reminders)
+            def mark_sent(draft):
+                draft['last_sent'] = now
+
+            await repository.update('reminders', reminder_id, mark_sent)
             logger.info(f"✅ Немедленно отправлено срочное напоминание для {reminder_id} с замещением старых сообщений")
         except Exception as e:
             logger.error(f"❌ Ошибка при отправке срочного напоминания: {e}")
 
+async def handle_shopping_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка ингредиента в списке покупок: отмечает купленным / снимает отметку в том же сообщении"""
+    query = update.callback_query
+    reminder_id = context.args[0] if context.args else None
+    reminder = repository.get('reminders', reminder_id) if reminder_id else None
+    if not reminder:
+        await query.answer("Напоминание уже неактуально.")
+        return
+    await query.answer()
+
+    user_id = str(query.from_user.id)
+    meal_plan_id = reminder['meal_plan_id']
+    items = await shopping_list_items(meal_plan_id, user_id)
+
+    async with entity_locks.hold('reminder', [item_id for item_id, _ in items]):
+        def toggle(draft):
+            confirmed_by = {str(confirmed) for confirmed in draft.get('confirmed_by') or ()}
+            confirmed_by ^= {user_id}
+            draft['confirmed_by'] = confirmed_by
+
+        await repository.update('reminders', reminder_id, toggle)
+        items = await shopping_list_items(meal_plan_id, user_id)
+        all_bought = bool(items) and all(is_ingredient_bought(item, user_id) for _, item in items)
+        if all_bought:
+            # ВСЕ КУПЛЕНО: удаляем напоминания ингредиентов, как при "Купил"
+            for item_id, _ in items:
+                repository.delete('reminders', item_id)
+            message_store.discard(shopping_list_key(meal_plan_id), user_id)
+
+    if not all_bought:
+        message_text, reply_markup = render_shopping_list(meal_plan_id, user_id, items, now_ts())
+        try:
+            await edit_notification(query, shopping_list_key(meal_plan_id), message_text, reply_markup)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления списка покупок: {e}")
+        return
+
+    users = load_users()
+    username = users.get(user_id, {}).get('username', 'Unknown')
+    logger.info(f"✅ {username} купил(а) все ингредиенты плана {meal_plan_id}: {len(items)}")
+    result = await create_next_week_meal_plan(context.application, meal_plan_id)
+    text = f"✅ {username} подтвердил(а) покупку всех ингредиентов ({len(items)}).\n🍽 Напоминания удалены."
+    if result == "plan_already_exists":
+        text += "\n📅 План на следующую неделю уже был создан ранее!"
+    elif result:
+        text += "\n📅 Автоматически создан план на следующую неделю!"
+    reply_message = await reply_to_notification(query, shopping_list_key(meal_plan_id), text)
+    schedule_message_deletion(context, reply_message)
+
+async def handle_shopping_later(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка "Еще не купил" в списке покупок: срочный режим для всех некупленных ингредиентов"""
+    query = update.callback_query
+    await query.answer()
+
+    meal_plan_id = context.args[0] if context.args else None
+    user_id = str(query.from_user.id)
+    items = await shopping_list_items(meal_plan_id, user_id) if meal_plan_id else []
+    pending = [item_id for item_id, item in items if not is_ingredient_bought(item, user_id)]
+    if not pending:
+        await query.edit_message_text("❌ Напоминание не найдено.")
+        schedule_message_deletion(context, query.message)
+        return
+
+    now = now_ts()
+    next_urgent_times = []
+
+    def postpone(draft):
+        # Следующее срочное напоминание через 3 часа, но не в тихие часы всех получателей ингредиента
+        next_urgent_ts = next_send_time(draft, now + URGENT_REPEAT_INTERVAL)
+        activate_urgent_mode(draft, now, next_urgent_ts)
+        # Список обновляется сразу - следующий повтор через 3 часа
+        draft['last_sent'] = now
+        next_urgent_times.append(next_urgent_ts)
+
+    async with entity_locks.hold('reminder', pending):
+        for item_id in pending:
+            await repository.update('reminders', item_id, postpone)
+    if next_urgent_times:
+        next_time = local_time(min(next_urgent_times), user_timezone(user_id)).strftime('%d.%m.%Y %H:%M')
+        logger.info(f"✅ Срочный режим активирован для списка покупок плана {meal_plan_id} ({len(pending)} ингредиентов). "
+                    f"Следующее напоминание: {next_time}")
+
+    items = await shopping_list_items(meal_plan_id, user_id)
+    message_text, reply_markup = render_shopping_list(meal_plan_id, user_id, items, now)
+    try:
+        await edit_notification(query, shopping_list_key(meal_plan_id), message_text, reply_markup)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления списка покупок: {e}")
+
 async def start_delete_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало удаления напоминания"""
     query = update.callback_query
@@ -6044,7 +8610,7 @@ async def handle_delete_confirmation(update: Update, context: ContextTypes.DEFAU
 
     if len(reminder['delete_confirmed_by']) >= len(reminder['users']):
         del reminders[reminder_id]
-        if not save_reminders(reminders):
+        if not await save_reminders(reminders):
             logger.error("Ошибка при записи напоминаний в файл reminders.json")
         await query.edit_message_text(
             "🗑 Напоминание удалено.",
@@ -6053,7 +8619,7 @@ async def handle_delete_confirmation(update: Update, context: ContextTypes.DEFAU
             ])
         )
     else:
-        if not save_reminders(reminders):
+        if not await save_reminders(reminders):
             logger.error("Ошибка при записи напоминаний в файл reminders.json")
         await query.edit_message_text(
             f"✅ Вы подтвердили удаление. Ожидается подтверждение от других пользователей ({len(reminder['delete_confirmed_by'])}/{len(reminder['users'])}).",
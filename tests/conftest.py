@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+class MemoryBackend:
+    """Backend в памяти: коллекции загружаются из словаря, записи копятся в writes"""
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.collections = tuple(self.data) or ('users', 'reminders')
+        self.writes = []
+
+    def load(self, name):
+        return {record_id: dict(record) for record_id, record in self.data.get(name, {}).items()}
+
+    def write(self, name, changes):
+        self.writes.append((name, changes))
+        return True
+
+    def has_index(self, name, field):
+        return False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def memory_repository():
+    """Фабрика хранилищ на MemoryBackend (закрываются после теста)"""
+    repositories = []
+
+    def make(data=None):
+        repository = bot.StateRepository(MemoryBackend(data), bot.RECORD_TYPES)
+        repositories.append(repository)
+        return repository
+
+    yield make
+    for repository in repositories:
+        repository.close()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Файлы JsonBackend пишутся в относительные пути - работаем во временном каталоге"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import CallbackQuery, Message, Update, User
+
+import bot
+
+
+async def first(update, context):
+    return 'first'
+
+
+async def second(update, context):
+    return 'second'
+
+
+def callback_update(data):
+    return Update(1, callback_query=CallbackQuery('1', User(1, 'anna', False), 'chat', data=data))
+
+
+def test_callback_data_round_trip():
+    assert bot.callback_data('bought', 'r1', 2) == 'bought:r1:2'
+    assert bot.parse_callback_data('bought:r1:2') == ('bought', ['r1', '2'])
+    assert bot.parse_callback_data('shop_later:p1') == ('shop_later', ['p1'])
+    assert bot.parse_callback_data('list_reminders') == ('list_reminders', [])
+
+
+def test_resolve_action_passes_arguments():
+    router = bot.CallbackRouter()
+    router.add(first, action='bought')
+    assert router.resolve('bought:r1') == (first, ['r1'])
+    assert router.resolve('bought:') == (first, [])
+    assert router.resolve('unknown:r1') is None
+
+
+def test_resolve_exact_and_prefix_aliases():
+    router = bot.CallbackRouter()
+    router.add(first, exact=['list_reminders'])
+    router.add(second, prefixes=['delete_reminder_'])
+
+    assert router.resolve('list_reminders') == (first, [])
+    assert router.resolve('list_reminders_more') is None
+    assert router.resolve('delete_reminder_r1') == (second, [])
+    assert router.resolve('delete_remind') is None
+
+
+def test_resolve_prefers_earlier_route():
+    router = bot.CallbackRouter()
+    router.add(first, prefixes=['bought_'])
+    router.add(second, prefixes=['bought_r'], exact=['bought_r1'])
+    assert router.resolve('bought_r1') == (first, [])
+
+    router = bot.CallbackRouter()
+    router.add(first, prefixes=['not_'])
+    router.add(second, prefixes=['not_bought_'])
+    assert router.resolve('not_bought_r1') == (first, [])
+
+    router = bot.CallbackRouter()
+    router.add(first, exact=['back_to_day_selection'])
+    router.add(second, exact=['back_to_day_selection'], prefixes=['back_'])
+    assert router.resolve('back_to_day_selection') == (first, [])
+
+
+def test_unknown_action_falls_back_to_aliases():
+    router = bot.CallbackRouter()
+    router.add(first, action='bought')
+    router.add(second, prefixes=['cal_'])
+    # Старые данные с разделителем внутри префиксного формата
+    assert router.resolve('cal_2026:10:17') == (second, [])
+
+
+def test_check_update_and_handle_update():
+    router = bot.CallbackRouter()
+    router.add(first, action='shop')
+
+    assert router.check_update(callback_update('shop:p1:3')) == (first, ['p1', '3'])
+    assert router.check_update(callback_update('other')) is None
+    assert router.check_update(Update(2, message=Message(1, None, None))) is None
+    assert router.check_update('not an update') is None
+
+    context = SimpleNamespace(args=None)
+    result = asyncio.run(router.handle_update(callback_update('shop:p1:3'), None, (first, ['p1', '3']), context))
+    assert result == 'first'
+    assert context.args == ['p1', '3']
+
+
+@pytest.mark.parametrize('data, handler, args', [
+    ('bought:r1', 'handle_bought_not_bought', ['r1']),
+    ('bought_r1', 'handle_bought_not_bought', []),
+    ('not_bought:r1', 'handle_bought_not_bought', ['r1']),
+    ('not_bought_r1', 'handle_bought_not_bought', []),
+    ('shop:p1:3', 'handle_shopping_toggle', ['p1', '3']),
+    ('shop_later:p1', 'handle_shopping_later', ['p1']),
+    ('rpage:regular:2', 'handle_reminders_pagination', ['regular', '2']),
+    ('regular_page_2', 'handle_reminders_pagination', []),
+    ('delete_reminder_r1', 'handle_delete_reminder', []),
+    ('confirm_delete_r1', 'handle_confirm_delete', []),
+    ('my_reminders_delete', 'my_reminders_for_deletion', []),
+    ('list_reminders', 'main_menu_callback', []),
+    ('cancel_reminder', 'cancel_reminder', []),
+    ('ignore', 'ignore_callback', []),
+])
+def test_bot_routes(data, handler, args):
+    router = bot.build_callback_router()
+    resolved, resolved_args = router.resolve(data)
+    assert resolved is getattr(bot, handler)
+    assert resolved_args == args
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import bot
+
+
+def journal_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_write_appends_journal_and_load_replays_it(workdir):
+    backend = bot.JsonBackend()
+    assert backend.load('users') == {}
+
+    assert backend.write('users', {'1': {'username': 'anna'}, '2': {'username': 'boris'}})
+    assert backend.write('users', {'2': None})
+    entries = journal_lines(workdir / 'users.json.journal')
+    assert [(entry['op'], entry['id']) for entry in entries] == [('put', '1'), ('put', '2'), ('del', '2')]
+
+    # Снимок не переписывается при каждом изменении
+    assert json.loads((workdir / 'users.json').read_text(encoding='utf-8')) == {}
+    assert bot.JsonBackend().load('users') == {'1': {'username': 'anna'}}
+
+
+def test_write_skips_unchanged_records(workdir):
+    backend = bot.JsonBackend()
+    backend.load('users')
+    backend.write('users', {'1': {'username': 'anna'}})
+    size = (workdir / 'users.json.journal').stat().st_size
+
+    assert backend.write('users', {'1': {'username': 'anna'}, '3': None})
+    assert (workdir / 'users.json.journal').stat().st_size == size
+
+
+def test_load_skips_torn_journal_line(workdir):
+    backend = bot.JsonBackend()
+    backend.load('users')
+    backend.write('users', {'1': {'username': 'anna'}})
+    with open(workdir / 'users.json.journal', 'a', encoding='utf-8') as f:
+        f.write('{"ts":"2026-10-17T10:00:00+03:00","op":"put","id":"2","da')
+
+    assert bot.JsonBackend().load('users') == {'1': {'username': 'anna'}}
+
+
+def test_compaction_keeps_previous_snapshot_and_journal(workdir, monkeypatch):
+    monkeypatch.setattr(bot, 'JOURNAL_COMPACT_BYTES', 1)
+    backend = bot.JsonBackend()
+    backend.load('users')
+
+    backend.write('users', {'1': {'username': 'anna'}})
+    assert json.loads((workdir / 'users.json').read_text(encoding='utf-8')) == {'1': {'username': 'anna'}}
+    assert not (workdir / 'users.json.journal').exists()
+    assert json.loads((workdir / 'users.json.prev').read_text(encoding='utf-8')) == {}
+    assert [entry['id'] for entry in journal_lines(workdir / 'users.json.journal.prev')] == ['1']
+
+    backend.write('users', {'2': {'username': 'boris'}})
+    assert json.loads((workdir / 'users.json.prev').read_text(encoding='utf-8')) == {'1': {'username': 'anna'}}
+    assert [entry['id'] for entry in journal_lines(workdir / 'users.json.journal.prev')] == ['2']
+    assert bot.JsonBackend().load('users') == {'1': {'username': 'anna'}, '2': {'username': 'boris'}}
+
+
+def test_corrupt_snapshot_is_recovered_from_prev(workdir, monkeypatch):
+    monkeypatch.setattr(bot, 'JOURNAL_COMPACT_BYTES', 1)
+    backend = bot.JsonBackend()
+    backend.load('users')
+    backend.write('users', {'1': {'username': 'anna'}})
+    backend.write('users', {'2': {'username': 'boris'}})
+
+    # Снимок поврежден после сворачивания журнала: контрольная сумма не совпадает
+    (workdir / 'users.json').write_text('{"1":{"username":"an', encoding='utf-8')
+
+    expected = {'1': {'username': 'anna'}, '2': {'username': 'boris'}}
+    assert bot.JsonBackend().load('users') == expected
+    assert len(list(workdir.glob('users.json.corrupt.*'))) == 1
+    # Восстановленный снимок записан вместе с новой контрольной суммой
+    assert bot._checked_payload('users.json') is not None
+    assert bot.JsonBackend().load('users') == expected
+
+
+def test_corrupt_snapshot_without_prev_refuses_to_load(workdir):
+    bot._write_json_atomic('users.json', {'1': {'username': 'anna'}})
+    (workdir / 'users.json').write_text('{}', encoding='utf-8')
+
+    with pytest.raises(bot.SnapshotChecksumError):
+        bot.JsonBackend().load('users')
+    # Поврежденные данные не подменяются пустыми
+    assert (workdir / 'users.json').read_text(encoding='utf-8') == '{}'
+    assert len(list(workdir.glob('users.json.corrupt.*'))) == 1
@@ -0,0 +1,108 @@
+from datetime import datetime
+
+import pytest
+
+import bot
+
+
+def ts(day, hour, minute=0, tz=None):
+    return int(datetime(2026, 10, day, hour, minute, tzinfo=tz or bot.DEFAULT_TZ).timestamp())
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(bot, 'REMINDER_JITTER_WINDOW', 0)
+
+
+@pytest.fixture
+def users(memory_repository, monkeypatch):
+    """Подменяет хранилище бота хранилищем с заданными пользователями"""
+    def install(records):
+        monkeypatch.setattr(bot, 'repository', memory_repository({'users': records}))
+    return install
+
+
+def test_parse_quiet_hours():
+    policy = bot.parse_quiet_hours('23:00-09:30')
+    assert (policy.start, policy.end) == (23 * 60, 9 * 60 + 30)
+    assert policy.tz is bot.DEFAULT_TZ
+    assert str(policy) == '23:00-09:30'
+
+    assert str(bot.parse_quiet_hours('off')) == 'выключены'
+    assert bot.parse_quiet_hours('22:00-07:00', 'Asia/Vladivostok').tz == bot.get_timezone('Asia/Vladivostok')
+    for spec in ('25:00-07:00', '22:00', 'ночью'):
+        with pytest.raises(ValueError):
+            bot.parse_quiet_hours(spec)
+
+
+def test_is_quiet_across_midnight_and_within_day():
+    night = bot.parse_quiet_hours('23:00-09:00')
+    assert night.is_quiet(ts(17, 23))
+    assert night.is_quiet(ts(18, 8, 59))
+    assert not night.is_quiet(ts(18, 9))
+    assert not night.is_quiet(ts(17, 22, 59))
+
+    lunch = bot.parse_quiet_hours('13:00-14:00')
+    assert lunch.is_quiet(ts(17, 13, 30))
+    assert not lunch.is_quiet(ts(17, 14))
+
+    off = bot.parse_quiet_hours('off')
+    assert not any(off.is_quiet(ts(17, hour)) for hour in range(24))
+
+
+def test_next_allowed_defers_to_end_of_quiet_hours(no_jitter):
+    night = bot.parse_quiet_hours('23:00-09:00')
+    assert night.next_allowed(ts(17, 12)) == ts(17, 12)
+    assert night.next_allowed(ts(17, 23, 30)) == ts(18, 9)
+    assert night.next_allowed(ts(18, 2)) == ts(18, 9)
+
+
+def test_next_allowed_jitter_is_stable_per_key(monkeypatch):
+    monkeypatch.setattr(bot, 'REMINDER_JITTER_WINDOW', 900)
+    night = bot.parse_quiet_hours('23:00-09:00')
+
+    shift = night.next_allowed(ts(18, 2), 'r1') - ts(18, 9)
+    assert 0 <= shift < 900
+    assert night.next_allowed(ts(17, 23, 30), 'r1') - ts(18, 9) == shift
+    # Вне тихих часов время не сдвигается
+    assert night.next_allowed(ts(17, 12), 'r1') == ts(17, 12)
+
+
+def test_ingredients_of_one_plan_share_jitter_key():
+    first = {'id': 'i1', 'type': 'ingredient', 'meal_plan_id': 'p1'}
+    second = {'id': 'i2', 'type': 'ingredient', 'meal_plan_id': 'p1'}
+    assert bot.reminder_jitter_key(first) == bot.reminder_jitter_key(second) == 'plan_p1'
+    assert bot.reminder_jitter_key({'id': 'r1', 'type': 'regular'}) == 'r1'
+
+
+def test_next_send_time_waits_for_all_recipients(users, no_jitter):
+    users({'1': {'quiet_hours': '23:00-09:00'}, '2': {'quiet_hours': '08:00-10:00'}})
+    reminder = {'id': 'r1', 'users': [1, 2]}
+
+    assert bot.next_send_time(reminder, ts(17, 12)) == ts(17, 12)
+    # После тихих часов первого начинаются тихие часы второго
+    assert bot.next_send_time(reminder, ts(17, 23, 30)) == ts(18, 10)
+
+
+def test_next_send_time_uses_recipient_timezone(users, no_jitter):
+    vladivostok = bot.get_timezone('Asia/Vladivostok')
+    users({'1': {'quiet_hours': '23:00-09:00', 'timezone': 'Asia/Vladivostok'}})
+    reminder = {'id': 'r1', 'users': [1]}
+
+    assert bot.next_send_time(reminder, ts(18, 12, tz=vladivostok)) == ts(18, 12, tz=vladivostok)
+    assert bot.next_send_time(reminder, ts(18, 0, tz=vladivostok)) == ts(18, 9, tz=vladivostok)
+
+
+def test_next_send_time_falls_back_without_common_window(users, no_jitter):
+    users({'1': {'quiet_hours': '00:00-12:00'}, '2': {'quiet_hours': '12:00-00:00'}})
+    reminder = {'id': 'r1', 'users': [1, 2]}
+
+    allowed = bot.next_send_time(reminder, ts(17, 1))
+    assert allowed >= ts(17, 1)
+    assert not bot.QUIET_HOURS.is_quiet(allowed)
+
+
+def test_next_send_time_defaults_for_unknown_users(users, no_jitter):
+    users({})
+    assert bot.next_send_time({'id': 'r1', 'users': [42]}, ts(17, 1)) == bot.QUIET_HOURS.next_allowed(ts(17, 1))
+    assert bot.next_send_time({'id': 'r1', 'users': []}, ts(17, 12)) == bot.QUIET_HOURS.next_allowed(ts(17, 12))
@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def reminder(record_id='r1', text='Купить молоко', **fields):
+    return {'id': record_id, 'text': text, 'interval_days': 1, 'users': [1], 'created_by': 1, **fields}
+
+
+def test_put_bumps_version_and_stores_copy(memory_repository):
+    repository = memory_repository()
+    record = repository.put('reminders', 'r1', reminder())
+    assert record.version == 1
+    assert repository.put('reminders', 'r1', reminder(text='Купить хлеб')).version == 2
+
+    # Хранилище держит свою копию записи
+    record['text'] = 'изменено после сохранения'
+    assert repository.get('reminders', 'r1')['text'] == 'Купить хлеб'
+
+
+def test_compare_and_set_checks_version(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder(version=3)}})
+
+    assert not repository.compare_and_set('reminders', 'r1', 2, reminder(text='устаревшее'))
+    assert repository.get('reminders', 'r1')['text'] == 'Купить молоко'
+    assert repository.get('reminders', 'r1').version == 3
+
+    assert repository.compare_and_set('reminders', 'r1', 3, reminder(text='новое'))
+    assert repository.get('reminders', 'r1')['text'] == 'новое'
+    assert repository.get('reminders', 'r1').version == 4
+
+    assert not repository.compare_and_set('reminders', 'missing', 0, reminder('missing'))
+
+
+def test_update_applies_mutation(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+
+    def mutate(draft):
+        draft['not_bought_count'] = 2
+
+    updated = asyncio.run(repository.update('reminders', 'r1', mutate))
+    assert updated['not_bought_count'] == 2
+    assert repository.get('reminders', 'r1')['not_bought_count'] == 2
+    assert repository.get('reminders', 'r1').version == 1
+
+
+def test_update_skips_when_mutate_returns_false(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+
+    def mutate(draft):
+        draft['text'] = 'не сохранится'
+        return False
+
+    assert asyncio.run(repository.update('reminders', 'r1', mutate)) is None
+    assert repository.get('reminders', 'r1')['text'] == 'Купить молоко'
+    assert repository.get('reminders', 'r1').version == 0
+    assert asyncio.run(repository.update('reminders', 'missing', mutate)) is None
+
+
+def test_update_retries_on_concurrent_change(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+    attempts = []
+
+    async def mutate(draft):
+        attempts.append(draft['text'])
+        if len(attempts) == 1:
+            # Пока обработчик ждал, запись изменил другой обработчик
+            repository.put('reminders', 'r1', reminder(text='параллельная правка'))
+        draft['not_bought_count'] = 1
+
+    updated = asyncio.run(repository.update('reminders', 'r1', mutate))
+    assert attempts == ['Купить молоко', 'параллельная правка']
+    assert updated['text'] == 'параллельная правка'
+    assert updated['not_bought_count'] == 1
+    assert repository.get('reminders', 'r1').version == 2
+
+
+def test_update_gives_up_after_attempts(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+
+    def mutate(draft):
+        repository.put('reminders', 'r1', reminder(text='всегда новее'))
+
+    with pytest.raises(bot.VersionConflict) as error:
+        asyncio.run(repository.update('reminders', 'r1', mutate, attempts=3))
+    assert error.value.name == 'reminders'
+    assert error.value.record_ids == ['r1']
+
+
+def test_snapshot_is_copy_on_read(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+    snapshot = repository.snapshot('reminders')
+
+    snapshot['r1']['text'] = 'правка в копии'
+    assert repository.get('reminders', 'r1')['text'] == 'Купить молоко'
+    assert snapshot.changed() == {'r1'}
+
+    assert repository.commit('reminders', snapshot)
+    assert repository.get('reminders', 'r1')['text'] == 'правка в копии'
+    assert repository.get('reminders', 'r1').version == 1
+    # После сохранения копия сравнивается с записанной версией
+    assert snapshot.changed() == set()
+
+
+def test_commit_rejects_stale_snapshot(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder(), 'r2': reminder('r2')}})
+    first = repository.snapshot('reminders')
+    second = repository.snapshot('reminders')
+
+    first['r1']['text'] = 'первый писатель'
+    assert repository.commit('reminders', first)
+
+    second['r1']['text'] = 'второй писатель'
+    second['r2']['text'] = 'тоже не сохранится'
+    assert not repository.commit('reminders', second)
+    assert repository.get('reminders', 'r1')['text'] == 'первый писатель'
+    assert repository.get('reminders', 'r2')['text'] == 'Купить молоко'
+
+
+def test_commit_untouched_records_do_not_conflict(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder(), 'r2': reminder('r2')}})
+    snapshot = repository.snapshot('reminders')
+    repository.put('reminders', 'r2', reminder('r2', text='параллельная правка'))
+
+    snapshot['r1']['text'] = 'своя правка'
+    assert repository.commit('reminders', snapshot)
+    assert repository.get('reminders', 'r2')['text'] == 'параллельная правка'
+
+
+def test_commit_deletes_and_does_not_resurrect(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder(), 'r2': reminder('r2')}})
+    snapshot = repository.snapshot('reminders')
+    del snapshot['r1']
+    assert repository.commit('reminders', snapshot)
+    assert repository.get('reminders', 'r1') is None
+
+    stale = repository.snapshot('reminders')
+    stale['r2'] = bot.Reminder(reminder('r2', text='замена'))
+    repository.delete('reminders', 'r2')
+    assert not repository.commit('reminders', stale)
+    assert repository.get('reminders', 'r2') is None
+
+
+def test_commit_new_record_conflicts_with_parallel_create(memory_repository):
+    repository = memory_repository({'reminders': {}})
+    snapshot = repository.snapshot('reminders')
+    repository.put('reminders', 'r1', reminder(text='создан параллельно'))
+
+    snapshot['r1'] = bot.Reminder(reminder())
+    assert not repository.commit('reminders', snapshot)
+    assert repository.get('reminders', 'r1')['text'] == 'создан параллельно'
+
+
+def test_commit_plain_dict_rejects_stale_versions(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder()}})
+    records = {'r1': bot.Reminder(reminder(text='по старой версии'))}
+    repository.put('reminders', 'r1', reminder(text='параллельная правка'))
+
+    assert not repository.commit('reminders', records)
+    assert repository.get('reminders', 'r1')['text'] == 'параллельная правка'
+
+    current = repository.get('reminders', 'r1').clone()
+    current['text'] = 'по свежей версии'
+    assert repository.commit('reminders', {'r1': current})
+    assert repository.get('reminders', 'r1')['text'] == 'по свежей версии'
+    assert repository.get('reminders', 'r1').version == 2
+
+
+def test_flush_writes_only_dirty_records(memory_repository):
+    repository = memory_repository({'reminders': {'r1': reminder(), 'r2': reminder('r2')}})
+    repository.collection('reminders')
+    backend = repository.backend
+
+    # Вне цикла событий запись на диск идет сразу
+    repository.put('reminders', 'r2', reminder('r2', text='изменено'))
+    repository.delete('reminders', 'r1')
+    changes = {}
+    for name, written in backend.writes:
+        assert name == 'reminders'
+        changes.update(written)
+    assert changes['r1'] is None
+    assert changes['r2']['text'] == 'изменено'
+    assert changes['r2']['version'] == 1
+    assert repository.flush()